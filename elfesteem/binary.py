@@ -10,6 +10,7 @@ from elfesteem.pe_init import PE, COFF
 from elfesteem.minidump_init import Minidump
 from elfesteem.macho import MACHO
 from elfesteem.rprc import RPRC
+from elfesteem.strpatchwork import StrPatchwork
 
 class UnknownFormat(object):
     def __init__(self, raw):
@@ -46,12 +47,7 @@ class BINARY(object):
 if __name__ == "__main__":
     for file in sys.argv[1:]:
         print("File: %s"%file)
-        fd = open(file, 'rb')
-        try:
-            raw = fd.read()
-        finally:
-            fd.close()
-        e = BINARY(raw)
+        e = BINARY(StrPatchwork.from_file(file))
         print("  container    %s" % e.container)
         print("  architecture %s" % e.architecture)
         print("  entrypoint   %#x" % e.entrypoint)
@@ -0,0 +1,194 @@
+# Columnar view of a table of fixed-size records (e.g. ELF symbols or
+# relocations): the whole table is decoded in one pass, and each field
+# is a column. Queries on columns are vectorised when NumPy is available;
+# else the columns are arrays of the 'array' module.
+
+import struct
+from array import array
+from elfesteem.cstruct import data_null, data_empty, Struct
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Conversion from 'struct' types to NumPy types
+numpy_types = {
+    'B': 'u1', 'H': 'u2', 'I': 'u4', 'Q': 'u8',
+    'b': 'i1', 'h': 'i2', 'i': 'i4', 'q': 'i8',
+    }
+
+def record_layout(cls, parent, stride=None):
+    sex = parent.sex
+    if cls._packformat: sex = ""
+    format, st, names, opt, _ = cls._codec(sex, parent.wsize)
+    if stride is None or stride < st.size:
+        stride = st.size
+    return sex + cls._packformat, format, names, stride
+
+def numpy_dtype(sex, format, names, stride):
+    offsets = []
+    formats = []
+    for name in names:
+        offsets.append(struct.calcsize(sex+"".join(
+            [format[_] for _ in names[:len(offsets)]])))
+        ftype = format[name]
+        if ftype.endswith('s'):
+            formats.append('S'+ftype[:-1])
+        else:
+            formats.append((sex or '=')+numpy_types[ftype])
+    return numpy.dtype({'names': names, 'formats': formats,
+                        'offsets': offsets, 'itemsize': stride})
+
+def fallback_record(sex, format, names, stride):
+    # Format of one record, without endianess, padded to 'stride'
+    record = "".join([format[_] for _ in names])
+    return record + 'x'*(stride-struct.calcsize(sex+record))
+
+class Columns(object):
+    """
+    How to create a Columns object:
+      cls: the CStruct class of the records
+      parent: the object that would be the parent of the records
+      content: the table, as bytes or StrPatchwork
+      stride: distance between two records (default: size of 'cls')
+      use_numpy: if False, NumPy is not used even if available
+
+    How to use a Columns object:
+      len gives the number of records
+      [name] is the column of a field, or of a value derived from a
+        field, as defined by the '_derived' attribute of 'cls'
+      select(**conditions) gives the list of indexes of records that
+        verify all conditions; a condition field=value means equality,
+        field=(start, stop) means start <= field < stop
+    """
+    def __init__(self, cls, parent, content, stride=None, use_numpy=True):
+        if use_numpy:
+            self.numpy = numpy
+        else:
+            self.numpy = None
+        sex, format, names, stride = record_layout(cls, parent, stride)
+        data = content[0:len(content)]
+        count = (len(data)+stride-1)//stride
+        data += data_null*(count*stride-len(data))
+        self.count = count
+        self.derived = getattr(cls, '_derived', {})
+        self.columns = {}
+        if self.numpy is not None:
+            dtype = numpy_dtype(sex, format, names, stride)
+            table = self.numpy.frombuffer(data, dtype=dtype, count=count)
+            for name in names:
+                self.columns[name] = table[name]
+        else:
+            # Only one call to 'unpack' for many records; the values of
+            # a given field are then extracted by slicing.
+            record = fallback_record(sex, format, names, stride)
+            step = 0x1000
+            values = [ [] for _ in names ]
+            for start in range(0, count, step):
+                n = min(step, count-start)
+                flat = Struct(sex+record*n).unpack_from(data, start*stride)
+                for i in range(len(names)):
+                    values[i].extend(flat[i::len(names)])
+            for i in range(len(names)):
+                self.columns[names[i]] = self.fallback_column(
+                    format[names[i]], values[i])
+
+    def fallback_column(self, ftype, values):
+        if ftype.endswith('s'):
+            return values
+        try:
+            return array(ftype, values)
+        except ValueError:
+            # e.g. 'Q' typecode is not available before python3.3
+            return values
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        if not name in self.columns:
+            field, shift, mask = self.derived[name]
+            col = self.columns[field]
+            if self.numpy is not None:
+                t = col.dtype.type
+                self.columns[name] = (col >> t(shift)) & t(mask)
+            else:
+                self.columns[name] = [ (_>>shift)&mask for _ in col ]
+        return self.columns[name]
+
+    def select(self, **conditions):
+        if self.numpy is not None:
+            mask = self.numpy.ones(self.count, dtype=bool)
+            for name, value in conditions.items():
+                col = self[name]
+                if type(value) is tuple:
+                    mask &= (col >= value[0]) & (col < value[1])
+                else:
+                    mask &= col == value
+            return [ int(_) for _ in self.numpy.nonzero(mask)[0] ]
+        idx = range(self.count)
+        for name, value in conditions.items():
+            col = self[name]
+            if type(value) is tuple:
+                start, stop = value
+                idx = [ _ for _ in idx if start <= col[_] < stop ]
+            else:
+                idx = [ _ for _ in idx if col[_] == value ]
+        return list(idx)
+
+def pack_columns(cls, parent, values, stride=None, use_numpy=True):
+    """
+    Inverse of Columns: creates the table of records of type 'cls'
+      values: maps the names of fields, or of values derived from a
+        field, to sequences of the same length; fields without value
+        are null, derived values are or-ed in their field
+      other arguments are the same as for Columns
+    The encoding is vectorised when NumPy is available.
+    """
+    sex, format, names, stride = record_layout(cls, parent, stride)
+    derived = getattr(cls, '_derived', {})
+    count = 0
+    for name in values:
+        if not name in format and not name in derived:
+            raise ValueError("%s has no field %r" % (cls.__name__, name))
+        count = max(count, len(values[name]))
+    for name in values:
+        if len(values[name]) != count:
+            raise ValueError("Columns of different lengths")
+    if use_numpy and numpy is not None:
+        table = numpy.zeros(count, dtype=numpy_dtype(sex, format, names, stride))
+        for name in names:
+            if name in values:
+                table[name] = numpy.asarray(values[name],
+                                            dtype=table.dtype[name])
+        for name, (field, shift, mask) in derived.items():
+            if name in values:
+                col = table[field]
+                t = col.dtype.type
+                col |= (numpy.asarray(values[name], dtype=col.dtype)
+                        & t(mask)) << t(shift)
+        return table.tobytes()
+    # Same as above, with one call to 'pack' for many records.
+    rows = []
+    for name in names:
+        if name in values:
+            col = list(values[name])
+        elif format[name].endswith('s'):
+            col = [data_empty] * count
+        else:
+            col = [0] * count
+        for dname, (field, shift, mask) in derived.items():
+            if field == name and dname in values:
+                col = [ c | ((v & mask) << shift)
+                        for c, v in zip(col, values[dname]) ]
+        rows.append(col)
+    record = fallback_record(sex, format, names, stride)
+    step = 0x1000
+    data = []
+    for start in range(0, count, step):
+        n = min(step, count-start)
+        flat = []
+        for rec in zip(*[ _[start:start+n] for _ in rows ]):
+            flat.extend(rec)
+        data.append(Struct(sex+record*n).pack(*flat))
+    return data_empty.join(data)
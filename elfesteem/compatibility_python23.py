@@ -15,3 +15,17 @@ if sys.version_info[0] == 2 and sys.version_info[1] <= 3:
         return [ l[length-idx] for idx in range(1,length+1) ]
     import warnings
     warnings.simplefilter("ignore", FutureWarning)
+
+import struct
+if not hasattr(struct, 'Struct'):
+    # Python 2.3 and 2.4 do not know 'struct.Struct'
+    class Struct(object):
+        def __init__(self, format):
+            self.format = format
+            self.size = struct.calcsize(format)
+        def pack(self, *args):
+            return struct.pack(self.format, *args)
+        def unpack(self, data):
+            return struct.unpack(self.format, data)
+        def unpack_from(self, data, offset=0):
+            return struct.unpack(self.format, data[offset:offset+self.size])
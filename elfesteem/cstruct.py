@@ -13,6 +13,10 @@ if sys.version_info[0] < 3:
 else:
     bytes_to_name = lambda s: s.decode(encoding="latin1")
     name_to_bytes = lambda s: s.encode(encoding="latin1")
+if hasattr(struct, 'Struct'):
+    Struct = struct.Struct
+else:
+    from elfesteem.compatibility_python23 import Struct
 
 class CBase(object):
     """
@@ -24,13 +28,18 @@ class CBase(object):
       bytelen:  length of this byte string
       pprint(): representation of the object, that can be used by pprint
       update(): named args, that change the object content
+      modified(): called when the object changes, tells the parent
 
     Parameters used to create a CBase object from a bytestring:
       parent:  parent object (mandatory)
       content: binary stream to initialize the object
       start:   offset where to start parsing the content
       sex and wsize: endianess and wordsize
+
+    Subclasses that define __slots__ have no __dict__; this is used for
+    records that are parsed in large numbers, e.g. symbols.
     """
+    __slots__ = ('parent', 'sex', 'wsize', '_size')
     def __init__(self, *args, **kargs):
         if not 'parent' in kargs:
             # Old API of elfesteem
@@ -61,6 +70,12 @@ class CBase(object):
         pass
     def update(self, **kargs):
         pass
+    def modified(self):
+        # Called when the object is modified; the parent is told, e.g.
+        # to reset the indexes of a directory that contains the object
+        parent = getattr(self, 'parent', None)
+        if isinstance(parent, CBase):
+            parent.modified()
 
     def __len__(self):
         # We don't use __len__ for the length in bytes, because we want to be able
@@ -85,6 +100,7 @@ class CString(CBase):
     def set_value(self, s):
         self.X = s
         self._size = len(self.X) + 1
+        self.modified()
     def unpack(self, c, o):
         self.set_value(c[o:c.find(data_null,o)])
         self._off = o
@@ -103,7 +119,7 @@ class CString(CBase):
     def pprint(self):
         return self.X
 
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.strpatchwork import StrPatchwork, bytes_type
 class CData(object):
     # Generic class to be used at the end of a CStruct, to implement common
     # cases implemented in C as     struct s { ...; char data[]; }
@@ -174,9 +190,18 @@ class CStruct_metaclass(type):
                     lambda self,fname=fname:   self.getf(fname),
                     lambda self,v,fname=fname: self.setf(fname,v),
                     None)
+            if '__slots__' in dct:
+                # Compact objects: the values are stored in slots
+                slots = []
+                for c in bases:
+                    for k in c.__mro__:
+                        slots.extend(k.__dict__.get('__slots__', ()))
+                dct['__slots__'] = tuple(dct['__slots__']) + tuple(
+                    ['_0'+fname for fname, _ in dct['_fields']
+                                if not '_0'+fname in slots])
         return type.__new__(cls, name, bases, dct)
 
-CStruct_base = CStruct_metaclass('CStruct_base', (CBase,), {})
+CStruct_base = CStruct_metaclass('CStruct_base', (CBase,), {'__slots__': ()})
 class CStruct(CStruct_base):
     """
     The class CStruct is inherited by classes that simply
@@ -196,35 +221,66 @@ class CStruct(CStruct_base):
     Field types:
       basic types with fixed size (u08, ..., 16s)
       wsize-dependent type (ptr)
+
+    The format of the fields is shared by all objects of the same class,
+    sex and wsize. If the class defines __slots__, then a slot is added
+    for each field.
     """
+    __slots__ = ('_meta',)
 
     def getf(self, fname):
         return getattr(self,'_0'+fname)
     def setf(self, fname, v):
         return setattr(self,'_0'+fname,v)
 
+    _format = property(lambda _: _._meta[0])
+    _struct = property(lambda _: _._meta[1])
+    _names  = property(lambda _: _._meta[2])
+    _opt    = property(lambda _: _._meta[3])
+
     _packformat = ""
 
+    def _codec(cls, sex, wsize):
+        # The format only depends on the class, the endianess and the
+        # wordsize; it is computed once and cached in the class.
+        cache = cls.__dict__.get('_codec_cache')
+        if cache is None:
+            cache = {}
+            cls._codec_cache = cache
+        key = (sex, wsize)
+        if not key in cache:
+            format = {}
+            pstr = []
+            for fname, ftype in cls._fields:
+                ftype = convert_size2type(ftype, wsize)
+                format[fname] = ftype
+                pstr.append(ftype)
+            packstring = sex + cls._packformat + "".join(pstr)
+            names = [x[0] for x in cls._fields if isinstance(x[1],str)]
+            opt = [x for x in cls._fields if not isinstance(x[1],str)]
+            attrs = ['_0'+x for x in names]
+            cache[key] = (format, Struct(packstring), names, opt, attrs)
+        return cache[key]
+    _codec = classmethod(_codec)
+
     def _parent_parse(self, kargs):
         CBase._parent_parse(self, kargs)
         if self._packformat:
             self.sex = ""
-        self._format = {}
-        pstr = []
-        for fname, ftype in self._fields:
-            ftype = convert_size2type(ftype, self.wsize)
-            self._format[fname] = ftype
-            pstr.append(ftype)
-        self._packstring =  self.sex + self._packformat+"".join(pstr)
-        self._names = [x[0] for x in self._fields if isinstance(x[1],str)]
-        self._opt = [x for x in self._fields if not isinstance(x[1],str)]
+        self._meta = self._codec(self.sex, self.wsize)
 
     def unpack(self, c, o):
-        self._size = struct.calcsize(self._packstring)
-        s = c[o:o+self._size]
-        s += data_null*(self._size-len(s))
-        disas = struct.unpack(self._packstring, s)
-        for n,v in zip(self._names,disas):
+        self._size = self._struct.size
+        if hasattr(c, 'unpack_from'):
+            # StrPatchwork
+            disas = c.unpack_from(self._struct, o)
+        elif isinstance(c, bytes_type) and 0 <= o and o+self._size <= len(c):
+            disas = self._struct.unpack_from(c, o)
+        else:
+            s = c[o:o+self._size]
+            s += data_null*(self._size-len(s))
+            disas = self._struct.unpack(s)
+        for n,v in zip(self._meta[4],disas):
             setattr(self, n, v)
         # If the last fields are optional data, their types are a class
         for fname, fclass in self._opt:
@@ -233,7 +289,7 @@ class CStruct(CStruct_base):
             self.setf(fname, v)
 
     def _initialize(self):
-        self._size = struct.calcsize(self._packstring)
+        self._size = self._struct.size
         for f in self._names:
             # Default values
             if self._format[f].endswith('s'): self.setf(f,data_empty)
@@ -253,8 +309,8 @@ class CStruct(CStruct_base):
             self._size += self._size_align(v)
 
     def pack(self):
-        fields = [getattr(self, x) for x in self._names]
-        s = struct.pack(self._packstring, *fields)
+        fields = [getattr(self, x) for x in self._meta[4]]
+        s = self._struct.pack(*fields)
         for fname, fclass in self._opt:
             s += self._pack_align(self.getf(fname))
         if self.bytelen != len(s):
@@ -283,6 +339,7 @@ class CStruct(CStruct_base):
 class CStructWithStrTable(CStruct):
     # The attribute 'name' is computed from an integer index 'name_idx'
     # and a link to the string table 'strtab'
+    __slots__ = ()
     def get_name(self):
         return self.strtab.get_name(self.name_idx)
     def set_name(self, name):
@@ -296,6 +353,61 @@ class CStructWithStrTable(CStruct):
         if 'name' in kargs and 'name_idx' in self._names:
             self.name = kargs['name']
 
+# String tables are sequences of null-terminated names. The index of a
+# string table is a dict that maps each name to its offset. A name can
+# also be found at the offset of any name it is a suffix of (tail
+# merging, as done by linkers); this is used only among the names that
+# are added at once, because indexing all the suffixes of a large table
+# is too costly.
+def strtab_index(data, start=0):
+    # Strings beginning before offset 'start' are not indexed
+    index = {}
+    pos = 0
+    for s in data.split(data_null)[:-1]:
+        if pos >= start and not s in index:
+            index[s] = pos
+        pos += len(s)+1
+    return index
+
+def strtab_append(index, names, offset, find=None):
+    # Adds 'names' to a string table whose end is at 'offset'; 'index'
+    # is updated. As in ld, new names are sorted by reversed bytes, in
+    # decreasing order: a name that is a suffix of another one comes
+    # just after it, and is not appended.
+    # If 'find' is given, it returns the offset of a name that is
+    # already in the table, e.g. as the suffix of a longer name, or -1.
+    # Returns the list of appended names and the offsets of all names.
+    res = []
+    for name in names:
+        if not isinstance(name, bytes_type):
+            name = name_to_bytes(name)
+        res.append(name)
+    names = res
+    order = {}
+    for name in names:
+        if name in index:
+            continue
+        if find is not None:
+            pos = find(name + data_null)
+            if pos != -1:
+                index[name] = pos
+                continue
+        order[name] = name[::-1]
+    order = [ (rev, name) for name, rev in order.items() ]
+    order.sort()
+    order.reverse()
+    added = []
+    prev = None
+    for _, name in order:
+        if prev is not None and prev.endswith(name):
+            index[name] = index[prev] + len(prev) - len(name)
+        else:
+            index[name] = offset
+            added.append(name)
+            offset += len(name)+1
+        prev = name
+    return added, [ index[_] for _ in names ]
+
 class CArray_metaclass(type):
     """
     metaclass, with a syntax compatible with python2 and python3
@@ -320,7 +432,7 @@ class CArray(CArray_base):
 
     How to use a CArray object:
       in addition to the CBase interface,
-      [item] gives access to an element of the array
+      [item] gives access to an element of the array, and replaces it
       len gives the number of elements
       append adds an element to the array
       _array is the whole array
@@ -380,9 +492,16 @@ class CArray(CArray_base):
     def __len__(self):
         return len(self._array)
 
+    def __setitem__(self, item, obj):
+        self._size -= self._size_align(self._array[item])
+        self._array[item] = obj
+        self._size += self._size_align(obj)
+        self.modified()
+
     def append(self, obj):
         self._array.append(obj)
         self._size += self._size_align(self._array[-1])
+        self.modified()
         return obj
 
     def pprint(self):
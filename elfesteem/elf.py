@@ -28,6 +28,17 @@ class Ehdr(CStruct):
                 ("shnum","u16"),
                 ("shstrndx","u16") ]
 
+def reset_index(hdr, index):
+    # The ELF object containing the section or segment of header 'hdr'
+    # may have an index (of virtual addresses, of names) that is now
+    # invalid
+    try:
+        e = hdr.parent.parent.parent
+    except AttributeError:
+        return
+    if getattr(e, index, None) is not None:
+        setattr(e, index, None)
+
 class Shdr(CStructWithStrTable):
     _fields = [ ("name_idx","u32"),
                 ("type","u32"),
@@ -96,8 +107,22 @@ class Shdr(CStructWithStrTable):
     type_txt = property(type_txt)
     def readelf_display(self):
         return self.format % self
-
-class Phdr32(CStruct):
+    def setf(self, fname, v):
+        CStructWithStrTable.setf(self, fname, v)
+        if fname in ('addr', 'size'):
+            reset_index(self, '_vad_index')
+        elif fname == 'name_idx':
+            reset_index(self, '_name_index')
+        elif fname in ('link', 'type'):
+            reset_index(self, '_link_index')
+
+class PhdrBase(CStruct):
+    def setf(self, fname, v):
+        CStruct.setf(self, fname, v)
+        if fname in ('vaddr', 'memsz'):
+            reset_index(self, '_vad_index')
+
+class Phdr32(PhdrBase):
     _fields = [ ("type","u32"),
                 ("offset","u32"),
                 ("vaddr","u32"),
@@ -107,7 +132,7 @@ class Phdr32(CStruct):
                 ("flags","u32"),
                 ("align","u32") ]
 
-class Phdr64(CStruct):
+class Phdr64(PhdrBase):
     _fields = [ ("type","u32"),
                 ("flags","u32"),
                 ("offset","ptr"),
@@ -118,6 +143,7 @@ class Phdr64(CStruct):
                 ("align","ptr") ]
 
 class Sym32(CStructWithStrTable):
+    __slots__ = ()
     _fields = [ ("name_idx","u32"),
                 ("value","u32"),
                 ("size","u32"),
@@ -133,6 +159,8 @@ class Sym32(CStructWithStrTable):
                           '<unknown>: %d'%(_.info>>4)))
     visibility = property(lambda _: constants['STV'].get(_.other,
                           'DEFAULT [<other>: %x] '%_.other))
+    # Columns derived from fields: (field, shift, mask)
+    _derived = { 'type': ('info', 0, 0xf), 'bind': ('info', 4, 0xf) }
     def ndx(self):
         if   self.shndx==SHN_UNDEF:  return "UND"
         elif self.shndx==SHN_ABS:    return "ABS"
@@ -145,6 +173,7 @@ class Sym32(CStructWithStrTable):
         return self.readelf_display()
 
 class Sym64(Sym32):
+    __slots__ = ()
     _fields = [ ("name_idx","u32"),
                 ("info","u08"),
                 ("other","u08"),
@@ -158,6 +187,7 @@ class Dym(CStruct):
                 ("val","u32") ]
 
 class RelBase(CStruct):
+    __slots__ = ()
     def symbol(self):
         if not hasattr(self.parent.linksection, 'symtab') \
                 or self.sym_idx >= len(self.parent.linksection.symtab):
@@ -184,16 +214,21 @@ class RelBase(CStruct):
         machine = constants['EM'][self.parent.parent.parent.Ehdr.machine]
         if machine == 'SPARC32PLUS': machine = 'SPARC'
         if machine == 'SPARCV9':     machine = 'SPARC'
-        if not machine in constants['R']:
-            ret = '%d aka. %#x' % (self.type, self.type)
-        elif hasattr(self, 'type1'): # MIPS64
-            ret = 'R_%s_%s' % (machine, constants['R'][machine][self.type1])
+        if hasattr(self, 'type1'): # MIPS64
+            ret = self.type_name(machine, self.type1)
         else:
-            ret = 'R_%s_%s' % (machine, constants['R'][machine][self.type])
+            ret = self.type_name(machine, self.type)
         ret = ret[:17] # truncated by readelf!
         if ret == 'R_386_JMP_SLOT': ret = 'R_386_JUMP_SLOT' 
         return ret
     type17 = property(type17)
+    def type_name(self, machine, type):
+        # Types that are not in the table of the machine, if any, are
+        # displayed as numbers
+        name = constants['R'].get(machine, {}).get(type)
+        if name is None:
+            return '%d aka. %#x' % (type, type)
+        return 'R_%s_%s' % (machine, name)
     def readelf_display(self):
         res = self.format % self
         if self.__class__.__name__ == 'Rel32':
@@ -210,13 +245,14 @@ class RelBase(CStruct):
             else:               res += " + %x" %  self.addend
         if hasattr(self, 'type1'):
             machine = constants['EM'][self.parent.parent.parent.Ehdr.machine]
-            type = 'R_%s_%s' % (machine, constants['R'][machine][self.type2])
+            type = self.type_name(machine, self.type2)
             res += "\n                    Type2: %-16s" % type
-            type = 'R_%s_%s' % (machine, constants['R'][machine][self.type3])
+            type = self.type_name(machine, self.type3)
             res += "\n                    Type3: %-16s" % type
         return res
 
 class Rel32(RelBase):
+    __slots__ = ()
     # sym_idx is 24-bit long, cannot be defined as a field type
     # we get it by parsing 'info'
     _fields = [ ("offset","ptr"),
@@ -225,16 +261,20 @@ class Rel32(RelBase):
     format = '%(offset)08x  %(info)08x %(type17)-17s'
     type = property(lambda _: _.info & 0xff)
     sym_idx = property(lambda _:_.info>>8)
+    _derived = { 'type': ('info', 0, 0xff), 'sym_idx': ('info', 8, 0xffffff) }
 
 class Rel64(RelBase):
+    __slots__ = ()
     _fields = [ ("offset","ptr"),
                 ("info","u64") ]
     format = '%(offset)012x  %(info)012x %(type17)-17s %(value)016x %(name)s'
     format = '%(offset)012x  %(info)012x %(type17)-17s'
     type = property(lambda _: _.info & mask32)
     sym_idx = property(lambda _:_.info>>32)
+    _derived = { 'type': ('info', 0, mask32), 'sym_idx': ('info', 32, mask32) }
 
 class Rel64MIPS(RelBase):
+    __slots__ = ()
     # e.g. http://www.openwall.com/lists/musl/2016/01/22/2
     _fields = [ ("offset","ptr"),
                 ("sym_idx","u32"),
@@ -246,18 +286,24 @@ class Rel64MIPS(RelBase):
         raise ValueError("MIPS64 relocation type is a combination of 3 relocation types each of size 1 byte")
     type = property(type)
     info = property(lambda _:_.type1 + (_.type2<<8) + (_.type3<<16) + (_.ssym<<24) + (_.sym_idx<<32))
+    # The column 'type' is the first relocation type, as in type17;
+    # 'sym_idx' is a field.
+    _derived = { 'type': ('type1', 0, 0xff) }
 
 class Rela32(Rel32):
+    __slots__ = ()
     _fields = [ ("offset","ptr"),
                 ("info","u32"),
                 ("addend","s32") ]
 
 class Rela64(Rel64):
+    __slots__ = ()
     _fields = [ ("offset","ptr"),
                 ("info","u64"),
                 ("addend","s64") ]
 
 class Dyn32(CStruct):
+    __slots__ = ()
     _fields = [ ("type","u32"),
                 ("name_idx","u32") ]
     def name(self):
@@ -267,6 +313,7 @@ class Dyn32(CStruct):
     name = property(name)
 
 class Dyn64(Dyn32):
+    __slots__ = ()
     _fields = [ ("type","u64"),
                 ("name_idx","u64") ]
 
@@ -1831,6 +1878,8 @@ R_ARM_GOTOFF            = 24,      # 32 bit offset to GOT
 R_ARM_GOTPC             = 25,      # 32 bit PC relative offset to GOT
 R_ARM_GOT32             = 26,      # 32 bit GOT entry
 R_ARM_PLT32             = 27,      # 32 bit PLT address
+R_ARM_CALL              = 28,      # PC relative 24 bit (BL, BLX)
+R_ARM_JUMP24            = 29,      # PC relative 24 bit (B, BL<cond>)
 R_ARM_ALU_PCREL_7_0     = 32,
 R_ARM_ALU_PCREL_15_8    = 33,
 R_ARM_ALU_PCREL_23_15   = 34,
@@ -2231,6 +2280,36 @@ R_V800_GPWHI1           = 0x3c,    # V810
 R_V800_HWLO             = 0x3d,    # V850
 )
 
+SetConstants(
+# AArch64 relocations (subset)
+R_AARCH64_NONE               = 0,    # No relocation
+R_AARCH64_ABS64              = 257,  # Direct 64 bit
+R_AARCH64_ABS32              = 258,  # Direct 32 bit
+R_AARCH64_ABS16              = 259,  # Direct 16 bit
+R_AARCH64_PREL64             = 260,  # PC relative 64 bit
+R_AARCH64_PREL32             = 261,  # PC relative 32 bit
+R_AARCH64_PREL16             = 262,  # PC relative 16 bit
+R_AARCH64_ADR_PREL_PG_HI21   = 275,  # Page relative ADRP
+R_AARCH64_ADR_PREL_PG_HI21_NC= 276,
+R_AARCH64_ADD_ABS_LO12_NC    = 277,  # Low 12 bits for ADD
+R_AARCH64_LDST8_ABS_LO12_NC  = 278,  # Low 12 bits for 8 bit LD/ST
+R_AARCH64_JUMP26             = 282,  # PC relative 28 bit (B)
+R_AARCH64_CALL26             = 283,  # PC relative 28 bit (BL)
+R_AARCH64_LDST16_ABS_LO12_NC = 284,  # Low 12 bits for 16 bit LD/ST
+R_AARCH64_LDST32_ABS_LO12_NC = 285,  # Low 12 bits for 32 bit LD/ST
+R_AARCH64_LDST64_ABS_LO12_NC = 286,  # Low 12 bits for 64 bit LD/ST
+R_AARCH64_LDST128_ABS_LO12_NC= 299,  # Low 12 bits for 128 bit LD/ST
+R_AARCH64_COPY               = 1024, # Copy symbol at runtime
+R_AARCH64_GLOB_DAT           = 1025, # Create GOT entry
+R_AARCH64_JUMP_SLOT          = 1026, # Create PLT entry
+R_AARCH64_RELATIVE           = 1027, # Adjust by program base
+R_AARCH64_TLS_DTPMOD64       = 1028,
+R_AARCH64_TLS_DTPREL64       = 1029,
+R_AARCH64_TLS_TPREL64        = 1030,
+R_AARCH64_TLSDESC            = 1031,
+R_AARCH64_IRELATIVE          = 1032,
+)
+
 constants['R'] = {}
 for k in constants:
     if k.startswith('R_'):
@@ -2,9 +2,13 @@
 
 import struct
 import logging
+from bisect import bisect_left, bisect_right
 
 from elfesteem import elf
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.strpatchwork import StrPatchwork, pack_regions
+from elfesteem.columns import Columns, pack_columns
+from elfesteem import intervals
+from elfesteem.patterns import search_regions
 
 log = logging.getLogger("elfparse")
 console_handler = logging.StreamHandler()
@@ -12,6 +16,10 @@ console_handler.setFormatter(logging.Formatter("%(levelname)-5s: %(message)s"))
 log.addHandler(console_handler)
 log.setLevel(logging.WARN)
 
+import sys
+if sys.version_info[0:2] == (2, 3):
+    from elfesteem.compatibility_python23 import sorted
+
 
 
 def align_to(value, alignment):
@@ -206,9 +214,36 @@ wsize = parent.wsize)
             # don't change for unmaped sections
             self.sh.addr += diff
 
+    def check_header(self):
+        # Validation of the section header, done when the file is read,
+        # even if the section is never parsed
+        pass
     def parse_content(self):
         pass
+    def get_columns(self, cls, stride, use_numpy):
+        # Columnar view of a section made of records of type 'cls';
+        # it is kept while the content is the same object and has not
+        # been written since, e.g. by __setitem__ or by a direct write
+        # to the content.
+        if not hasattr(self, '_columns'):
+            self._columns = {}
+        content = self.content
+        version = (content, getattr(content, 'version', None))
+        key = (use_numpy, cls, stride)
+        cached = self._columns.get(key)
+        if cached is None or cached[0][0] is not content \
+                or cached[0][1] != version[1]:
+            cached = (version, Columns(cls, self, content,
+                stride=stride, use_numpy=use_numpy))
+            self._columns[key] = cached
+        return cached[1]
     def pack(self):
+        lazy = self.__dict__.get('_lazy')
+        if lazy is not None and lazy[0] is not None \
+                and not 'content' in self.__dict__:
+            # Not loaded: read from the file, without keeping a copy
+            data, start, stop = lazy[0]
+            return data[start:stop]
         data = self.content
         if type(data) != str: data = data.pack()
         return data
@@ -245,6 +280,56 @@ wsize = parent.wsize)
             sh = elf.Shdr(parent=self, type=self.sht, name_idx=0, **kargs)
         self.sh=sh
         self.content=StrPatchwork()
+    def __getattr__(self, name):
+        # Sections read from a file are parsed at the first access to
+        # their content or to an attribute set by parse_content()
+        if name.startswith('__') or self.__dict__.get('_lazy') is None:
+            raise AttributeError("'%s' object has no attribute '%s'"
+                                 % (self.__class__.__name__, name))
+        if name == 'content':
+            self.load_content()
+        else:
+            self.load()
+        return getattr(self, name)
+    def __dir__(self):
+        self.load()
+        names = {}
+        for name in dir(self.__class__): names[name] = True
+        for name in self.__dict__: names[name] = True
+        return sorted(names.keys())
+    def set_lazy(self, source):
+        # 'source' is the content of the file, or None if the content
+        # of the section is not in the file
+        if source is not None:
+            del self.content
+            source = (source, self.sh.offset, self.sh.offset+self.sh.size)
+        self._lazy = (source,)
+    def load_content(self):
+        # Extracts the content, without parsing it
+        lazy = self.__dict__.get('_lazy')
+        if lazy is None or lazy[0] is None:
+            return
+        if 'content' in self.__dict__:
+            # The content has been set before being read from the file
+            self._lazy = (None,)
+            return
+        data, start, stop = lazy[0]
+        self.content = StrPatchwork(data[start:stop])
+        self._lazy = (None,)
+    def load(self):
+        if self.__dict__.get('_lazy') is None:
+            return
+        self.load_content()
+        del self._lazy
+        # The linked sections are parsed first, if needed. A dependency
+        # loop cannot recurse forever, because '_lazy' has been removed.
+        if self.parse_linked_first:
+            for s in (self.linksection, self.infosection):
+                if isinstance(s, Section):
+                    s.load()
+        self.parse_content()
+    # False if parse_content() does not use the linked sections
+    parse_linked_first = True
     def __repr__(self):
         return "%(name)-15s %(offset)08x %(size)06x %(addr)08x %(flags)x" % self.sh
     def recalc(self):
@@ -262,8 +347,88 @@ class NullSection(Section):
 class ProgBits(Section):
     sht = elf.SHT_PROGBITS
 
+def unpack_array(c, sex, fmt, offset, count):
+    # At most 'count' values of type 'fmt', truncated at the end of 'c'
+    sz = struct.calcsize(fmt)
+    count = max(0, min(count, (len(c)-offset)//sz))
+    return list(struct.unpack(sex+"%d%s"%(count,fmt), c[offset:offset+count*sz]))
+
+def elf_hash(name):
+    # Hash function of SHT_HASH sections, cf. System V ABI
+    h = 0
+    for c in struct.unpack("%dB"%len(name), name):
+        h = (h << 4) + c
+        g = h & 0xf0000000
+        if g:
+            h ^= g >> 24
+        h &= ~g
+    return h
+
+def gnu_hash(name):
+    # Hash function of SHT_GNU_HASH sections, cf. dl_new_hash in glibc
+    h = 5381
+    for c in struct.unpack("%dB"%len(name), name):
+        h = (h*33 + c) & 0xffffffff
+    return h
+
 class HashSection(Section):
     sht = elf.SHT_HASH
+    parse_linked_first = False
+    def parse_content(self):
+        c = self.content
+        self.nbucket, self.nchain = (unpack_array(c, self.sex, "I", 0, 2)+[0,0])[:2]
+        self.buckets = unpack_array(c, self.sex, "I", 8, self.nbucket)
+        self.chains = unpack_array(c, self.sex, "I", 8+4*self.nbucket,
+                                   self.nchain)
+    def candidates(self, name):
+        # Indexes in the symbol table of symbols that may be named 'name',
+        # in the order used by ld.so
+        if not self.buckets:
+            return
+        idx = self.buckets[elf_hash(name_to_bytes(name)) % len(self.buckets)]
+        seen = {}
+        while idx != 0 and idx < len(self.chains) and not idx in seen:
+            seen[idx] = True
+            yield idx
+            idx = self.chains[idx]
+
+class GNUHashSection(Section):
+    sht = elf.SHT_GNU_HASH
+    parse_linked_first = False
+    def parse_content(self):
+        c = self.content
+        header = unpack_array(c, self.sex, "I", 0, 4)
+        if len(header) < 4:
+            header = [0, 0, 0, 0]
+        self.nbucket, self.symoffset, self.bloom_size, self.bloom_shift = header
+        word = {32: "I", 64: "Q"}[self.wsize]
+        self.bloom = unpack_array(c, self.sex, word, 16, self.bloom_size)
+        of = 16 + self.wsize//8 * self.bloom_size
+        self.buckets = unpack_array(c, self.sex, "I", of, self.nbucket)
+        of += 4 * self.nbucket
+        self.chains = unpack_array(c, self.sex, "I", of, (len(c)-of)//4)
+    def candidates(self, name):
+        # Indexes in the symbol table of symbols that may be named 'name',
+        # in the order used by ld.so; the bloom filter and the hash values
+        # in the chains avoid looking at most other symbols
+        if not self.buckets or not self.bloom:
+            return
+        h1 = gnu_hash(name_to_bytes(name))
+        bits = self.wsize
+        word = self.bloom[(h1 // bits) % len(self.bloom)]
+        mask = (1 << (h1 % bits)) | (1 << ((h1 >> self.bloom_shift) % bits))
+        if word & mask != mask:
+            return
+        idx = self.buckets[h1 % len(self.buckets)]
+        if idx < self.symoffset:
+            return
+        while 0 <= idx - self.symoffset < len(self.chains):
+            h2 = self.chains[idx - self.symoffset]
+            if h1 | 1 == h2 | 1:
+                yield idx
+            if h2 & 1:
+                break
+            idx += 1
 
 class NoBitsSection(Section):
     sht = elf.SHT_NOBITS
@@ -438,6 +603,15 @@ class Dynamic(Section):
             self.dyntab.append(dyn)
             if type(dyn.name) is str:
                 self.dynamic[dyn.name] = dyn
+    def columns(self, use_numpy=True):
+        sz = self.sh.entsize
+        if sz == 0:
+            sz = self.wsize // 4
+        Dyn = { 32: elf.Dyn32, 64: elf.Dyn64 }[self.wsize]
+        return self.get_columns(Dyn, sz, use_numpy)
+    def select(self, **conditions):
+        # e.g. select(type=elf.DT_NEEDED)
+        return [ self.dyntab[_] for _ in self.columns().select(**conditions) ]
     def __getitem__(self,item):
         if type(item) is str:
             return self.dynamic[item]
@@ -509,6 +683,7 @@ class Dynamic(Section):
                 ph.ph.paddr = ph.ph.vaddr = self.sh.addr
 
 from elfesteem.cstruct import data_null, bytes_to_name, name_to_bytes
+from elfesteem.cstruct import strtab_index, strtab_append
 
 class StrTable(Section):
     sht = elf.SHT_STRTAB
@@ -517,25 +692,40 @@ class StrTable(Section):
         n = self.content[idx:self.content.find(data_null, idx)]
         return bytes_to_name(n)
 
+    _index = None
+    def name_index(self):
+        # Offset of each name; it is rebuilt when the length of the
+        # content has changed
+        if self._index is None or self._index[0] != len(self.content):
+            index = strtab_index(self.content[0:len(self.content)])
+            self._index = (len(self.content), index)
+        return self._index[1]
+
     def find_name(self, name):
+        # A name that is not in the index may be the suffix of a name
         name = name_to_bytes(name)
-        if name + data_null in self.content:
-            return self.content.find(name+data_null)
-        
-        return None
+        idx = self.name_index().get(name)
+        if idx is None and name + data_null in self.content:
+            idx = self.content.find(name + data_null)
+        return idx
 
     def add_name(self, name):
-        name = name_to_bytes(name)
-        if name + data_null in self.content:
-            return self.content.find(name)
-        
+        return self.add_names([name])[0]
+
+    def add_names(self, names):
+        # Names that are not yet in the table are appended, with only
+        # one resize of the section; returns the offsets of all names
         # TODO: check for unused space and reuse, aka 2 or more NULL bytes
+        index = self.name_index()
         idx = len(self.content)
-
-        self.resize(0, len(name))
-        self.content[idx] = name+data_null
-
-        return idx
+        added, res = strtab_append(index, names, idx,
+                                   self.content.find)
+        if added:
+            data = data_null.join(added) + data_null
+            self.resize(0, len(data))
+            self.content[idx] = data
+            self._index = (len(self.content), index)
+        return res
 
     def mod_name(self, idx, name):
         name = name_to_bytes(name)
@@ -556,17 +746,24 @@ class StrTable(Section):
 
 class SymTable(Section):
     sht = elf.SHT_SYMTAB
-    def __init__(self, *args, **kargs):
-        Section.__init__(self, *args, **kargs)
+    def __init__(self, parent, sh=None, **kargs):
+        Section.__init__(self, parent, sh, **kargs)
+        if sh is None:
+            # New section; sections read from a file get these
+            # attributes from parse_content()
+            self.symtab=[]
+            self.symbols={}
+    def check_header(self):
+        sz = { 32: elf.Sym32, 64: elf.Sym64 }[self.wsize](self).bytelen
+        if sz != self.sh.entsize:
+            log.error("SymTable has invalid entsize %d instead of %d",
+                self.sh.entsize, sz)
+    def parse_content(self):
         self.symtab=[]
         self.symbols={}
-    def parse_content(self):
         Sym = { 32: elf.Sym32, 64: elf.Sym64 }[self.wsize]
         c = self.content
         sz = Sym(self).bytelen
-        if sz != self.sh.entsize:
-            log.error("SymTable has invalid entsize %d instead of %d",
-                self.sh.entsize, sz)
         idx = 0
         while len(c) > sz*idx:
             s = c[sz*idx:sz*(idx+1)]
@@ -574,6 +771,30 @@ class SymTable(Section):
             sym = Sym(parent=self, content=s)
             self.symtab.append(sym)
             self.symbols[sym.name] = sym
+    def columns(self, use_numpy=True):
+        Sym = { 32: elf.Sym32, 64: elf.Sym64 }[self.wsize]
+        sz = self.sh.entsize
+        if sz == 0:
+            sz = None
+        return self.get_columns(Sym, sz, use_numpy)
+    def is_match(self, sym, name):
+        # Same conditions as ld.so, except versioning: the symbol is
+        # defined, is not local, and is not a section or a file
+        return ( sym.name == name
+             and sym.shndx != elf.SHN_UNDEF
+             and sym.info>>4 != elf.STB_LOCAL
+             and (sym.value != 0 or sym.info&0xf == elf.STT_TLS)
+             and not sym.info&0xf in (elf.STT_SECTION, elf.STT_FILE) )
+    def lookup(self, name):
+        # The symbol found by ld.so for 'name', or None; it is not
+        # always symbols[name], which is the last symbol with this name
+        for sym in self.symtab:
+            if self.is_match(sym, name):
+                return sym
+        return None
+    def select(self, **conditions):
+        # e.g. select(type=elf.STT_FUNC, value=(start, stop))
+        return [ self.symtab[_] for _ in self.columns().select(**conditions) ]
     def __len__(self):
         return len(self.symtab)
     def __getitem__(self,item):
@@ -604,6 +825,32 @@ class SymTable(Section):
 
 class DynSymTable(SymTable):
     sht = elf.SHT_DYNSYM
+    def hash_section(self):
+        # The section .gnu.hash or .hash for this table; as in ld.so,
+        # GNU hash is preferred
+        found = None
+        for s in self.parent.parent.link_index().get(id(self), []):
+            if s.sh.type == elf.SHT_GNU_HASH:
+                return s
+            if s.sh.type == elf.SHT_HASH:
+                found = s
+        return found
+    def get_symbol(self, idx):
+        # Decodes only one symbol, if the table has not been parsed
+        if not '_lazy' in self.__dict__:
+            return self.symtab[idx]
+        Sym = { 32: elf.Sym32, 64: elf.Sym64 }[self.wsize]
+        sz = Sym(self).bytelen
+        return Sym(parent=self, content=self.content[sz*idx:sz*(idx+1)])
+    def lookup(self, name):
+        h = self.hash_section()
+        if h is None:
+            return SymTable.lookup(self, name)
+        for idx in h.candidates(name):
+            sym = self.get_symbol(idx)
+            if self.is_match(sym, name):
+                return sym
+        return None
 
 
 class RelTable(Section):
@@ -631,6 +878,61 @@ class RelTable(Section):
             rel = Rel(parent=self, content=s)
             self.reltab.append(rel)
             self.rel[rel.sym] = rel
+    def columns(self, use_numpy=True):
+        return self.get_columns(self.rel_type(), self.sh.entsize, use_numpy)
+    def select(self, **conditions):
+        # e.g. select(type=elf.R_X86_64_JUMP_SLOT)
+        return [ self.reltab[_] for _ in self.columns().select(**conditions) ]
+
+    def get_reloc(self, idx):
+        # Decodes only one relocation, if the table has not been parsed
+        if not '_lazy' in self.__dict__:
+            return self.reltab[idx]
+        sz = self.sh.entsize
+        return self.rel_type()(parent=self,
+                               content=self.content[sz*idx:sz*(idx+1)])
+    _offset_index = None
+    def offset_index(self):
+        # Offsets patched by the relocations, sorted, and the indexes
+        # of the corresponding relocations; it is computed again when
+        # the columns change.
+        columns = self.columns()
+        if self._offset_index is None or self._offset_index[0] is not columns:
+            col = columns['offset']
+            if hasattr(col, 'tolist'):
+                col = col.tolist()
+            order = [ (col[_], _) for _ in range(len(col)) ]
+            order.sort()
+            self._offset_index = (columns, [ _[0] for _ in order ],
+                                           [ _[1] for _ in order ])
+        return self._offset_index[1:]
+    def relocs_at(self, offset, size=1):
+        # Relocations that patch some byte in [offset:offset+size]; the
+        # relocated field is assumed to be at most one word long.
+        offsets, idx = self.offset_index()
+        i = bisect_right(offsets, offset - self.wsize//8)
+        j = bisect_left(offsets, offset + size)
+        return [ self.get_reloc(_) for _ in idx[i:j] ]
+    def set_relocs(self, relocs, use_numpy=True):
+        # Replaces all relocations. 'relocs' is either a list of tuples
+        # (offset, type, sym_idx[, addend]) or a dict of columns, e.g.
+        # {'offset': [...], 'info': [...]}, as given by columns().
+        # The table is encoded at once, and will be parsed when needed.
+        if not hasattr(relocs, 'keys'):
+            names = ('offset', 'type', 'sym_idx', 'addend')
+            values = {}
+            for name, col in zip(names, zip(*relocs)):
+                values[name] = col
+            relocs = values
+        data = pack_columns(self.rel_type(), self, relocs,
+                            stride=self.sh.entsize, use_numpy=use_numpy)
+        self.content = StrPatchwork(data)
+        if len(data) != self.sh.size:
+            self.resize(self.sh.size, len(data))
+        for name in ('reltab', 'rel'):
+            if name in self.__dict__:
+                del self.__dict__[name]
+        self._lazy = (None,)
 
     def __setitem__(self,item,val):
         if not isinstance(val, elf.RelBase):
@@ -638,7 +940,7 @@ class RelTable(Section):
         if item >= len(self.reltab):
             self.reltab.extend([None for i in range(item+1-len(self.reltab))])
         self.reltab[item] = val
-        self.rel[val.name] = val
+        self.rel[val.sym] = val
         self.content[item * self.sh.entsize] = val.pack()
 
     def readelf_display(self):
@@ -697,35 +999,40 @@ class SHList(object):
 
         if ehdr.shnum == 0: return
 
+        # The content of sections is only extracted and parsed when
+        # needed, from a snapshot of the file that does not copy it.
+        source = StrPatchwork(parent.content)
         for s in self.shlist:
-            if not isinstance(s, NoBitsSection):
-                if s.sh.offset > filesize:
-                    log.error("Offset to section %d after end of file",
-                              self.shlist.index(s))
-                    continue
-                if s.sh.offset+s.sh.size > filesize:
-                    log.error("Offset to end of section %d after end of file",
-                              self.shlist.index(s))
-                    continue
-                s.content = StrPatchwork(parent[s.sh.offset: s.sh.offset+s.sh.size])
-        # Follow dependencies when initializing sections
-        zero = self.shlist[0]
-        todo = self.shlist[1:]
-        done = []
-        while todo:
-            s = todo.pop(0)
-            if ( (s.linksection in done + [zero, NoLinkSection]) and
-                 (s.infosection in done + [zero, None]) ):
-                done.append(s)
-                s.parse_content()
+            s.check_header()
+            if isinstance(s, NoBitsSection):
+                s.set_lazy(None)
+            elif s.sh.offset > filesize:
+                log.error("Offset to section %d after end of file",
+                          self.shlist.index(s))
+                s.set_lazy(None)
+            elif s.sh.offset+s.sh.size > filesize:
+                log.error("Offset to end of section %d after end of file",
+                          self.shlist.index(s))
+                s.set_lazy(None)
             else:
-                todo.append(s)
+                s.set_lazy(source)
+    def load(self):
+        # Parses all sections. Each section loads the sections it depends
+        # on before itself, so this is a depth-first topological sort.
+        for s in self.shlist:
+            s.load()
     def append(self, item):
         self.shlist.append(item)
     def __len__(self):
         return len(self.shlist)
     def __getitem__(self, item):
         return self.shlist[item]
+    def __setitem__(self, item, section):
+        # Replaces a section; the indexes of the ELF are reset
+        self.shlist[item] = section
+        self.parent._vad_index = None
+        self.parent._name_index = None
+        self.parent._link_index = None
     def __repr__(self):
         rep = ["#  section         offset   size   addr     flags"]
         for i,s in enumerate(self.shlist):
@@ -931,6 +1238,10 @@ class PHList(object):
 
     def __getitem__(self, item):
         return self.phlist[item]
+    def __setitem__(self, item, segment):
+        # Replaces a segment; the index of virtual addresses is reset
+        self.phlist[item] = segment
+        self.parent._vad_index = None
 
     def __repr__(self):
         r = ["   offset filesz vaddr    memsz"]
@@ -1000,6 +1311,38 @@ class PHList(object):
         self.parent.Ehdr.shoff += diff
 
 
+class VadIndex(object):
+    # Index of the virtual addresses of sections and segments.
+    # 'bounds' is the sorted list of addresses where a section or segment
+    # starts or ends; all addresses in [bounds[i]:bounds[i+1]] belong to
+    # the same sections sh[i] and segments ph[i], in the order of the file.
+    def __init__(self, e):
+        self.key = (len(e.sh.shlist), len(e.ph.phlist))
+        self.max_addr = 0
+        for s in e.sh.shlist + e.ph.phlist:
+            self.max_addr = max(self.max_addr, s.addr + s.size)
+        sh = [ s for s in e.sh.shlist if s.size ]
+        ph = [ s for s in e.ph.phlist if s.size ]
+        bounds = {}
+        for s in sh + ph:
+            bounds[s.addr] = True
+            bounds[s.addr+s.size] = True
+        self.bounds = sorted(bounds.keys())
+        self.sh = [ [] for _ in self.bounds ]
+        self.ph = [ [] for _ in self.bounds ]
+        for table, items in ((self.sh, sh), (self.ph, ph)):
+            for s in items:
+                i = bisect_left(self.bounds, s.addr)
+                j = bisect_left(self.bounds, s.addr+s.size)
+                for k in range(i, j):
+                    table[k].append(s)
+    def find(self, ad):
+        # Sections and segments that contain the address 'ad'
+        i = bisect_right(self.bounds, ad) - 1
+        if i < 0:
+            return [], []
+        return self.sh[i], self.ph[i]
+
 class virt(object):
     def __init__(self, x):
         self.parent = x
@@ -1085,14 +1428,7 @@ class virt(object):
         # the maximum virtual address is found by retrieving the maximum
         # possible virtual address, either from the program entries, and
         # section entries. if there is no such object, raise an error.
-        l = 0
-        if  self.parent.ph.phlist:
-            for phdr in self.parent.ph.phlist:
-                l = max(l, phdr.ph.vaddr + phdr.ph.memsz)
-        if  self.parent.sh.shlist:
-            for shdr in self.parent.sh.shlist:
-                l = max(l, shdr.sh.addr  + shdr.sh.size)
-        return l
+        return self.parent.vad_index().max_addr
 
     def is_addr_in(self, ad):
         return self.parent.is_in_virt_address(ad)
@@ -1117,6 +1453,37 @@ class virt(object):
             offset = 0
         return -1
 
+    def search(self, patterns, start=0, end=None):
+        # Yields (address, id) for all matches of 'patterns', in one pass
+        # over each segment, see elfesteem.patterns. The segments are
+        # searched in the file, without copy, except where some section
+        # has been loaded and may have been modified.
+        e = self.parent
+        regions = []
+        for p in e.ph.phlist:
+            if p.ph.type != elf.PT_LOAD:
+                continue
+            data = StrPatchwork(e.content.view(p.ph.offset,
+                                               p.ph.offset+p.ph.filesz))
+            for s in p.shlist:
+                if s.sh.type == elf.SHT_NOBITS or not 'content' in s.__dict__:
+                    continue
+                data[s.sh.addr - p.ph.vaddr] = s.content[0:s.sh.size]
+            regions.append((p.ph.vaddr, data))
+        if not regions:
+            # No segment, e.g. object files: the allocated sections
+            for s in e.sh:
+                if isinstance(s, NullSection) \
+                        or not s.sh.flags & elf.SHF_ALLOC \
+                        or s.sh.type == elf.SHT_NOBITS:
+                    continue
+                if 'content' in s.__dict__:
+                    data = s.content[0:s.sh.size]
+                else:
+                    data = e.content.view(s.sh.offset, s.sh.offset+s.sh.size)
+                regions.append((s.sh.addr, data))
+        return search_regions(regions, patterns, start, end)
+
 def elf_default_content(self, **kargs):
     if self.Ehdr.type == elf.ET_REL:
         elf_default_content_reloc(self, **kargs)
@@ -1248,6 +1615,12 @@ class ELF(object):
     sections = property(lambda _:_.sh)
     symbols = property(lambda _:_.getsectionbytype(elf.SHT_SYMTAB))
     dynsyms = property(lambda _:_.getsectionbytype(elf.SHT_DYNSYM))
+    # Reset by changes of addresses or sizes in section or segment headers
+    _vad_index = None
+    # Reset by changes of names of sections
+    _name_index = None
+    # Reset by changes of links or types of sections
+    _link_index = None
 
     def __init__(self, elfstr = None, **kargs):
         self._virt = virt(self)
@@ -1275,6 +1648,10 @@ class ELF(object):
             return
         self.content = StrPatchwork(elfstr)
         self.parse_content()
+        if not kargs.get('check_coherency', True):
+            # e.g. to save time on files with many sections; the check
+            # can be done later by calling check_coherency()
+            return
         try:
             self.check_coherency()
         except ValueError:
@@ -1307,19 +1684,26 @@ class ELF(object):
         return self.content[item]
 
     def build_content(self):
+        return self.build_patchwork().pack()
+    def regions(self):
+        # List of (offset, produce) for the parts of the file; when
+        # they overlap, the last one wins.
         if self.Ehdr.shoff == 0:
             elf_set_offsets(self)
-        c = StrPatchwork()
-        c[0] = self.Ehdr.pack()
-        c[self.Ehdr.phoff] = self.ph.pack()
+        r = [ (0, self.Ehdr.pack),
+              (self.Ehdr.phoff, self.ph.pack) ]
         for s in self.sh:
-            c[s.sh.offset] = s.pack()
-        sh = self.sh.pack()
-        if len(sh):
-            # When 'shoff' is invalid, 'sh' is empty, but the line below
-            # is very slow because strpatchwork extends the file.
-            c[self.Ehdr.shoff] = sh
-        return c.pack()
+            r.append((s.sh.offset, s.pack))
+        if len(self.sh.shlist):
+            # When 'shoff' is invalid, 'sh' is empty, but writing it
+            # would be very slow because strpatchwork extends the file.
+            r.append((self.Ehdr.shoff, self.sh.pack))
+        return r
+    def build_patchwork(self):
+        c = StrPatchwork()
+        for offset, produce in self.regions():
+            c[offset] = produce()
+        return c
 
     def check_coherency(self):
         if self.Ehdr.version != 1:
@@ -1348,33 +1732,61 @@ class ELF(object):
             elif self.sh[self.Ehdr.shstrndx].sh.name != '.shstrtab':
                 raise ValueError("Section of index shstrndx[%d] is of name '%s' instead of '%s'"%(self.Ehdr.shstrndx, self.sh[self.Ehdr.shstrndx].sh.name, '.shstrtab'))
 
-        skipable_section_types = [
-        ]
-
-        for sh1 in self.sh:
-            # the section after BSS can overlap
-
-            for sh2 in self.sh:
-                if sh2.sh.type in skipable_section_types:
-                    continue
-
-                if sh1.sh.type != elf.SHT_NOBITS and sh2.sh.type != elf.SHT_NOBITS and \
-                        (sh1.sh.offset < sh2.sh.offset < sh1.sh.offset + sh1.size or \
-                         sh2.sh.offset < sh1.sh.offset < sh2.sh.offset + sh2.size):
-                    raise ValueError("Section offset overlap for [%r] [%r]" % (sh1, sh2))
-
-                if not sh1.addr or not sh2.addr:
-                    continue
-
-                if sh1.sh.flags & sh2.sh.flags & elf.SHF_ALLOC and \
-                        (sh1.addr < sh2.addr < sh1.addr + sh1.size or \
-                         sh2.addr < sh1.addr < sh2.addr + sh2.size):
-                    raise ValueError("Section address overlap for [%r] [%r]" % (sh1, sh2))
+        # Only the first overlap is reported: the first section that
+        # overlaps another one, with the first section it overlaps.
+        offsets, addresses = self.section_ranges()
+        first = (intervals.first_overlaps(offsets),
+                 intervals.first_overlaps(addresses))
+        for i in range(len(offsets)):
+            j = [ _[i] for _ in first if _[i] is not None ]
+            if not j:
+                continue
+            j = min(j)
+            if intervals.overlap(offsets[i], offsets[j]):
+                kind = 'offset'
+            else:
+                kind = 'address'
+            raise ValueError("Section %s overlap for [%r] [%r]"
+                             % (kind, self.sh[i], self.sh[j]))
+
+    def section_ranges(self):
+        # Ranges of file offsets of sections with content, and ranges of
+        # addresses of allocated sections
+        offsets, addresses = [], []
+        for s in self.sh.shlist:
+            if s.sh.type != elf.SHT_NOBITS:
+                offsets.append((s.sh.offset, s.sh.offset + s.size))
+            else:
+                offsets.append(None)
+            if s.addr and s.sh.flags & elf.SHF_ALLOC:
+                addresses.append((s.addr, s.addr + s.size))
+            else:
+                addresses.append(None)
+        return offsets, addresses
+    def section_overlaps(self):
+        # List of all overlaps, as (kind, section1, section2) where 'kind'
+        # is 'offset' or 'address' and section1 is before section2
+        offsets, addresses = self.section_ranges()
+        res = []
+        for kind, ranges in (('offset', offsets), ('address', addresses)):
+            for i, j in intervals.overlaps(ranges):
+                res.append((kind, self.sh[i], self.sh[j]))
+        return res
 
     def __str__(self):
         raise AttributeError("Use pack() instead of str()")
     def pack(self):
         return self.build_content()
+    def pack_to(self, fileobj):
+        # Same output as pack(), written in offset order to 'fileobj';
+        # the content of each section is produced when it is written.
+        pack_regions(fileobj, self.regions())
+    def write(self, filename):
+        fd = open(filename, 'wb')
+        try:
+            self.pack_to(fd)
+        finally:
+            fd.close()
 
     def getsectionsbytype(self, sectiontype):
         return [s for s in self.sh if s.sh.type == sectiontype]
@@ -1384,7 +1796,30 @@ class ELF(object):
         return s[0]
     def getsectionsbyname(self, name):
         if ',' in name: name = name[:name.index(',')]
-        return [s for s in self.sh if s.sh.name.strip('\x00') == name]
+        return self.name_index().get(name, [])[:]
+    def name_index(self):
+        # Sections with a given name, in the order of the section list;
+        # rebuilt when a section is added or removed, or when the field
+        # name_idx of a header changes (cf. elf.reset_index)
+        idx = self._name_index
+        if idx is None or idx[0] != len(self.sh.shlist):
+            names = {}
+            for s in self.sh.shlist:
+                names.setdefault(s.sh.name.strip('\x00'), []).append(s)
+            idx = self._name_index = (len(self.sh.shlist), names)
+        return idx[1]
+    def link_index(self):
+        # Sections linked to a given section, by id of this section, in
+        # the order of the section list; rebuilt as name_index()
+        idx = self._link_index
+        if idx is None or idx[0] != len(self.sh.shlist):
+            links = {}
+            for s in self.sh.shlist:
+                if 0 < s.sh.link < len(self.sh.shlist):
+                    target = self.sh.shlist[s.sh.link]
+                    links.setdefault(id(target), []).append(s)
+            idx = self._link_index = (len(self.sh.shlist), links)
+        return idx[1]
     def getsectionbyname(self, name):
         s = self.getsectionsbyname(name)
         if len(s) == 0: return None
@@ -1395,8 +1830,7 @@ class ELF(object):
             s = self.getsectionbyname(section)
             if s.sh.addr <= ad < s.sh.addr + s.sh.size:
                 return s
-        sh = [ s for s in self.sh if s.addr <= ad < s.addr+s.size ]
-        ph = [ s for s in self.ph if s.addr <= ad < s.addr+s.size ]
+        sh, ph = self.vad_index().find(ad)
 
         if len(sh) == 1 and len(ph) == 1:
             # Executable returns a section and a PH
@@ -1426,10 +1860,128 @@ class ELF(object):
         return self.Ehdr.type == elf.ET_REL
 
     def is_in_virt_address(self, ad):
+        return len(self.vad_index().find(ad)[0]) > 0
+
+    def relocate(self, base=0, symbols=None, image=None):
+        # Applies the relocations. An object file (ET_REL) is loaded at
+        # the addresses of its sections; other files are loaded at
+        # 'base', which is added to their addresses. Undefined symbols
+        # are resolved with the dict 'symbols' (name -> address).
+        # The patches are written in 'image', addressed by the virtual
+        # addresses after loading, or by default in the file itself.
+        # Returns the number of relocations that have been applied.
+        from elfesteem import relocation
+        types = relocation.elf_relocations.get(self.Ehdr.machine)
+        if types is None:
+            raise ValueError("Cannot apply relocations for %s"
+                             % self.architecture)
+        if symbols is None:
+            symbols = {}
+        is_rel = self.Ehdr.type == elf.ET_REL
+        if is_rel:
+            base = 0
+        patches = relocation.Relocator(self.sex)
+        applied = 0
+        skipped = {}
+        addresses = {}
         for s in self.sh:
-            if s.sh.addr <= ad < s.sh.addr + s.sh.size:
-                return True
-        return False
+            if not isinstance(s, RelTable):
+                continue
+            if is_rel:
+                if not 0 < s.sh.info < len(self.sh.shlist):
+                    continue
+                target = self.sh[s.sh.info]
+                if image is not None and not target.sh.flags & elf.SHF_ALLOC:
+                    continue
+                start = target.addr
+            else:
+                target = self.virt
+                start = 0
+            symtab = s.linksection
+            if not id(symtab) in addresses:
+                addresses[id(symtab)] = self.symbol_addresses(symtab, base,
+                                                              symbols)
+            symaddr = addresses[id(symtab)]
+            c = s.columns()
+            offsets, rtypes, sym_idx = c['offset'], c['type'], c['sym_idx']
+            if s.sh.type == elf.SHT_RELA:
+                addends = c['addend']
+            for i in range(len(c)):
+                t = int(rtypes[i])
+                if types.get(t, 0) is None:
+                    continue
+                S = symaddr(int(sym_idx[i]))
+                # Skipped relocations are counted by unsupported type,
+                # or in the bucket None for undefined symbols
+                if not t in types:
+                    skipped[t] = skipped.get(t, 0) + 1
+                    continue
+                if S is None:
+                    skipped[None] = skipped.get(None, 0) + 1
+                    continue
+                field, formula = types[t]
+                offset = int(offsets[i])
+                P = start + base + offset
+                A = None
+                if s.sh.type == elf.SHT_RELA:
+                    A = int(addends[i])
+                if image is not None:
+                    patches.add(image, P, field, formula, S, A, P, base)
+                elif is_rel:
+                    patches.add(target.content, offset, field, formula,
+                                S, A, P, base)
+                else:
+                    patches.add(target, offset, field, formula, S, A, P, base)
+                applied += 1
+        patches.apply()
+        if None in skipped:
+            log.warning("%d relocations to undefined symbols not applied",
+                        skipped.pop(None))
+        for t in sorted(skipped.keys()):
+            log.warning("%d relocations of type %d not applied",
+                        skipped[t], t)
+        return applied
+
+    def symbol_addresses(self, symtab, base, symbols):
+        # Function giving the address of the symbol of index 'idx' in
+        # 'symtab', or None if this symbol cannot be resolved
+        if not isinstance(symtab, SymTable):
+            return lambda idx: 0
+        c = symtab.columns()
+        is_rel = self.Ehdr.type == elf.ET_REL
+        cache = {0: 0}
+        def symaddr(idx):
+            if idx in cache:
+                return cache[idx]
+            shndx, value = int(c['shndx'][idx]), int(c['value'][idx])
+            if shndx == elf.SHN_UNDEF:
+                name = symtab.linksection.get_name(int(c['name_idx'][idx]))
+                if name in symbols:
+                    res = symbols[name]
+                elif int(c['bind'][idx]) == elf.STB_WEAK:
+                    res = 0
+                else:
+                    res = None
+            elif shndx == elf.SHN_ABS:
+                res = value
+            elif shndx >= elf.SHN_LORESERVE:
+                res = None
+            elif is_rel:
+                res = value + self.sh[shndx].addr
+            else:
+                res = value + base
+            cache[idx] = res
+            return res
+        return symaddr
+
+    def vad_index(self):
+        # Rebuilt when a section or segment is added, when one is replaced
+        # with e.sh[i] = ... or e.ph[i] = ..., or when the address or size
+        # in a header changes (cf. elf.reset_index)
+        idx = self._vad_index
+        if idx is None or idx.key != (len(self.sh.shlist), len(self.ph.phlist)):
+            idx = self._vad_index = VadIndex(self)
+        return idx
 
 if __name__ == "__main__":
     import readline
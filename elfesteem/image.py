@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+# Flat memory image of a binary container (ELF, PE, Mach-O, RPRC).
+# The 'virt' objects of the containers find the sections that contain
+# the addresses at each access, and concatenate the slices of sections.
+# A LoadedImage maps the container once: each mapped region is a single
+# buffer covering whole pages, and reads and writes at virtual addresses
+# are slices of this buffer.
+
+from array import array
+from bisect import bisect_right
+from elfesteem.strpatchwork import data_null, data_empty, to_bytes
+from elfesteem.patterns import search_regions
+
+# Protections of the pages, with the values of mmap and Mach-O
+PROT_NONE  = 0
+PROT_READ  = 1
+PROT_WRITE = 2
+PROT_EXEC  = 4
+
+class LoadedImage(object):
+    """
+    Sparse memory image, made of regions aligned to 'page_size'.
+    Each region has a buffer (an array of bytes) and the protection of
+    each of its pages. Adjacent or overlapping regions are merged; the
+    protection of a page shared by two mappings is the union of both.
+
+    How to use a LoadedImage object:
+      LoadedImage(e, base): maps the container 'e', see load()
+      map(addr, size, data, prot): maps 'size' bytes at 'addr', that
+        contain 'data' followed by zeroes
+      image[addr] and image[start:stop]: read bytes; an IndexError is
+        raised if they are not all mapped
+      image[addr] = data and image[start:stop] = data: write bytes
+      prot(addr), protect(addr, size, prot): protection of the pages
+      search(patterns, start, end): yields (address, id) for matches
+        of patterns, see elfesteem.patterns
+      regions(): list of (start, stop) of mapped regions
+    The protections are not enforced, e.g. relocations can be applied
+    with e.relocate(image=...) to read-only pages.
+    """
+    def __init__(self, e=None, base=None, page_size=0x1000):
+        self.page_size = page_size
+        self._start = []
+        self._data = []
+        self._prot = []
+        if e is not None:
+            self.load(e, base)
+
+    def _align(self, addr, size):
+        start = addr - addr % self.page_size
+        stop = addr + size + (-(addr + size)) % self.page_size
+        return start, stop
+
+    def map(self, addr, size, data=None, prot=PROT_READ):
+        if data is None:
+            data = data_empty
+        if len(data) > size:
+            size = len(data)
+        if size == 0:
+            return
+        start, stop = self._align(addr, size)
+        # Regions that overlap or touch [start, stop) are merged
+        i = bisect_right(self._start, start) - 1
+        if i < 0 or self._start[i] + len(self._data[i]) < start:
+            i += 1
+        j = i
+        while j < len(self._start) and self._start[j] <= stop:
+            j += 1
+        if i < j:
+            stop = max(stop, self._start[j-1] + len(self._data[j-1]))
+        if i < j and self._start[i] <= start:
+            # The first region is extended in place, e.g. when adjacent
+            # sections are mapped in increasing order
+            start = self._start[i]
+            buf, prots = self._data[i], self._prot[i]
+            merged = range(i+1, j)
+        else:
+            buf, prots = array('B'), array('B')
+            merged = range(i, j)
+        buf.extend(array('B', data_null) * (stop - start - len(buf)))
+        prots.extend(array('B', [PROT_NONE])
+                     * ((stop - start) // self.page_size - len(prots)))
+        for k in merged:
+            off = self._start[k] - start
+            buf[off:off+len(self._data[k])] = self._data[k]
+            off //= self.page_size
+            prots[off:off+len(self._prot[k])] = self._prot[k]
+        first = (addr - start) // self.page_size
+        last = (addr + size - 1 - start) // self.page_size
+        for k in range(first, last+1):
+            prots[k] |= prot
+        if len(data):
+            buf[addr-start:addr-start+len(data)] = array('B', data)
+        self._start[i:j] = [start]
+        self._data[i:j] = [buf]
+        self._prot[i:j] = [prots]
+
+    def _region(self, addr, size):
+        # Index of the region containing [addr, addr+size)
+        i = bisect_right(self._start, addr) - 1
+        if i < 0 or addr + size > self._start[i] + len(self._data[i]):
+            raise IndexError("Address %#x not mapped" % addr)
+        return i
+
+    def __getitem__(self, item):
+        if type(item) is slice:
+            assert item.step is None
+            start, stop = item.start, item.stop
+        else:
+            start, stop = item, item+1
+        if stop <= start:
+            return data_empty
+        i = self._region(start, stop - start)
+        off = start - self._start[i]
+        return to_bytes(self._data[i][off:off+stop-start])
+    def __setitem__(self, item, data):
+        # If 'item' is an integer, we write starting from this address
+        if type(item) is slice:
+            assert item.step is None
+            start = item.start
+            if item.stop - start != len(data):
+                raise ValueError("Cannot change the size of a LoadedImage")
+        else:
+            start = item
+        if not len(data):
+            return
+        i = self._region(start, len(data))
+        off = start - self._start[i]
+        self._data[i][off:off+len(data)] = array('B', data)
+
+    def prot(self, addr):
+        i = self._region(addr, 1)
+        return self._prot[i][(addr - self._start[i]) // self.page_size]
+    def protect(self, addr, size, prot):
+        i = self._region(addr, size)
+        first = (addr - self._start[i]) // self.page_size
+        last = (addr + size - 1 - self._start[i]) // self.page_size
+        for k in range(first, last+1):
+            self._prot[i][k] = prot
+
+    def search(self, patterns, start=0, end=None):
+        # Yields (address, id) for all matches of 'patterns' in one pass
+        # over each region, see elfesteem.patterns
+        return search_regions(zip(self._start, self._data),
+                              patterns, start, end)
+
+    def regions(self):
+        return [(start, start+len(data))
+                for start, data in zip(self._start, self._data)]
+    def max_addr(self):
+        if not self._start:
+            return 0
+        return self._start[-1] + len(self._data[-1])
+
+    def load(self, e, base=None):
+        # Maps the container 'e'; 'base' has the meaning of the argument
+        # of e.relocate(): for PE it is the image base (ImageBase by
+        # default), for other containers it is added to the addresses.
+        from elfesteem import elf_init, pe_init, rprc
+        from elfesteem.macho import init as macho_init
+        if   isinstance(e, elf_init.ELF):    mapping = elf_mapping
+        elif isinstance(e, pe_init.PE):      mapping = pe_mapping
+        elif isinstance(e, macho_init.MACHO): mapping = macho_mapping
+        elif isinstance(e, rprc.RPRC):       mapping = rprc_mapping
+        else:
+            raise ValueError("Cannot load %r" % e)
+        for addr, size, data, prot in mapping(e, base):
+            self.map(addr, size, data, prot)
+
+# For each container, the list of (addr, size, data, prot) to map.
+# The data comes from the sections that have been loaded, because they
+# may have been modified since the file was parsed, else from the file.
+
+def elf_mapping(e, base):
+    from elfesteem import elf
+    from elfesteem.elf_init import NullSection
+    if base is None:
+        base = 0
+    res = []
+    for p in e.ph.phlist:
+        if p.ph.type != elf.PT_LOAD:
+            continue
+        prot = PROT_NONE
+        if p.ph.flags & elf.PF_R: prot |= PROT_READ
+        if p.ph.flags & elf.PF_W: prot |= PROT_WRITE
+        if p.ph.flags & elf.PF_X: prot |= PROT_EXEC
+        data = array('B', e.content[p.ph.offset:p.ph.offset+p.ph.filesz])
+        for s in p.shlist:
+            if s.sh.type == elf.SHT_NOBITS or not 'content' in s.__dict__:
+                # Sections not loaded have the content of the file
+                continue
+            off = s.sh.addr - p.ph.vaddr
+            c = s.content[0:s.sh.size]
+            data[off:off+len(c)] = array('B', c)
+        res.append((base+p.ph.vaddr, p.ph.memsz, data, prot))
+    if res:
+        return res
+    # No segment, e.g. object files: the allocated sections are mapped
+    for s in e.sh:
+        if isinstance(s, NullSection) or not s.sh.flags & elf.SHF_ALLOC:
+            continue
+        prot = PROT_READ
+        if s.sh.flags & elf.SHF_WRITE:     prot |= PROT_WRITE
+        if s.sh.flags & elf.SHF_EXECINSTR: prot |= PROT_EXEC
+        data = None
+        if s.sh.type == elf.SHT_NOBITS:
+            pass
+        elif 'content' in s.__dict__:
+            data = s.content[0:s.sh.size]
+        else:
+            data = e.content[s.sh.offset:s.sh.offset+s.sh.size]
+        res.append((base+s.sh.addr, s.sh.size, data, prot))
+    return res
+
+def pe_mapping(e, base):
+    from elfesteem import pe
+    res = []
+    if hasattr(e, 'NThdr'):
+        if base is None:
+            base = e.NThdr.ImageBase
+        size = e.NThdr.sizeofheaders
+        res.append((base, size, e.content[0:size], PROT_READ))
+    elif base is None:
+        base = 0
+    for s in e.SHList:
+        prot = PROT_NONE
+        if s.flags & pe.IMAGE_SCN_MEM_READ:    prot |= PROT_READ
+        if s.flags & pe.IMAGE_SCN_MEM_WRITE:   prot |= PROT_WRITE
+        if s.flags & pe.IMAGE_SCN_MEM_EXECUTE: prot |= PROT_EXEC
+        size = max(s.size, s.rawsize)
+        data = None
+        if s.is_in_file():
+            data = s.data[0:min(size, s.rawsize)]
+        res.append((base+s.vaddr, size, data, prot))
+    return res
+
+def macho_mapping(e, base):
+    from elfesteem.macho import loaders
+    if not hasattr(e, 'load'):
+        raise ValueError("Not a unique memory mapping in Mach-O fat")
+    if base is None:
+        base = 0
+    zerofill = (loaders.S_ZEROFILL, loaders.S_THREAD_LOCAL_ZEROFILL,
+                loaders.S_GB_ZEROFILL)
+    res = []
+    for lc in e.load:
+        if not hasattr(lc, 'vmaddr') or lc.initprot == PROT_NONE:
+            # e.g. __PAGEZERO, that only reserves addresses
+            continue
+        data = array('B', e.content[lc.fileoff:lc.fileoff+lc.filesize])
+        for sh in getattr(lc, 'sh', ()):
+            if sh.type in zerofill:
+                continue
+            off = sh.addr - lc.vmaddr
+            c = sh.sect.pack()[:sh.size]
+            data[off:off+len(c)] = array('B', c)
+        res.append((base+lc.vmaddr, lc.vmsize, data,
+                    lc.initprot & (PROT_READ|PROT_WRITE|PROT_EXEC)))
+    return res
+
+def rprc_mapping(e, base):
+    if base is None:
+        base = 0
+    return [(base+s.da, s.len, s.data.pack(), PROT_READ|PROT_WRITE|PROT_EXEC)
+            for s in e.sections]
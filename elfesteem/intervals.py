@@ -1,4 +1,6 @@
 import sys
+from bisect import bisect_left, bisect_right
+import heapq
 if sys.version_info[0] >= 3:
     from functools import reduce
 if sys.version_info[0:2] == (2, 3):
@@ -81,3 +83,93 @@ class Intervals(object):
         self.ranges = new_ranges
         self._merge()
         return self
+
+# Detection of overlapping ranges, e.g. sections in a file.
+# 'ranges' is a list of pairs (start, stop), or None for the elements
+# that should be ignored. Two ranges overlap when one of them starts
+# strictly inside the other.
+
+def overlap(r1, r2):
+    if r1 is None or r2 is None:
+        return False
+    return r1[0] < r2[0] < r1[1] or r2[0] < r1[0] < r2[1]
+
+def overlaps(ranges):
+    '''
+    Sorted list of all pairs of indexes (i, j), i < j, of overlapping
+    ranges. Sort and sweep: ranges are visited by increasing start, and
+    'active' contains the ranges that started before and are not finished.
+    '''
+    order = [ (r[0], r[1], i) for i, r in enumerate(ranges) if r is not None ]
+    order.sort()
+    active = []
+    res = []
+    pos = 0
+    while pos < len(order):
+        start = order[pos][0]
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        end = pos
+        while end < len(order) and order[end][0] == start:
+            for _, i in active:
+                j = order[end][2]
+                res.append((min(i, j), max(i, j)))
+            end += 1
+        for _, stop, j in order[pos:end]:
+            heapq.heappush(active, (stop, j))
+        pos = end
+    res.sort()
+    return res
+
+def first_overlaps(ranges):
+    '''
+    For each range, the smallest index of a range that overlaps it, or
+    None. Computed in O(n log n) even if there are O(n^2) overlapping
+    pairs, e.g. to find quickly the first overlap of a malformed file.
+    '''
+    res = [ None ] * len(ranges)
+    def update(i, j):
+        if j is not None and j != i and (res[i] is None or j < res[i]):
+            res[i] = j
+    order = [ (r[0], r[1], i) for i, r in enumerate(ranges) if r is not None ]
+    order.sort()
+    # Ranges in which range i starts: sweep by increasing start, with
+    # 'by_stop' to remove the finished ranges and 'by_index' to get the
+    # smallest index among the active ranges.
+    by_stop, by_index, finished = [], [], {}
+    pos = 0
+    while pos < len(order):
+        start = order[pos][0]
+        while by_stop and by_stop[0][0] <= start:
+            finished[heapq.heappop(by_stop)[1]] = True
+        while by_index and by_index[0] in finished:
+            heapq.heappop(by_index)
+        end = pos
+        while end < len(order) and order[end][0] == start:
+            if by_index:
+                update(order[end][2], by_index[0])
+            end += 1
+        for _, stop, j in order[pos:end]:
+            heapq.heappush(by_stop, (stop, j))
+            heapq.heappush(by_index, j)
+        pos = end
+    # Ranges starting in range i: they are contiguous in 'order', the
+    # smallest index is found with a sparse table of minimums.
+    starts = [ _[0] for _ in order ]
+    table = [ [ _[2] for _ in order ] ]
+    width = 1
+    while 2*width <= len(order):
+        prev = table[-1]
+        table.append([ min(prev[k], prev[k+width])
+                       for k in range(len(order)-2*width+1) ])
+        width *= 2
+    for start, stop, i in order:
+        lo = bisect_right(starts, start)
+        hi = bisect_left(starts, stop)
+        if lo < hi:
+            level = 0
+            while 2 << level <= hi - lo:
+                level += 1
+            width = 1 << level
+            update(i, min(table[level][lo], table[level][hi-width]))
+    return res
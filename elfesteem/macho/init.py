@@ -1,6 +1,8 @@
 from elfesteem.macho.sections import *
 from elfesteem.macho.loaders import *
+from elfesteem.strpatchwork import pack_regions
 from elfesteem import intervals
+from elfesteem.patterns import search_regions
 import struct
 
 constants = {}
@@ -169,6 +171,32 @@ class virt(object):
             data_slice = data[i]
             s.content[n_item] = data_slice
             off = i.stop
+
+    def search(self, patterns, start=0, end=None):
+        # Yields (address, id) for all matches of 'patterns', in one pass
+        # over each segment, see elfesteem.patterns. The segments are
+        # searched in the file, without copy, except for the sections
+        # that differ from the file.
+        e = self.parent
+        if not hasattr(e, 'load'):
+            raise ValueError("Not a unique memory mapping in Mach-O fat")
+        zerofill = (S_ZEROFILL, S_THREAD_LOCAL_ZEROFILL, S_GB_ZEROFILL)
+        regions = []
+        for lc in e.load:
+            if not hasattr(lc, 'vmaddr') or lc.initprot == VM_PROT_NONE:
+                # e.g. __PAGEZERO, that only reserves addresses
+                continue
+            data = StrPatchwork(e.content.view(lc.fileoff,
+                                               lc.fileoff+lc.filesize))
+            for sh in getattr(lc, 'sh', ()):
+                if sh.type in zerofill:
+                    continue
+                off = sh.addr - lc.vmaddr
+                c = sh.sect.pack()[:sh.size]
+                if data[off:off+len(c)] != c:
+                    data[off] = c
+            regions.append((lc.vmaddr, data))
+        return search_regions(regions, patterns, start, end)
     
     def get_rvaitem(self, item, section = None):
         if item.step != None:
@@ -308,28 +336,40 @@ class MACHO(object):
             log.warning("parse_dynamic_symbols() can only be used with x86 architectures, not %s", self.Mhdr.cputype)
 
     def pack(self):
+        return self.build_patchwork().pack()
+    def regions(self):
+        # List of (offset, produce) for the parts of the file; when
+        # they overlap, the last one wins.
         if hasattr(self,'Mhdr'):
-            c = StrPatchwork()
             mhdr = self.Mhdr.pack()
-            c[0] = mhdr
-            offset = len(mhdr)
-            c[offset] = self.load.pack()
+            r = [ (0, lambda: mhdr),
+                  (len(mhdr), self.load.pack) ]
             for s in self.sect:
-                c[s.offset] = s.pack()
-            for offset, data in self.rawdata:
-                c[offset] = data
-            return c.pack()
+                r.append((s.offset, s.pack))
         elif hasattr(self,'Fhdr'):
-            c = StrPatchwork()
             fhdr = self.Fhdr.pack()
-            c[0] = fhdr
-            offset = len(fhdr)
-            c[offset] = self.fh.pack()
+            r = [ (0, lambda: fhdr),
+                  (len(fhdr), self.fh.pack) ]
             for e in self.arch.macholist:
-                c[e.offset] = e.pack()
-            for offset, data in self.rawdata:
-                c[offset] = data
-            return c.pack()
+                r.extend([ (e.offset+offset, produce)
+                           for offset, produce in e.regions() ])
+        for offset, data in self.rawdata:
+            r.append((offset, lambda data=data: data))
+        return r
+    def build_patchwork(self):
+        c = StrPatchwork()
+        for offset, produce in self.regions():
+            c[offset] = produce()
+        return c
+    def pack_to(self, fileobj):
+        # Same output as pack(), written in offset order to 'fileobj'
+        pack_regions(fileobj, self.regions())
+    def write(self, filename):
+        fd = open(filename, 'wb')
+        try:
+            self.pack_to(fd)
+        finally:
+            fd.close()
     def __str__(self):
         raise AttributeError("Use pack() instead of str()")
     
@@ -366,10 +406,10 @@ class MACHO(object):
     entrypoint = property(entrypoint, set_entrypoint)
 
     def getsectionbyname(self, name):
-        for s in self.sect:
-            if hasattr(s, 'sh') and name == "%s,%s"%(s.sh.segname,s.sh.sectname):
-                return s
-        return None
+        if not hasattr(self.sect, 'name_index'):
+            # Fat Mach-O
+            return None
+        return self.sect.name_index().get(name)
 
     def getsectionbyvad(self, ad, section = None):
         if section:
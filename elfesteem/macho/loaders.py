@@ -431,6 +431,18 @@ class sectionHeader(CStruct):
         self.pad_sectname = name_to_bytes(val)+data_null*padding
     sectname = property(get_sectname, set_sectname)
     name = property(lambda _:"%s,%s"%(_.segname,_.sectname))
+    def setf(self, fname, v):
+        CStruct.setf(self, fname, v)
+        if fname in ('pad_sectname', 'pad_segname'):
+            # The index of sections by name of the Mach-O is not valid
+            # anymore; it is found by following the parents
+            p = self.parent
+            while p is not None:
+                sect = getattr(p, 'sect', None)
+                if hasattr(sect, 'reset_name_index'):
+                    sect.reset_name_index()
+                    return
+                p = getattr(p, 'parent', None)
     def is_text_section(self):
         return self.sectname == "__text"
     all_flags = property(lambda _:_.flags) # Backwards compatibility
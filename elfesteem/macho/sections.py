@@ -1,6 +1,7 @@
 import struct
 from elfesteem.macho.common import *
 from elfesteem.cstruct import Constants, CBase, CString, CArray, CStruct, CStructWithStrTable
+from elfesteem.cstruct import strtab_index, strtab_append
 from elfesteem.strpatchwork import StrPatchwork
 
 import sys
@@ -1077,18 +1078,46 @@ class StringTable(LinkEditSection):
     type = 'str'
     def get_name(self, idx):
         return bytes_to_name(self.content[idx:self.content.find(data_null,idx)])
-    def add_name(self, name):
+    _index = None
+    def name_index(self):
+        # Offset of each name; it is rebuilt when the length of the
+        # content has changed
+        if self._index is None or self._index[0] != len(self.content):
+            index = strtab_index(self.content[0:len(self.content)])
+            self._index = (len(self.content), index)
+        return self._index[1]
+    def find_name(self, name):
+        # A name that is not in the index may be the suffix of a name
         name = name_to_bytes(name)
-        if data_null+name+data_null in self.content:
-            return self.content.find(name)
-        data = self.content
-        if type(data) != str: data = data.pack()
-        idx = len(data)
-        self.content = data+name+data_null
-        for sh in self.parent.shlist:
-            if sh.sh.offset > self.sh.offset:
-                sh.sh.offset += len(name)+1
+        idx = self.name_index().get(name)
+        if idx is None and name + data_null in self.content:
+            idx = self.content.find(name + data_null)
         return idx
+    def add_name(self, name):
+        return self.add_names([name])[0]
+    def add_names(self, names):
+        # Names that are not yet in the table are appended; what follows
+        # the string table in the file is moved only once
+        index = self.name_index()
+        idx = len(self.content)
+        added, res = strtab_append(index, names, idx,
+                                   self.content.find)
+        if added:
+            data = data_null.join(added) + data_null
+            self.content[idx] = data
+            self.resize(len(data))
+            self._index = (len(self.content), index)
+        return res
+    def resize(self, diff):
+        end = self.offset + self.size
+        load = self.parent.parent
+        segm = load.parent.getsegment_byoffset(self.offset)
+        self.size += diff
+        load.changeOffsets(diff, end)
+        if segm is not None:
+            segm.filesize += diff
+            if segm.vmsize < segm.filesize:
+                segm.vmsize = segm.filesize
     def mod_name(self, idx, name):
         name = name_to_bytes(name)
         n = self.content[idx:self.content.find(data_null,idx)]
@@ -1128,7 +1157,21 @@ class Sections(object):
                 for s in lc.sect:
                     segm = parent.getsegment_byoffset(s.offset)
                     if segm is not None: segm.sect.append(s)
+    # Index of sections by name 'segname,sectname'; reset when a section
+    # is added, removed or renamed.
+    _name_index = None
+    def reset_name_index(self):
+        self._name_index = None
+    def name_index(self):
+        if self._name_index is None or self._name_index[0] != len(self.sect):
+            names = {}
+            for s in self.sect:
+                if hasattr(s, 'sh'):
+                    names.setdefault("%s,%s"%(s.sh.segname,s.sh.sectname), s)
+            self._name_index = (len(self.sect), names)
+        return self._name_index[1]
     def add(self, s):
+        self.reset_name_index()
         # looking in s.lc to know where to insert
         pos = 0
         for lc in self.parent.load:
@@ -1148,6 +1191,7 @@ class Sections(object):
                 poslist.append(i)
         return poslist
     def removepos(self, pos):
+        self.reset_name_index()
         self.sect.remove(self.sect[pos])
     def __getitem__(self, pos):
         return self.sect.__getitem__(pos)
@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+
+# Search of many byte patterns in one pass over some data.
+# A pattern is either
+#   - a byte string, e.g. struct.pack("BBB", 0x55, 0x89, 0xe5)
+#   - a signature, i.e. a sequence of byte values where None matches
+#     any byte, e.g. (0x55, 0x89, None, 0xec) or signature("55 89 ?? ec")
+#   - a compiled regular expression on bytes
+# Byte strings and signatures are merged in a trie, which is converted
+# to a regular expression that finds the positions where some pattern
+# may match; the trie is then walked from each of these positions, to
+# know which patterns match. Regular expressions without groups that
+# have the same flags are merged in this regular expression, or in a
+# similar one if their flags differ from those of the trie, and are
+# matched at the positions found. Other regular expressions are
+# searched separately. The matches of these searches are merged by
+# address, and yielded without being buffered.
+
+import re
+import sys
+import struct
+import mmap
+from array import array
+from elfesteem.strpatchwork import StrPatchwork, to_bytes, bytes_type
+
+ANY = -1 # Key of the trie for wildcard bytes
+END = -2 # Key of the trie for the ids of patterns that end there
+TRIE_FLAGS = re.compile(''.encode('latin1'), re.DOTALL).flags
+
+def signature(text):
+    # "55 89 ?? ec" -> (0x55, 0x89, None, 0xec); spaces are optional
+    text = text.replace(' ', '')
+    if len(text) % 2:
+        raise ValueError("Invalid signature %r" % text)
+    res = []
+    for i in range(0, len(text), 2):
+        if text[i:i+2] == '??':
+            res.append(None)
+        else:
+            res.append(int(text[i:i+2], 16))
+    return tuple(res)
+
+def bytes_to_signature(data):
+    return tuple(array('B', data))
+
+class Patterns(object):
+    """
+    A compiled set of patterns.
+      Patterns(patterns): 'patterns' is a list, and the id of each pattern
+        is its index, or a dict that maps ids to patterns
+      search(data, addr): yields (address, id) for all matches in 'data',
+        that is at address 'addr', sorted by address and by pattern order
+    The object can be reused for many searches, e.g. with the search()
+    methods of the 'virt' objects of containers.
+    """
+    def __init__(self, patterns):
+        if hasattr(patterns, 'items'):
+            patterns = patterns.items()
+        else:
+            patterns = enumerate(patterns)
+        self.trie = {}
+        self.order = {}
+        regexps = []
+        for pos, (pid, p) in enumerate(patterns):
+            self.order[pid] = pos
+            if hasattr(p, 'search'):
+                regexps.append((pid, p))
+                continue
+            if not isinstance(p, (tuple, list)):
+                p = bytes_to_signature(p)
+            if len(p) == 0:
+                raise ValueError("Empty pattern %r" % (pid,))
+            node = self.trie
+            for b in p:
+                if b is None: b = ANY
+                node = node.setdefault(b, {})
+            node.setdefault(END, []).append(pid)
+        # 'prefilters' is a list of (regexp, trie, regexps), where 'regexp'
+        # finds the positions where the trie (if not None) or some of
+        # the regular expressions 'regexps' may match; 'regexps' is the
+        # list of the regular expressions searched separately.
+        merged = {}
+        self.regexps = []
+        for pid, r in regexps:
+            if r.groups or not isinstance(r.pattern, bytes_type):
+                # Merging would renumber the groups
+                self.regexps.append((pid, r))
+            else:
+                merged.setdefault(r.flags, []).append((pid, r))
+        if self.trie:
+            merged.setdefault(TRIE_FLAGS, [])
+        self.prefilters = []
+        flags = list(merged.keys())
+        flags.sort()
+        for f in flags:
+            trie = None
+            if f == TRIE_FLAGS and self.trie:
+                trie = self.trie
+            try:
+                regexp = self._prefilter(trie, merged[f], f)
+            except re.error:
+                # e.g. global inline flags, that cannot be merged
+                self.regexps.extend(merged[f])
+                merged[f] = []
+                if trie is None:
+                    continue
+                regexp = self._prefilter(trie, [], f)
+            self.prefilters.append((regexp, trie, merged[f]))
+
+    def _prefilter(self, trie, regexps, flags):
+        alts = []
+        if trie is not None:
+            alts.append(self._regexp(trie))
+        for pid, r in regexps:
+            alts.append('(?:'.encode('latin1') + r.pattern
+                        + ')'.encode('latin1'))
+        return re.compile('(?='.encode('latin1')
+                          + '|'.encode('latin1').join(alts)
+                          + ')'.encode('latin1'), flags)
+
+    def _regexp(self, node):
+        # Regular expression that matches at the positions where some
+        # pattern in the trie 'node' matches
+        if END in node:
+            # A pattern ends here, what follows does not matter
+            return ''.encode('latin1')
+        alts = []
+        keys = [ k for k in node.keys() if k >= 0 ]
+        keys.sort()
+        for k in keys:
+            alts.append(re.escape(struct.pack("B", k)) + self._regexp(node[k]))
+        if ANY in node:
+            alts.append('.'.encode('latin1') + self._regexp(node[ANY]))
+        if len(alts) == 1:
+            return alts[0]
+        return '(?:'.encode('latin1') + '|'.encode('latin1').join(alts) \
+            + ')'.encode('latin1')
+
+    def _walk(self, data, pos):
+        # Ids of the patterns in the trie that match at 'pos'
+        res = []
+        todo = [(self.trie, pos)]
+        while todo:
+            node, pos = todo.pop()
+            res.extend(node.get(END, ()))
+            if pos >= len(data):
+                continue
+            if data[pos] in node:
+                todo.append((node[data[pos]], pos+1))
+            if ANY in node:
+                todo.append((node[ANY], pos+1))
+        return res
+
+    def search(self, data, addr=0):
+        # The regular expressions are applied to 'data' without copy
+        # when it is bytes or mmap, or with python3 any object with the
+        # buffer interface (e.g. memoryview); with python2 the trie is
+        # walked on an array of the bytes, only built if needed.
+        raw = walk = data
+        if sys.version_info[0] < 3:
+            walk = None
+            if hasattr(data, 'tobytes'):
+                data = raw = data.tobytes() # memoryview
+            if isinstance(data, array):
+                walk, raw = data, to_bytes(data)
+            elif not isinstance(data, (bytes_type, mmap.mmap)):
+                walk = array('B', data)
+                raw = to_bytes(walk)
+        elif not isinstance(data, (bytes, bytearray, memoryview, mmap.mmap,
+                                   array)):
+            raw = walk = array('B', data)
+        # One stream of matches for each prefilter and for each regular
+        # expression searched separately, merged by address
+        streams = []
+        for regexp, trie, regexps in self.prefilters:
+            streams.append(self._search_prefilter(raw, walk,
+                                                  regexp, trie, regexps))
+        for pid, r in self.regexps:
+            streams.append(self._search_regexp(raw, pid, r))
+        heads = []
+        for stream in streams:
+            for match in stream:
+                heads.append((match, stream))
+                break
+        while heads:
+            i = 0
+            for j in range(1, len(heads)):
+                if heads[j][0] < heads[i][0]:
+                    i = j
+            (pos, _, pid), stream = heads[i]
+            yield addr + pos, pid
+            for match in stream:
+                heads[i] = (match, stream)
+                break
+            else:
+                del heads[i]
+
+    def _search_prefilter(self, raw, walk, regexp, trie, regexps):
+        # Yields (position, order, id) for the matches of the trie and
+        # of 'regexps' at the positions found by 'regexp'
+        for m in regexp.finditer(raw):
+            pos = m.start()
+            found = []
+            if trie is not None:
+                if walk is None:
+                    # Only built if some pattern may match
+                    walk = array('B', raw[:])
+                for pid in self._walk(walk, pos):
+                    found.append((pos, self.order[pid], pid))
+            for pid, r in regexps:
+                if r.match(raw, pos) is not None:
+                    found.append((pos, self.order[pid], pid))
+            found.sort()
+            for match in found:
+                yield match
+
+    def _search_regexp(self, raw, pid, r):
+        m = r.search(raw)
+        while m is not None:
+            yield m.start(), self.order[pid], pid
+            m = r.search(raw, m.start()+1)
+
+def search_regions(regions, patterns, start=0, end=None):
+    # 'regions' is a list of (address, data); yields (address, id)
+    # for matches of 'patterns' in the data that is in [start:end].
+    # 'data' may be a StrPatchwork, searched without copy if it is
+    # not patched.
+    if not isinstance(patterns, Patterns):
+        patterns = Patterns(patterns)
+    regions = [ (addr, i, data) for i, (addr, data) in enumerate(regions)
+                if data is not None ]
+    regions.sort()
+    for addr, _, data in regions:
+        if isinstance(data, StrPatchwork):
+            data = data.view(0, len(data))
+        if start > addr:
+            data = data[start-addr:]
+            addr = start
+        if end is not None and end < addr + len(data):
+            data = data[:max(0, end-addr)]
+        for match in patterns.search(data, addr):
+            yield match
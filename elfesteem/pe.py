@@ -3,9 +3,11 @@
 from elfesteem.cstruct import Constants, CBase, CString, CStruct, CArray
 from elfesteem.cstruct import data_null, data_empty
 from elfesteem.cstruct import bytes_to_name
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.strpatchwork import StrPatchwork, to_bytes
+from array import array
 import struct
 import logging
+from bisect import bisect_left, bisect_right
 log = logging.getLogger("pe")
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter("%(levelname)-5s: %(message)s"))
@@ -494,6 +496,26 @@ IMAGE_REL_M32R_SECREL    = 0x000D, # The 32-bit offset of the target from the be
 IMAGE_REL_M32R_TOKEN     = 0x000E, # The CLR token.
 )
 
+SetConstants(
+# Base relocation types; some values depend on the machine
+IMAGE_REL_BASED_ABSOLUTE       = 0,
+IMAGE_REL_BASED_HIGH           = 1,
+IMAGE_REL_BASED_LOW            = 2,
+IMAGE_REL_BASED_HIGHLOW        = 3,
+IMAGE_REL_BASED_HIGHADJ        = 4,
+IMAGE_REL_BASED_MIPS_JMPADDR   = 5,
+IMAGE_REL_BASED_ARM_MOV32      = 5,
+IMAGE_REL_BASED_RISCV_HIGH20   = 5,
+IMAGE_REL_BASED_THUMB_MOV32    = 7,
+IMAGE_REL_BASED_RISCV_LOW12I   = 7,
+IMAGE_REL_BASED_RISCV_LOW12S   = 8,
+IMAGE_REL_BASED_MIPS_JMPADDR16 = 9,
+IMAGE_REL_BASED_IA64_IMM64     = 9,
+IMAGE_REL_BASED_DIR64          = 10,
+no_name = ('IMAGE_REL_BASED_ARM_MOV32', 'IMAGE_REL_BASED_RISCV_HIGH20',
+           'IMAGE_REL_BASED_RISCV_LOW12I', 'IMAGE_REL_BASED_IA64_IMM64')
+)
+
 class InvalidOffset(Exception):
     pass
 
@@ -791,7 +813,12 @@ class SectionData(CBase):
         raw_sz += self.parent.scnptr - self.parent.scn_baseoff
         if self.parent.scn_baseoff+raw_sz > len(c):
             raw_sz = len(c) - self.parent.scn_baseoff
-        self.data[0] = c[self.parent.scn_baseoff:self.parent.scn_baseoff+raw_sz]
+        start, stop = self.parent.scn_baseoff, self.parent.scn_baseoff+raw_sz
+        if isinstance(c, StrPatchwork):
+            # No copy of the file, the section data is an overlay
+            self.data = StrPatchwork(c.view(start, stop))
+        else:
+            self.data[0] = c[start:stop]
         if self.parent.relptr >= len(c):
             raise ValueError("COFF invalid relptr")
         self.relocs = COFFRelocations(parent=self.parent,
@@ -885,6 +912,11 @@ class Shdr(CStruct):
         filealignment = 0x200
         return (self.scnptr//filealignment)*filealignment
     scn_baseoff = property(scn_baseoff)
+    def setf(self, fname, v):
+        CStruct.setf(self, fname, v)
+        if fname in ('name_data', 'paddr', 'vaddr', 'rsize', 'scnptr') \
+                and isinstance(self.parent, SHList):
+            self.parent.reset_indexes()
     def is_in_file(self):
         if self.rsize == 0:
             # Empty section, not in the file!
@@ -949,6 +981,47 @@ class ShdrTI(Shdr):
         return self.rsize
     rawsize = property(rawsize)
 
+class RangeIndex(object):
+    """
+    Index of a list of items, each one being a range [start:stop].
+    'bounds' is the sorted list of all starts and stops; for each
+    interval between two consecutive bounds, 'first' contains the first
+    item of the list that contains this interval, or None.
+    """
+    def __init__(self, items, ranges):
+        self.key = len(items)
+        bounds = {}
+        for start, stop in ranges:
+            if start < stop:
+                bounds[start] = True
+                bounds[stop] = True
+        self.bounds = sorted(bounds.keys())
+        self.first = [None] * len(self.bounds)
+        # Each interval gets its item only once: 'skip' points to the
+        # next interval that may not have an item yet.
+        skip = list(range(len(self.bounds)+1))
+        def next_free(i):
+            j = i
+            while skip[j] != j:
+                j = skip[j]
+            while skip[i] != j:
+                skip[i], i = j, skip[i]
+            return j
+        for item, (start, stop) in zip(items, ranges):
+            if start >= stop:
+                continue
+            i = next_free(bisect_left(self.bounds, start))
+            j = bisect_left(self.bounds, stop)
+            while i < j:
+                self.first[i] = item
+                skip[i] = i+1
+                i = next_free(i+1)
+    def find(self, pos):
+        i = bisect_right(self.bounds, pos) - 1
+        if i < 0:
+            return None
+        return self.first[i]
+
 class SHList(CArray):
     def _cls(self):
         if self.parent.COFFhdr.machine == IMAGE_FILE_MACHINE_TI:
@@ -970,6 +1043,39 @@ class SHList(CArray):
     def __repr__(self):
         # Not respecting python's recommendation of what __repr__ should return
         return self.display()
+
+    # Indexes of sections by RVA, by file offset and by name, used by
+    # PE.rva2off and similar methods; they are computed when needed, and
+    # are reset when a section is added or when a section header is
+    # modified.
+    _rva_index = None
+    _off_index = None
+    _name_index = None
+    def reset_indexes(self):
+        self._rva_index = None
+        self._off_index = None
+        self._name_index = None
+    def rva_index(self):
+        if self._rva_index is None or self._rva_index.key != len(self):
+            self._rva_index = RangeIndex(self._array,
+                [ (s.vaddr, s.vaddr+s.size) for s in self._array ])
+        return self._rva_index
+    def off_index(self):
+        if self._off_index is None or self._off_index.key != len(self):
+            self._off_index = RangeIndex(self._array,
+                [ (s.scnptr, s.scnptr+s.rsize) for s in self._array ])
+        return self._off_index
+    def name_index(self):
+        # First section with a given name
+        if self._name_index is None or self._name_index[0] != len(self):
+            names = {}
+            for s in self._array:
+                names.setdefault(s.name.strip('\x00'), s)
+            self._name_index = (len(self), names)
+        return self._name_index[1]
+    def append(self, obj):
+        self.reset_indexes()
+        return CArray.append(self, obj)
     
     def add_section(self, name="default", data = data_empty, **args):
         if len(self):
@@ -1078,6 +1184,7 @@ class SHList(CArray):
             s.offset = raw_off
             s.rawsize = len(s.data)
             addr = raw_off + s.rawsize
+        self.reset_indexes()
 
 
 ####################################################################
@@ -1152,7 +1259,45 @@ class SHList(CArray):
 
 from elfesteem.visual_studio_mangling import symbol_demangle
 
+class IndexMapping(object):
+    """
+    Read-only view of a dict, used for the indexes of the directories.
+    The same object is returned by the index methods until the directory
+    is modified.
+    """
+    def __init__(self, d):
+        self._dict = d
+    def __getitem__(self, key):
+        return self._dict[key]
+    def get(self, key, default=None):
+        return self._dict.get(key, default)
+    def __contains__(self, key):
+        return key in self._dict
+    def __iter__(self):
+        return iter(self._dict)
+    def __len__(self):
+        return len(self._dict)
+    def keys(self):
+        return list(self._dict.keys())
+    def values(self):
+        return list(self._dict.values())
+    def items(self):
+        return list(self._dict.items())
+    def __eq__(self, other):
+        if isinstance(other, IndexMapping):
+            other = other._dict
+        return self._dict == other
+    def __ne__(self, other):
+        return not self == other
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._dict)
+
 class CArrayDirectory(CArray):
+    def modified(self):
+        # Any change in the directory, e.g. the name of an imported
+        # function, resets its indexes
+        if hasattr(self, 'reset_indexes'):
+            self.reset_indexes()
     def unpack(self, c, o):
         if o is None:
             # Use the entry in the NT headers
@@ -1167,11 +1312,18 @@ class CArrayDirectory(CArray):
             if o is None: return # Directory in no section
         CArray.unpack(self, c, o)
 
+class DirectoryStruct(CStruct):
+    # Structure in a directory: the indexes of the directory are reset
+    # when a field or another attribute is set, e.g. a name
+    def __setattr__(self, name, value):
+        CStruct.__setattr__(self, name, value)
+        self.modified()
+
 class ImportName(CStruct):
     _fields = [ ("hint", "u16"),
                 ("name", CString) ]
 
-class ImportNamePtr(CStruct):
+class ImportNamePtr(DirectoryStruct):
     _fields = [ ("rva","ptr") ]
     def unpack(self, c, o):
         CStruct.unpack(self, c, o)
@@ -1193,13 +1345,17 @@ class ImportNamePtr(CStruct):
                 self.obj = None
                 self.name = None
             else:
-                self.obj = ImportName(parent=self, content=c, start=off)
+                # ImportName objects are shared, see DirImport.unpack
+                names = getattr(self.parent.parent.parent, '_names', {})
+                if not off in names:
+                    names[off] = ImportName(parent=self, content=c, start=off)
+                self.obj = names[off]
                 self.name = str(self.obj.name)
 
 class ImportThunks(CArray):
     _cls = ImportNamePtr
 
-class ImportDescriptor(CStruct):
+class ImportDescriptor(DirectoryStruct):
     _fields = [ ("originalfirstthunk","u32"), # Import Lookup Table
                 ("timestamp","u32"),
                 ("forwarderchain","u32"),
@@ -1209,6 +1365,14 @@ class ImportDescriptor(CStruct):
               ]
     def rva2off(self, rva):
         return self.parent.parent.rva2off(rva)
+    def thunks(self, c, of):
+        # ImportThunks objects are shared, see DirImport.unpack; the
+        # thunks of DelayDescriptor depend on the attributes
+        memo = getattr(self.parent, '_thunks', {})
+        key = (of, getattr(self, 'attrs', 1) & 1)
+        if not key in memo:
+            memo[key] = ImportThunks(parent=self, content=c, start=of)
+        return memo[key]
     def unpack(self, c, o):
         CStruct.unpack(self, c, o)
         if self.parent.stop(self):
@@ -1225,22 +1389,22 @@ class ImportDescriptor(CStruct):
         else:
             self.name = CString(parent=self, content=c, start=of)
         # NB: it is possible for a PE to have many Import descriptors
-        # pointing to the same IAT and ILT. elfesteem will take a
-        # long time because the IAT and ILT will be parsed each time.
+        # pointing to the same IAT and ILT. They are parsed only once,
+        # and shared by the descriptors.
         # An example of such malformed file is
         # https://github.com/radare/radare2-regressions/blob/master/bins/fuzzed/file-rs-bf838568
         of = self.rva2off(self.firstthunk)
         if of is None:
             log.error('IAT')
         else:
-            self.IAT = ImportThunks(parent=self, content=c, start=of)
+            self.IAT = self.thunks(c, of)
         # NB: http://win32assembly.programminghorizon.com/pe-tut6.html
         # says "Some linkers generate PE files with 0 in
         # OriginalFirstThunk. This is considered a bug."
         # An example is the IDA installer!
         of = self.rva2off(self.originalfirstthunk)
         if not of in (0, None):
-            self.ILT = ImportThunks(parent=self, content=c, start=of)
+            self.ILT = self.thunks(c, of)
 
 class DirImport(CArrayDirectory):
     _cls = ImportDescriptor
@@ -1264,6 +1428,17 @@ class DirImport(CArrayDirectory):
                         t_obj += ' ' + repr_obj(u.obj)
                 res += '\n        %2d %#10x %s' % (jdx, t_virt, t_obj)
         return res
+    def unpack(self, c, o):
+        # During the parsing, the thunk arrays and the names that are
+        # referenced many times are memoised by file offset, so that
+        # malformed files with many descriptors pointing to the same
+        # thunks are parsed in linear time.
+        self._thunks = {}
+        self._names = {}
+        try:
+            CArrayDirectory.unpack(self, c, o)
+        finally:
+            del self._thunks, self._names
     def pack(self):
         raise AttributeError("Cannot pack '%s': the Directory Entry data is not always contiguous"%self.__class__.__name__)
     def stop(self, elt):
@@ -1285,12 +1460,11 @@ class DirImport(CArrayDirectory):
         # Expand self.dll_to_add with new DLL and functions
         # new_dll is a list, where each member is a pair
         # - dll_name: dict with 'name' giving the DLL name
-        #             The 'firstthunk' value is currently ignored:
-        #             elfesteem used this value to indicate another
-        #             section where the IAT would be located, and
-        #             did not create an ILT.
-        #             TODO: memorize this value to be used in
-        #             'write_directory'
+        #             The 'firstthunk' value is ignored: elfesteem used
+        #             this value to indicate another section where the
+        #             IAT would be located, and did not create an ILT;
+        #             this is now done with the arguments 'iat_rva' and
+        #             'ilt' of 'write_directory'.
         # - dll_func: list of function names
         for dll_name, dll_func in new_dll:
             # First, an empty descriptor
@@ -1298,24 +1472,63 @@ class DirImport(CArrayDirectory):
             self.dll_to_add.append(d)
             # Add the DLL name
             d.name = CString(parent=d, s=dll_name['name'].encode('latin1'))
-            # Add the Import names; they will be located after the two thunks
-            thunk_len = (1+len(dll_func))*(self.wsize/8)
-            thunk_len *= 2
-            # Add the IAT & ILT
+            # Add the IAT & ILT; the Import names are in the ILT
             d.ILT = ImportThunks(parent=d)
             for n in dll_func:
                 t = ImportNamePtr(parent=d.ILT)
                 t.obj = ImportName(parent=t, s=n.encode('latin1'))
                 t.name = n
-                thunk_len += t.obj.bytelen
-                if thunk_len%2: thunk_len += 1
                 d.ILT.append(t)
             d.IAT = ImportThunks(parent=d)
             for n in dll_func:
                 t = ImportNamePtr(parent=d.ILT)
                 t.name = n
                 d.IAT.append(t)
-    def write_directory(self, base_rva):
+    def _layout(self, ilt, separate_iat):
+        # Offsets of the new directory, computed in one pass over
+        # self.dll_to_add: the list of descriptors is followed, for each
+        # DLL, by its name, its ILT, its IAT (unless it is separate) and
+        # the names of the functions, aligned to 2 bytes.
+        # Returns (size, iat_size, layout) where layout has, for each DLL,
+        # the offsets of its name, ILT, IAT (in the separate IAT if any)
+        # and of the names of the functions.
+        ptr = self.wsize//8
+        of = self.bytelen + self._cls(parent=self).bytelen*len(self.dll_to_add)
+        end = of
+        iat_size = 0
+        layout = []
+        for d in self.dll_to_add:
+            name_of = of
+            of += d.name.bytelen
+            if of%2: of += 1
+            thunk_len = (1+len(d.ILT))*ptr
+            ilt_of = None
+            if ilt:
+                ilt_of = of
+                of += thunk_len
+            if separate_iat:
+                iat_of = iat_size
+                iat_size += thunk_len
+            else:
+                iat_of = of
+                of += thunk_len
+            end = of
+            names_of = []
+            for t in d.ILT:
+                names_of.append(of)
+                of += t.obj.bytelen
+                end = of
+                if of%2: of += 1
+            layout.append((name_of, ilt_of, iat_of, names_of))
+        return end, iat_size, layout
+    def plan(self, ilt=True, separate_iat=False):
+        # Sizes of the new Import Directory with the DLLs of
+        # self.dll_to_add and of the separate IAT, if any, that can be
+        # used to create sections of the appropriate size before calling
+        # write_directory with the same arguments.
+        size, iat_size, _ = self._layout(ilt, separate_iat)
+        return size, iat_size
+    def write_directory(self, base_rva, iat_rva=None, ilt=True):
         # Creates in the section starting at 'base_rva' a new Import Directory
         # with the content of self.dll_to_add
         
@@ -1326,16 +1539,25 @@ class DirImport(CArrayDirectory):
         # The trick we use is to move the list of descriptors in a new
         # section (s_dir), where we will also store the new ILT, IAT and
         # names, leaving the original section unchanged.
+        # If 'iat_rva' is not None, the new IATs are stored at this RVA,
+        # in an existing section, e.g. one created with the size given
+        # by self.plan(ilt, True).
+        # If 'ilt' is False, no ILT is created, the loader finds the
+        # names of the functions in the IAT.
+        # The layout is computed before anything is written, and each
+        # region is written at once.
         # 
-        # TODO: The IAT can be stored in another section than the rest of
-        # the directory (descriptors, names, ILT) ; provide this possibility.
-        # TODO: The ILT is not necessary. Provide the possibility of not
-        # creating it.
         # TODO: If base_rva is not the vaddr of an existing section, but
         # is inside na existing section, do we overwrite everything after
         # base_rva?
 
         e = self.parent
+        size, iat_size, layout = self._layout(ilt, iat_rva is not None)
+        if iat_rva is not None:
+            s_iat = e.getsectionbyrva(iat_rva)
+            if s_iat is None or \
+               iat_rva + iat_size > s_iat.vaddr + s_iat.rsize:
+                raise ValueError("No room for the IAT at RVA %#x" % iat_rva)
         for s_dir in e.SHList.shlist:
             # This section may have been created by
             #   e.SHList.add_section(name="myimp", rawsize=len(e.DirImport))
@@ -1352,53 +1574,77 @@ class DirImport(CArrayDirectory):
             s_dir = e.SHList.add_section(
                 name='.idata2',
                 flags=IMAGE_SCN_MEM_WRITE|IMAGE_SCN_MEM_READ|IMAGE_SCN_CNT_INITIALIZED_DATA,
-                rsize=0x1000,     # should be enough
+                rsize=size,
                 )
             base_rva = s_dir.vaddr
-        s_dir.section_data.data = StrPatchwork()
+        if s_dir.rsize < size:
+            s_dir.rsize = size
+        data = array('B', data_null) * s_dir.rsize
+        iat_data = array('B', data_null) * iat_size
+        def write(buf, of, s):
+            buf[of:of+len(s)] = array('B', s)
         self._size += self._cls(parent=self).bytelen * len(self.dll_to_add)
-        of = self.bytelen
-        for d in self.dll_to_add:
+        for d, (name_of, ilt_of, iat_of, names_of) in zip(self.dll_to_add, layout):
             self._array.append(d)
-            d.name_rva = base_rva+of
-            s_dir.section_data.data[of] = d.name.pack()
-            of += d.name.bytelen
-            if of%2: of += 1
-            thunk_len = (1+len(d.ILT))*(self.wsize//8)
-            thunk_len *= 2
-            for t in d.ILT:
-                t.rva = base_rva+of+thunk_len
-                s_dir.section_data.data[of+thunk_len] = t.obj.pack()
-                thunk_len += t.obj.bytelen
-                if thunk_len%2: thunk_len += 1
-            d.originalfirstthunk = base_rva+of
-            s_dir.section_data.data[of] = d.ILT.pack()
-            of += d.ILT.bytelen
-            d.firstthunk = base_rva+of
-            for idx, t in enumerate(d.IAT):
-                t.obj = d.ILT[idx].obj
-                t.rva = d.ILT[idx].rva
-            s_dir.section_data.data[of] = d.IAT.pack()
-            of += thunk_len - d.ILT.bytelen
+            d.name_rva = base_rva+name_of
+            write(data, name_of, d.name.pack())
+            for t, of in zip(d.ILT, names_of):
+                t.rva = base_rva+of
+                write(data, of, t.obj.pack())
+            for t, u in zip(d.IAT, d.ILT):
+                t.obj = u.obj
+                t.rva = u.rva
+            if ilt_of is None:
+                d.originalfirstthunk = 0
+                del d.ILT
+            else:
+                d.originalfirstthunk = base_rva+ilt_of
+                write(data, ilt_of, d.ILT.pack())
+            if iat_rva is None:
+                d.firstthunk = base_rva+iat_of
+                write(data, iat_of, d.IAT.pack())
+            else:
+                d.firstthunk = iat_rva+iat_of
+                write(iat_data, iat_of, d.IAT.pack())
         self.dll_to_add = []
         # Write the descriptor list (now that all RVA have been computed)
-        s_dir.section_data.data[0] = CArray.pack(self)
+        write(data, 0, CArray.pack(self))
+        s_dir.section_data.data = StrPatchwork()
+        s_dir.section_data.data[0] = to_bytes(data)
+        if iat_size:
+            s_iat.section_data.data[iat_rva-s_iat.vaddr] = to_bytes(iat_data)
         # Update the section sizes
-        s_dir.paddr = len(s_dir.section_data.data)
-        if s_dir.rsize < s_dir.paddr:
-            s_dir.rsize = s_dir.paddr
-        s_dir.section_data.data[s_dir.paddr] = data_null*(s_dir.rsize-s_dir.paddr)
+        s_dir.paddr = size
         e.NThdr.optentries[self._idx].rva = base_rva
         e.NThdr.optentries[self._idx].size = s_dir.paddr # Unused by PE loaders
+        self.reset_indexes()
+
+    # Index of imported functions: (dll name, function name or ordinal)
+    # is mapped to the RVA of the function in the Import Address Table,
+    # and (None, function name or ordinal) to the first one in any DLL.
+    # It is computed when needed, and is reset when the directory is
+    # rewritten.
+    _func_index = None
+    def reset_indexes(self):
+        self._func_index = None
+    def func_index(self):
+        if self._func_index is None or self._func_index[0] != len(self):
+            funcs = {}
+            for d in self:
+                dllname = str(d.name)
+                if not hasattr(d, 'IAT'):
+                    continue
+                for idx, t in enumerate(d.IAT):
+                    if t.name is None:
+                        continue
+                    rva = d.firstthunk+idx*t.bytelen
+                    funcs.setdefault((dllname, t.name), rva)
+                    funcs.setdefault((None, t.name), rva)
+            self._func_index = (len(self), IndexMapping(funcs))
+        return self._func_index[1]
     def get_funcrva(self, dllname, funcname):
         # Position of the function in the Import Address Table
-        for d in self:
-            if dllname is not None and str(d.name) != dllname:
-                continue
-            for idx, t in enumerate(d.IAT):
-                if t.name == funcname:
-                    return d.firstthunk+idx*t.bytelen
-        return None
+        return self.func_index().get((dllname, funcname))
     def get_funcvirt(self, dllname, funcname):
         return self.parent.rva2virt(self.get_funcrva(dllname, funcname))
     # For API compatibility with previous versions of elfesteem
@@ -1416,6 +1662,7 @@ class DirImport(CArrayDirectory):
     def set_impdesc(self, value):
         if value in (None, []):
             CArrayDirectory._initialize(self)
+            self.reset_indexes()
             return
         TODO
     impdesc = property(impdesc, set_impdesc)
@@ -1455,7 +1702,7 @@ class DirDelay(DirImport):
 
 
 
-class ExportAddressRVA(CStruct):
+class ExportAddressRVA(DirectoryStruct):
     _fields = [ ("rva","u32") ]
     def unpack(self, c, o):
         CStruct.unpack(self, c, o)
@@ -1472,7 +1719,7 @@ class ExportAddressTable(CArray):
     _cls = ExportAddressRVA
     count = lambda _: _.parent.numberoffunctions
 
-class ExportNamePointerRVA(CStruct):
+class ExportNamePointerRVA(DirectoryStruct):
     _fields = [ ("rva","u32") ]
     def unpack(self, c, o):
         CStruct.unpack(self, c, o)
@@ -1486,14 +1733,14 @@ class ExportNamePointersTable(CArray):
     _cls = ExportNamePointerRVA
     count = lambda _: _.parent.numberofnames
 
-class ExportOrdinal(CStruct):
+class ExportOrdinal(DirectoryStruct):
     _fields = [ ("ordinal","u16") ]
 
 class ExportOrdinalTable(CArray):
     _cls = ExportOrdinal
     count = lambda _: _.parent.numberofnames
 
-class ExportDescriptor(CStruct):
+class ExportDescriptor(DirectoryStruct):
     _fields = [ ("characteristics","u32"), # Unused and always 0
                 ("timestamp","u32"),
                 ("majorv","u16"), # Unused and always 0
@@ -1568,78 +1815,223 @@ class DirExport(CArrayDirectory):
             res += '\n    %2d %s %r' % (i, addr, name)
         return res
     def create(self, funcs, name = 'default.dll'):
-        # Don't separate 'create()' and 'add_name()' because adding new
-        # exports to an existing export table is very tricky: we need to
-        # resize the EAT, ENPT and EOT.
+        # Creates an export table in a new section; the functions whose
+        # RVA is unknown are exported at 0xdeadc0fe.
+        # For API compatibility with previous versions of elfesteem; see
+        # 'build' to add exports to an existing table.
         if len(self) != 0: return
         e = self.parent
         s = e.SHList.add_section(
             name='.edata2',
             flags=IMAGE_SCN_MEM_READ|IMAGE_SCN_CNT_INITIALIZED_DATA,
-            rsize=0x1000,     # should be enough
+            rsize=0x1000,
             )
-        base_rva = e.off2rva(s.scnptr)
-        e.NThdr.optentries[self._idx].rva = base_rva
-        s.section_data.data = StrPatchwork()
-        # First, an empty descriptor
-        d = ExportDescriptor(parent=self, base=1)
-        self.append(d)
-        of = self.bytelen
-        # Add the DLL name
-        d.name = CString(parent=d, s=name.encode('latin1'))
-        d.name_rva = base_rva+of
-        s.section_data.data[of] = d.name.pack()
-        of += d.name.bytelen
-        # Add the EAT, ENPT & EOT
-        d.numberoffunctions += len(funcs)
-        d.numberofnames     += len(funcs)
-        d.EAT = ExportAddressTable(parent=d)
+        self.build(funcs, name, base_rva=s.vaddr, default_rva=0xdeadc0fe)
+    def symbol_index(self):
+        # RVA of the external symbols of the COFF symbol table; on i386
+        # the names of C functions start with '_', we also index them
+        # without this prefix.
+        e = self.parent
+        res = {}
+        for sym in getattr(e, 'Symbols', ()):
+            if sym.storageclass != IMAGE_SYM_CLASS_EXTERNAL or \
+               not 0 < sym.sectionnumber <= len(e.SHList):
+                continue
+            rva = e.SHList[sym.sectionnumber-1].vaddr + sym.value
+            name = sym.name
+            res.setdefault(name, rva)
+            if name.startswith('_'):
+                res.setdefault(name[1:], rva)
+        return res
+    def build(self, funcs, name=None, base_rva=None, default_rva=None):
+        # Writes in the section starting at 'base_rva' (or in a new section
+        # of the appropriate size) an export table with the existing
+        # exports and 'funcs'. Each element of 'funcs' is
+        # - a function name, whose RVA is found in the COFF symbol table,
+        #   or is 'default_rva'; an error is raised if there is none,
+        # - a pair (name, rva),
+        # - a pair (name, forwarder), e.g. ('HeapAlloc', 'NTDLL.RtlAllocateHeap').
+        # Existing names are updated, new names get new ordinals. The
+        # names are sorted, because the loader uses a binary search.
+        # The layout is computed before anything is written, and the
+        # table is written at once; the previous table is left unchanged.
+        e = self.parent
+        if len(self):
+            d = self[0]
+            eat = []
+            for t in d.EAT:
+                fwd = getattr(t, 'name', None)
+                if fwd is not None:
+                    fwd = str(fwd)
+                eat.append((t.rva, fwd))
+            named = {}
+            for i in range(min(len(d.ENPT), len(d.EOT))):
+                if d.EOT[i].ordinal < len(eat):
+                    named.setdefault(str(d.ENPT[i].name), d.EOT[i].ordinal)
+            if name is None:
+                name = str(d.name)
+        else:
+            d = None
+            eat, named = [], {}
+        if name is None:
+            name = 'default.dll'
+        symbols = None
         for f in funcs:
             if isinstance(f, tuple):
-                rva = f[1]
+                f, rva = f
+            else:
+                if symbols is None:
+                    symbols = self.symbol_index()
+                rva = symbols.get(f, default_rva)
+                if rva is None:
+                    raise ValueError("No RVA for exported function %r" % f)
+            if isinstance(rva, str):
+                value = (0, rva)
             else:
-                # TODO: we should look for the RVA of a symbol of name 'f'
-                rva = 0xdeadc0fe
+                value = (rva, None)
+            if f in named:
+                eat[named[f]] = value
+            else:
+                named[f] = len(eat)
+                eat.append(value)
+        names = [ (f.encode('latin1'), f) for f in named.keys() ]
+        names.sort()
+        if d is None:
+            d = ExportDescriptor(parent=self, base=1)
+            self.append(d)
+        # Layout: descriptor, DLL name, EAT, EOT, ENPT, function names
+        # and forwarders
+        of = self.bytelen
+        name_of = of
+        of += len(name)+1
+        of += (-of)%4
+        eat_of = of
+        of += 4*len(eat)
+        eot_of = of
+        of += 2*len(names)
+        enpt_of = of
+        of += 4*len(names)
+        names_of = []
+        for n, _ in names:
+            names_of.append(of)
+            of += len(n)+1
+        fwd_of = []
+        for rva, fwd in eat:
+            if fwd is not None:
+                fwd_of.append(of)
+                of += len(fwd)+1
+            else:
+                fwd_of.append(None)
+        size = of
+        for s in e.SHList.shlist:
+            if s.vaddr == base_rva:
+                break
+        else:
+            s = e.SHList.add_section(
+                name='.edata2',
+                flags=IMAGE_SCN_MEM_READ|IMAGE_SCN_CNT_INITIALIZED_DATA,
+                rsize=size,
+                )
+            base_rva = s.vaddr
+        if s.rsize < size:
+            s.rsize = size
+        # Construct the tables
+        d.name = CString(parent=d, s=name.encode('latin1'))
+        d.name_rva = base_rva+name_of
+        d.numberoffunctions = len(eat)
+        d.numberofnames = len(names)
+        d.addressoffunctions = base_rva+eat_of
+        d.addressofordinals = base_rva+eot_of
+        d.addressofnames = base_rva+enpt_of
+        d.EAT = ExportAddressTable(parent=d)
+        for (rva, fwd), of in zip(eat, fwd_of):
             t = ExportAddressRVA(parent=d.EAT, rva=rva)
+            if fwd is not None:
+                t.rva = base_rva+of
+                t.name = CString(parent=t, s=fwd.encode('latin1'))
             d.EAT.append(t)
-        d.addressoffunctions = base_rva+of
-        s.section_data.data[of] = d.EAT.pack()
-        of += d.EAT.bytelen
         d.EOT = ExportOrdinalTable(parent=d)
-        for idx in range(len(funcs)):
-            t = ExportOrdinal(parent=d.EOT, ordinal=idx)
-            d.EOT.append(t)
-        d.addressofordinals = base_rva+of
-        s.section_data.data[of] = d.EOT.pack()
-        of += d.EOT.bytelen
-        pos = len(funcs)*4 # size of ENPT
         d.ENPT = ExportNamePointersTable(parent=d)
-        for f in funcs:
-            if isinstance(f, tuple): f = f[0] # The name of the function
-            t = ExportNamePointerRVA(parent=d.ENPT)
-            t.name = CString(parent=t, s=f.encode('latin1'))
+        for (n, f), of in zip(names, names_of):
+            d.EOT.append(ExportOrdinal(parent=d.EOT, ordinal=named[f]))
+            t = ExportNamePointerRVA(parent=d.ENPT, rva=base_rva+of)
+            t.name = CString(parent=t, s=n)
             t.name.name = f # For API compatibility with previous versions
-            t.rva = base_rva+of+pos
-            s.section_data.data[of+pos] = t.name.pack()
-            pos += t.name.bytelen
             d.ENPT.append(t)
-        d.addressofnames = base_rva+of
-        s.section_data.data[of] = d.ENPT.pack()
-        # Write the descriptor list (now that everyting has been computed)
-        s.section_data.data[0] = CArray.pack(self)
+        # Write the directory
+        data = array('B', data_null) * s.rsize
+        def write(of, b):
+            data[of:of+len(b)] = array('B', b)
+        write(0, CArray.pack(self))
+        write(name_of, d.name.pack())
+        write(eat_of, d.EAT.pack())
+        write(eot_of, d.EOT.pack())
+        write(enpt_of, d.ENPT.pack())
+        for t, of in zip(d.ENPT, names_of):
+            write(of, t.name.pack())
+        for t, of in zip(d.EAT, fwd_of):
+            if of is not None:
+                write(of, t.name.pack())
+        s.section_data.data = StrPatchwork()
+        s.section_data.data[0] = to_bytes(data)
         # Update the section sizes
-        s.paddr = len(s.section_data.data)
-        e.NThdr.optentries[self._idx].size = s.paddr # Unused by PE loaders
-        if s.rsize < s.paddr:
-            s.rsize = s.paddr
-        s.section_data.data[s.paddr] = data_null*(s.rsize-s.paddr)
+        s.paddr = size
+        e.NThdr.optentries[self._idx].rva = base_rva
+        e.NThdr.optentries[self._idx].size = size
         # Finalize
         d.compute_exports()
+        self.reset_indexes()
+
+    # Indexes of exported functions, computed when needed from the
+    # 'exports' of the descriptor, and reset when the directory is
+    # rewritten:
+    # - name_index(): function name -> RVA
+    # - ordinal_index(): ordinal -> RVA
+    # - forwarder_index(): function name or ordinal -> forwarder, e.g.
+    #   'NTDLL.RtlAllocateHeap'
+    _export_index = None
+    def reset_indexes(self):
+        self._export_index = None
+    def export_index(self):
+        # (key, names, ordinals, forwarders, name pointers, named exports)
+        # where name pointers are used by get_funcrva and named exports
+        # (names and ordinals of named functions) by PE.export_funcs
+        key = len(self)
+        if key:
+            key = (key, len(self[0].exports))
+        if self._export_index is None or self._export_index[0] != key:
+            names, ordinals, forwarders = {}, {}, {}
+            name_ptrs, funcs = {}, {}
+            for d in self:
+                for t in d.ENPT:
+                    name_ptrs.setdefault(str(t.name), t.rva)
+                for i in range(min(len(d.ENPT), len(d.EOT))):
+                    j = d.EOT[i].ordinal
+                    if j < len(d.EAT):
+                        funcs[str(d.ENPT[i].name)] = d.EAT[j].rva
+                        funcs[d.base+j] = d.EAT[j].rva
+                for ordinal, (addr, name) in d.exports.items():
+                    name = str(name)
+                    ordinals[ordinal] = addr.rva
+                    if name:
+                        names.setdefault(name, addr.rva)
+                    if hasattr(addr, 'name'):
+                        forwarders[ordinal] = str(addr.name)
+                        if name:
+                            forwarders.setdefault(name, str(addr.name))
+            self._export_index = (key,
+                IndexMapping(names), IndexMapping(ordinals),
+                IndexMapping(forwarders), name_ptrs, funcs)
+        return self._export_index
+    def name_index(self):
+        return self.export_index()[1]
+    def ordinal_index(self):
+        return self.export_index()[2]
+    def forwarder_index(self):
+        return self.export_index()[3]
     def get_funcrva(self, name):
-        for d in self:
-            for t in d.ENPT:
-                if str(t.name) == name: return t.rva
-        return None
+        # NB: this is the RVA of the name of the function
+        return self.export_index()[4].get(name)
     def get_funcvirt(self, name):
         return self.parent.rva2virt(self.get_funcrva(name))
     # For API compatibility with previous versions of elfesteem
@@ -1729,14 +2121,23 @@ class ResourceDataDescription(CStruct):
         if of is None:
             log.error("Invalid ResourceDataDescription with RVA %#x", self.rva)
             raise ValueError
-        else:
-            self.data = c[of:of+self.size]
+        # The content of the resource is only read when needed, because
+        # resources can be large and are usually not all used
+        self._content = c
+        self._data_off = of
+    def data(self):
+        return self._content[self._data_off:self._data_off+self.size]
+    def set_data(self, data):
+        self._content = data
+        self._data_off = 0
+        self.size = len(data)
+    data = property(data, set_data)
     def __repr__(self):
         return '<%s RVA=%#x size=%d codepage=%d zero=%d>' % (
             self.__class__.__name__,
             self.rva, self.size, self.codepage, self.zero)
 
-class ResourceDirectoryEntry(CStruct):
+class ResourceDirectoryEntry(DirectoryStruct):
     _fields = [ ("id","u32"),
                 ("offset","u32") ]
     base = property(lambda _:_.parent.base)
@@ -1795,7 +2196,7 @@ class ResourceDirectoryEntries(CArray):
         return self.parent.numberofnamedentries + self.parent.numberofidentries
     base = property(lambda _:_.parent.base)
 
-class ResourceDescriptor(CStruct):
+class ResourceDescriptor(DirectoryStruct):
     _fields = [ ("characteristics","u32"), # Unused and always 0
                 ("timestamp","u32"),
                 ("majorv","u16"), # Unused and always 0
@@ -1818,6 +2219,38 @@ class DirRes(CArrayDirectory):
         _.parent.rva2off(_.parent.NThdr.optentries[_._idx].rva))
     def rva2off(self, rva):
         return self.parent.rva2off(rva)
+    _path_index = None
+    def reset_indexes(self):
+        self._path_index = None
+    def path_index(self):
+        # Maps the paths (type, name, lang) to the ResourceDataDescription
+        # of the leaves; the elements of a path are ids, or strings for
+        # named entries. A path ending with None gives the first leaf of
+        # the branch, e.g. (RT_MANIFEST, None, None).
+        if self._path_index is None or self._path_index[0] != len(self):
+            paths = {}
+            def walk(path, desc):
+                for entry in desc.entries:
+                    if entry.id & 0x80000000:
+                        key = path + (str(entry.name),)
+                    else:
+                        key = path + (entry.id,)
+                    if hasattr(entry, 'dir'):
+                        walk(key, entry.dir)
+                    elif hasattr(entry, 'data'):
+                        paths.setdefault(key + (None,)*(3-len(key)),
+                                         entry.data)
+                        for i in range(len(key)-1, 0, -1):
+                            paths.setdefault(key[:i] + (None,)*(3-i),
+                                             entry.data)
+            if len(self):
+                walk((), self[0])
+            self._path_index = (len(self), IndexMapping(paths))
+        return self._path_index[1]
+    def lookup(self, type, name=None, lang=None):
+        # ResourceDataDescription of a resource, or None; its content is
+        # only read from the file when its 'data' is used
+        return self.path_index().get((type, name, lang))
     def is_depth_3_tree(self):
         if len(self) == 0: return False
         for d, (x, y, z) in self[0].show_tree():
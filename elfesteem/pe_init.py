@@ -1,9 +1,15 @@
 #! /usr/bin/env python
 
-import struct, array
+import struct, array, bisect
 from elfesteem import pe
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.cstruct import strtab_index, strtab_append
+from elfesteem.strpatchwork import StrPatchwork, bytes_type, pack_regions
+from elfesteem.patterns import search_regions
 log = pe.log
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import sys
 if sys.version_info[0:2] == (2, 3):
@@ -89,10 +95,16 @@ class ContentRVA(object):
             data_slice = data.__getitem__(i)
             s.section_data.__setitem__(n_item, data_slice)
             off = i.stop
-            #XXX test patch content
-            file_off = self.parent.rva2off(s.vaddr+n_item.start)
-            if self.parent.content:
-                self.parent.content = self.parent.content[:file_off]+ data_slice + self.parent.content[file_off+len(data_slice):]
+            # The file content is patched in place, for the part of the
+            # slice that is in the raw data of the section
+            if not s.is_in_file():
+                continue
+            raw_end = s.scnptr - s.scn_baseoff + s.rsize
+            file_off = s.scn_baseoff + n_item.start
+            file_len = min(len(data_slice), raw_end - n_item.start,
+                           len(self.parent.content) - file_off)
+            if file_len > 0:
+                self.parent.content[file_off] = data_slice[:file_len]
 
 
 class ContentVirtual(object):
@@ -198,6 +210,21 @@ class ContentVirtual(object):
             return self.parent.rva2virt(s.vaddr + ret)
         return -1
 
+    def search(self, patterns, start=0, end=None):
+        # Yields (address, id) for all matches of 'patterns', in one pass
+        # over the headers and each section, see elfesteem.patterns;
+        # the data that has not been modified is searched without copy.
+        e = self.parent
+        regions = []
+        base = 0
+        if hasattr(e, 'NThdr'):
+            base = e.NThdr.ImageBase
+            regions.append((base, e.content.view(0, e.NThdr.sizeofheaders)))
+        for s in e.SHList:
+            if s.is_in_file():
+                regions.append((base+s.vaddr, s.data.view(0, s.rawsize)))
+        return search_regions(regions, patterns, start, end)
+
     def is_addr_in(self, ad):
         return self.parent.is_in_virt_address(ad)
 
@@ -215,20 +242,25 @@ class ContentVirtual(object):
         return data_out
 
 class StrTable(object):
-    def __init__(self, c):
+    # COFF string table; it begins with its size (4 bytes) and names
+    # are found at offsets >= 4. 'names' maps each name to its offset
+    # (see strtab_index).
+    def __init__(self, c, sex='<'):
+        self.sex = sex
         self.res = {}
-        self.names = {}
         self.trail = pe.data_empty
         self.len = 0
+        self.grown = False
+        self._offsets = None
         while c:
             p = c.find(pe.data_null)
             if p < 0:
                 self.trail = c
                 break
             self.res[self.len] = c[:p]
-            self.names[c[:p]] = self.len
             self.len += p+1
             c = c[p+1:]
+        self.names = strtab_index(self.pack(), 4)
     def __str__(self):
         raise AttributeError("Use pack() instead of str()")
     def pack(self):
@@ -238,22 +270,156 @@ class StrTable(object):
             if len(res) != s:
                 raise ValueError("StrTable is incoherent : %r != %r"%(len(res),s))
             res += self.res[s] + pe.data_null
-        return res + self.trail
+        res += self.trail
+        if self.grown:
+            res = struct.pack(self.sex+'I', len(res)) + res[4:]
+        return res
     def add(self, name):
-        if name in self.names:
-            return self.names[name]
-        self.res[self.len] = name
-        self.names[name] = self.len
-        self.len += len(name)+1
+        return self.add_names([name])[0]
+    def add_names(self, names):
+        # Returns the offsets of all names; new names share the tail
+        # of existing names when possible
+        if self.len < 4:
+            # No room yet for the size of the table
+            self.res[self.len] = pe.data_null*(3-self.len)
+            self.len = 4
+        added, res = strtab_append(self.names, names, self.len)
+        for name in added:
+            self.res[self.len] = name
+            self.len += len(name)+1
+        if added:
+            self.grown = True
+            self._offsets = None
+        return res
     def rem(self, name):
         TODO
     def getby_name(self, name):
         return self.names[name]
     def getby_offset(self, of):
-        return self.res.get(of, "")
+        if of in self.res:
+            return self.res[of]
+        # 'of' may be inside a name, whose tail is shared
+        if self._offsets is None:
+            self._offsets = sorted(self.res.keys())
+        i = bisect.bisect_right(self._offsets, of) - 1
+        if i >= 0 and of < self._offsets[i] + len(self.res[self._offsets[i]]):
+            start = self._offsets[i]
+            return self.res[start][of-start:]
+        return ""
 
 # PE object
 
+# The PE checksum is computed by chunks of this size
+checksum_chunk = 0x100000
+
+def checksum_words(data, start, stop, use_numpy=True):
+    # Sum of the little-endian 32-bit words of data[start:stop]
+    try:
+        if isinstance(data, bytes):
+            data = memoryview(data)
+    except NameError:
+        # memoryview is not available before python2.7
+        pass
+    s = 0
+    for i in range(start, stop, checksum_chunk):
+        chunk = data[i:min(stop, i+checksum_chunk)]
+        if numpy is not None and use_numpy:
+            s += int(numpy.frombuffer(chunk, '<u4').sum(dtype='u8'))
+            continue
+        if hasattr(chunk, 'tobytes'):
+            chunk = chunk.tobytes()
+        a = array.array('I', chunk)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        s += sum(a)
+    return s
+
+class Checksum(object):
+    """
+    PE checksum of 'data', where the CheckSum field is at 'offset'.
+    The value of the CheckSum field is not part of the checksum.
+      value(): the checksum
+      update(offset, old, new): incremental computation, when the bytes
+        'old' at 'offset' are replaced by the bytes 'new'
+      write(data): incremental computation, when 'data' is appended;
+        a Checksum can be used as a file object, e.g. by pack_regions
+    The checksum is a one's complement sum of 16-bit words (folded to
+    16 bits), plus the length of the data; the last byte of data of odd
+    length is added after folding.
+    """
+    def __init__(self, data, offset, use_numpy=True):
+        self.offset = offset
+        self.length = len(data)
+        stop = self.length & ~1
+        self.last = 0
+        if self.length % 2:
+            self.last, = struct.unpack('B', data[stop:stop+1])
+        start = 0
+        self.sum = 0
+        if stop % 4:
+            self.sum, = struct.unpack('<H', data[:2])
+            start = 2
+        self.sum += checksum_words(data, start, stop, use_numpy)
+        if offset is not None:
+            self.sum -= struct.unpack('<I', data[offset:offset+4])[0]
+    def fold(self):
+        s = self.sum
+        while s>mask32:
+            s = (s>>32)+(s&mask32)
+        while s>0xFFFF:
+            s = (s&0xFFFF)+((s>>16)&0xFFFF)
+        return s
+    def value(self):
+        return self.fold() + self.last + self.length
+    def update(self, offset, old, new):
+        if len(old) != len(new):
+            raise ValueError("Cannot change the size of the data")
+        if offset + len(old) > self.length:
+            raise ValueError("Cannot write after the end of the data")
+        if self.length % 2 and offset + len(old) == self.length:
+            self.last, = struct.unpack('B', new[-1:])
+            old, new = old[:-1], new[:-1]
+        if self.offset is not None:
+            # The CheckSum field is ignored
+            start = max(0, self.offset - offset)
+            stop = min(len(old), self.offset + 4 - offset)
+            if start < stop:
+                blank = pe.data_null * (stop-start)
+                old = old[:start] + blank + old[stop:]
+                new = new[:start] + blank + new[stop:]
+        if offset % 2:
+            old, new = pe.data_null + old, pe.data_null + new
+        if len(old) % 2:
+            old, new = old + pe.data_null, new + pe.data_null
+        if not len(old):
+            return
+        fmt = '<%dH' % (len(old)//2)
+        delta = sum(struct.unpack(fmt, new)) - sum(struct.unpack(fmt, old))
+        if delta and self.sum > 0:
+            # Only the folded value is meaningful, and its computation
+            # from an updated sum gives the same result
+            self.sum = (self.fold() + delta - 1) % 0xFFFF + 1
+        else:
+            self.sum += delta
+    def write(self, data):
+        if not len(data):
+            return
+        if self.length % 2:
+            # The last byte is now the low byte of a word
+            self.sum += self.last + 256*struct.unpack('B', data[:1])[0]
+            self.last = 0
+            self.length += 1
+            data = data[1:]
+        stop = len(data) & ~1
+        start = 0
+        if stop % 4:
+            self.sum += struct.unpack('<H', data[:2])[0]
+            start = 2
+        self.sum += checksum_words(data, start, stop)
+        if len(data) % 2:
+            self.last, = struct.unpack('B', data[stop:stop+1])
+        self.length += len(data)
+
 class PE(object):
     # API shared by all/most binary containers
     architecture = property(lambda _:pe.constants['IMAGE_FILE_MACHINE'].get(_.COFFhdr.machine,'UNKNOWN(%d)'%_.COFFhdr.machine))
@@ -411,7 +577,7 @@ class PE(object):
                 log.warning('File too short for StrTable %#x != %#x' % (
                     len(self.content)-of, sz))
                 sz = len(self.content) - of
-            self.SymbolStrings = StrTable(self.content[of:of+sz])
+            self.SymbolStrings = StrTable(self.content[of:of+sz], self.sex)
 
     def resize(self, old, new):
         pass
@@ -423,25 +589,16 @@ class PE(object):
     def getsectionbyrva(self, rva, section = None):
         if section:
             return self.getsectionbyname(section)
-        for s in self.SHList.shlist:
-            if s.vaddr <= rva < s.vaddr+s.size:
-                return s
-        return None
+        return self.SHList.rva_index().find(rva)
 
     def getsectionbyvad(self, vad, section = None):
         return self.getsectionbyrva(self.virt2rva(vad), section)
 
     def getsectionbyoff(self, off):
-        for s in self.SHList.shlist:
-            if s.scnptr <= off < s.scnptr+s.rsize:
-                return s
-        return None
+        return self.SHList.off_index().find(off)
 
     def getsectionbyname(self, name):
-        for s in self.SHList:
-            if s.name.strip('\x00') ==  name:
-                return s
-        return None
+        return self.SHList.name_index().get(name)
 
     def rva2off(self, rva, section = None):
         if section is None and self.has_relocatable_sections():
@@ -486,54 +643,106 @@ class PE(object):
     def is_in_virt_address(self, ad):
         if hasattr(self, 'NThdr') and ad < self.NThdr.ImageBase:
             return False
-        ad = self.virt2rva(ad)
-        for s in self.SHList.shlist:
-            if s.vaddr <= ad < s.vaddr + s.size:
-                return True
-        return False
+        return self.getsectionbyrva(self.virt2rva(ad)) is not None
 
     drva = property(lambda _: _._rva) # Deprecated
     rva = property(lambda _: _._rva)
     virt = property(lambda _: _._virt)
 
     def patch_crc(self, c, olds):
-        s = 0
-        data = c[:]
-        l = len(data)
-        if len(c)%2:
-            end = struct.unpack('B', data[-1:])[0]
-            data = data[:-1]
-        if (len(c)&~0x1)%4:
-            s+=struct.unpack('H', data[:2])[0]
-            data = data[2:]
-        data = array.array('I', data)
-        for y in data:
-            s += y
-        s-=olds
-        while s>mask32:
-            s = (s>>32)+(s&mask32)
-        while s>0xFFFF:
-            s = (s&0xFFFF)+((s>>16)&0xFFFF)
-        if len(c)%2:
-            s+=end
-        s+=l
-        return s
+        crc = Checksum(c, None)
+        crc.sum -= olds
+        return crc.value()
+
+    def checksum_offset(self):
+        return self.DOShdr.lfanew + self.NTsig.bytelen \
+            + self.COFFhdr.bytelen + 64
+    def compute_checksum(self, data=None, use_numpy=True):
+        # Checksum of 'data', by default the content of the file
+        if data is None:
+            data = self.content
+        return Checksum(data, self.checksum_offset(), use_numpy).value()
+    def verify_checksum(self, data=None):
+        if data is None:
+            data = self.content
+        of = self.checksum_offset()
+        return struct.unpack('<I', data[of:of+4])[0] == \
+            self.compute_checksum(data)
+
+    def authenticode_ranges(self, data=None):
+        # The ranges of the file that are hashed by Authenticode: the
+        # headers without the CheckSum field and the SECURITY directory
+        # entry, the sections sorted by file offset, and the data after
+        # the sections, without the certificate table.
+        if data is None:
+            data = self.content
+        length = len(data)
+        checksum = self.checksum_offset()
+        skip = [ (checksum, checksum+4) ]
+        cert_size = 0
+        if self.NThdr.numberofrvaandsizes > pe.DIRECTORY_ENTRY_SECURITY:
+            of = checksum - 64 + {32: 96, 64: 112}[self.wsize] \
+                + 8 * pe.DIRECTORY_ENTRY_SECURITY
+            skip.append((of, of+8))
+            cert_size = self.NThdr.optentries[pe.DIRECTORY_ENTRY_SECURITY].size
+        ranges = []
+        pos = 0
+        for start, stop in skip:
+            ranges.append((pos, start))
+            pos = stop
+        end = self.NThdr.sizeofheaders
+        ranges.append((pos, end))
+        for s in sorted(self.SHList, key=lambda _:_.scnptr):
+            if s.rsize == 0:
+                continue
+            ranges.append((s.scnptr, s.scnptr+s.rsize))
+            end = max(end, s.scnptr+s.rsize)
+        ranges.append((end, length-cert_size))
+        return [ (start, min(stop, length)) for start, stop in ranges
+                 if start < min(stop, length) ]
+
+    def authenticode_digest(self, algorithm='sha256', data=None):
+        # Authenticode hash of 'data', by default the content of the file,
+        # which is read by chunks. If 'algorithm' is a list of names of
+        # hashlib algorithms, the list of digests is computed in one pass.
+        import hashlib
+        if data is None:
+            data = self.content
+        if isinstance(algorithm, (list, tuple)):
+            hashes = [ hashlib.new(name) for name in algorithm ]
+        else:
+            hashes = [ hashlib.new(algorithm) ]
+        if isinstance(data, bytes_type) and sys.version_info[0] >= 3:
+            data = memoryview(data)
+        for start, stop in self.authenticode_ranges(data):
+            for i in range(start, stop, checksum_chunk):
+                chunk = data[i:min(stop, i+checksum_chunk)]
+                for h in hashes:
+                    h.update(chunk)
+        res = [ h.digest() for h in hashes ]
+        if isinstance(algorithm, (list, tuple)):
+            return res
+        return res[0]
 
     def build_headers(self, c):
+        for off, produce in self.header_regions():
+            c[off] = produce()
+    def header_regions(self):
         off = self.DOShdr.lfanew
-        c[off] = self.NTsig.pack()
-        off += self.NTsig.bytelen
-        c[off] = self.COFFhdr.pack()
-        off += self.COFFhdr.bytelen
-        c[off] = self.Opthdr.pack()
-        off += self.Opthdr.bytelen
-        c[off] = self.NThdr.pack()
-        off += self.NThdr.bytelen
-
-    def build_content(self):
-        c = StrPatchwork()
-        c[self.NThdr.sizeofheaders-1] = pe.data_null
-        c[0] = self.DOShdr.pack()
+        r = []
+        for hdr in (self.NTsig, self.COFFhdr, self.Opthdr, self.NThdr):
+            r.append((off, hdr.pack))
+            off += hdr.bytelen
+        return r
+
+    def regions(self):
+        # List of (offset, produce) for the parts of the file, as for
+        # ELF; SizeOfImage and PointerToSymbolTable are updated, but the
+        # CheckSum field is not, because it depends on the whole file.
+        r = []
+        if self.NThdr.sizeofheaders:
+            r.append((self.NThdr.sizeofheaders-1, lambda: pe.data_null))
+        r.append((0, self.DOShdr.pack))
 
         # fix image size
         if len(self.SHList):
@@ -542,15 +751,12 @@ class PE(object):
             size &= ~(self.NThdr.sectionalignment-1)
             self.NThdr.sizeofimage = size
 
-        # headers
-        self.build_headers(c)
-
         # section headers
         off = self.DOShdr.lfanew \
             + self.NTsig.bytelen \
             + self.COFFhdr.bytelen \
             + self.COFFhdr.sizeofoptionalheader
-        c[off] = self.SHList.pack()
+        r.append((off, self.SHList.pack))
         off += self.SHList.bytelen
         end_of_headers = off
 
@@ -568,26 +774,33 @@ class PE(object):
                 log.warning("section %s offset %#x overlap previous section",
                     s.name, s.scnptr)
             off = s.scnptr+s.rawsize
-            c[s.scnptr:off] = s.section_data.data.pack()
+            r.append((s.scnptr, s.section_data.data.pack))
 
         # symbols and strings
         if self.COFFhdr.numberofsymbols:
             self.COFFhdr.pointertosymboltable = off
-            c[off] = self.Symbols.pack()
+            r.append((off, self.Symbols.pack))
             assert self.Symbols.bytelen == 18 * self.COFFhdr.numberofsymbols
             off += self.Symbols.bytelen
-            c[off] = self.SymbolStrings.pack()
+            r.append((off, self.SymbolStrings.pack))
 
-        # some headers may have been updated when building sections or symbols
-        self.build_headers(c)
+        # headers, written after the sections that may overlap them
+        r.extend(self.header_regions())
 
         # final verifications
-        l = self.DOShdr.lfanew + self.NTsig.bytelen + self.COFFhdr.bytelen
-        if l%4:
+        if self.checksum_offset() % 4:
             log.warning("non aligned coffhdr, bad crc calculation")
-        crcs = self.patch_crc(c.pack(), self.NThdr.CheckSum)
-        c[l+64] = struct.pack('I', crcs)
-        return c.pack()
+        return r
+
+    def build_content(self):
+        return self.build_patchwork().pack()
+    def build_patchwork(self):
+        c = StrPatchwork()
+        for offset, produce in self.regions():
+            c[offset] = produce()
+        crcs = self.patch_crc(c, self.NThdr.CheckSum)
+        c[self.checksum_offset()] = struct.pack('I', crcs)
+        return c
 
     def __str__(self):
         # For compatibility with previous versions of elftesteem
@@ -597,31 +810,80 @@ class PE(object):
 
     def pack(self):
         return self.build_content()
+    def pack_to(self, fileobj):
+        # Same output as pack(), written in offset order to 'fileobj'.
+        # The regions are produced twice: the checksum of the file is
+        # computed first, without building the file in memory.
+        regions = self.regions()
+        crc = Checksum(pe.data_empty, None)
+        pack_regions(crc, regions)
+        crc.sum -= self.NThdr.CheckSum
+        regions.append((self.checksum_offset(),
+                        lambda: struct.pack('I', crc.value())))
+        pack_regions(fileobj, regions)
+    def write(self, filename):
+        fd = open(filename, 'wb')
+        try:
+            self.pack_to(fd)
+        finally:
+            fd.close()
 
     def export_funcs(self):
+        # Names and ordinals of the named exports, mapped to their
+        # virtual addresses
         all_func = {}
-        for i, n in enumerate(self.DirExport.f_names):
-            all_func[n.name.name] = self.rva2virt(self.DirExport.f_address[self.DirExport.f_nameordinals[i].ordinal].rva)
-            all_func[self.DirExport.f_nameordinals[i].ordinal+self.DirExport.expdesc.base] = self.rva2virt(self.DirExport.f_address[self.DirExport.f_nameordinals[i].ordinal].rva)
+        for name, rva in self.DirExport.export_index()[5].items():
+            all_func[name] = self.rva2virt(rva)
         #XXX todo: test if redirected export
         return all_func
 
-    def reloc_to(self, imgbase):
-        DEPRECATED
-        offset = imgbase - self.NThdr.ImageBase
-        for rel in self.DirReloc.reldesc:
-            rva = rel.rva
-            for reloc in rel.rels:
-                t, off = reloc.rel
-                if t == 0 and off == 0:
+    def relocate(self, imgbase, image=None):
+        # Applies the base relocations, for a load at 'imgbase'. The
+        # patches are written in 'image', addressed by the virtual
+        # addresses after loading; by default, they are written in the
+        # file, whose ImageBase is changed.
+        # Returns the number of relocations that have been applied.
+        from elfesteem import relocation
+        delta = imgbase - self.NThdr.ImageBase
+        machine = self.COFFhdr.machine
+        patches = relocation.Relocator(self.sex)
+        if image is None:
+            image, origin = self.drva, 0
+        else:
+            origin = imgbase
+        applied = 0
+        skipped = {}
+        for block in self.DirReloc:
+            rels = block.rels
+            i = 0
+            while i < len(rels):
+                t, off = rels[i].rel
+                i += 1
+                if t == pe.IMAGE_REL_BASED_HIGHADJ:
+                    if i == len(rels):
+                        break
+                    field = relocation.word16_highadj(rels[i].word)
+                    i += 1
+                else:
+                    try:
+                        field = relocation.pe_base_relocation(machine, t)
+                    except KeyError:
+                        skipped[t] = skipped.get(t, 0) + 1
+                        continue
+                if field is None:
                     continue
-                if t != 3:
-                    raise ValueError('reloc type not impl')
-                off += rva
-                v = struct.unpack('I', self.drva[off:off+4])[0]
-                v += offset
-                self.drva[off:off+4] = struct.pack('I', v & mask32)
-        self.NThdr.ImageBase = imgbase
+                patches.add(image, origin + block.rva + off, field,
+                            relocation.B_A, B=delta)
+                applied += 1
+        patches.apply()
+        for t in sorted(skipped.keys()):
+            log.warning("%d base relocations of type %d not applied",
+                        skipped[t], t)
+        if origin == 0:
+            self.NThdr.ImageBase = imgbase
+        return applied
+    # For API compatibility with previous versions of elfesteem
+    reloc_to = relocate
 
 # The COFF file format happens to have many variants,
 # quite different from the COFF embedded in PE files...
@@ -753,7 +1015,7 @@ class COFF(PE):
                 log.warning('File too short for StrTable %#x != %#x' % (
                     len(self.content)-of, sz))
                 sz = len(self.content) - of
-            self.SymbolStrings = StrTable(self.content[of:of+sz])
+            self.SymbolStrings = StrTable(self.content[of:of+sz], self.sex)
         
         if self.Opthdr.__class__.__name__ == 'OpthdrUnknown':
             log.warning("Unknown Option Header format of size %d for machine %s:",
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+
+# Application of relocations to an image: ELF relocations (of object
+# files, or of executables and shared objects loaded at some base) and
+# PE base relocations.
+# Relocations are not applied one by one: the patches are sorted and
+# grouped by page, then each page is read once from the image, patched,
+# and written back once.
+
+from elfesteem.cstruct import Struct
+from elfesteem.strpatchwork import StrPatchwork
+from elfesteem import elf, pe
+
+page_size = 0x1000
+
+def sign_extend(value, bits):
+    value &= (1<<bits)-1
+    if value >> (bits-1):
+        value -= 1<<bits
+    return value
+
+class Field(object):
+    """
+    A relocated field of 'size' bytes
+      extract(old): the addend stored in the field, used when the
+        relocation has no explicit addend
+      insert(old, value): the new content of the field
+    By default, the field is a word that contains the value.
+    """
+    def __init__(self, size, extract=None, insert=None):
+        self.size = size
+        self.mask = (1 << (8*size)) - 1
+        if extract is not None:
+            self.extract = extract
+        if insert is not None:
+            self.insert = insert
+    def extract(self, old):
+        return old
+    def insert(self, old, value):
+        return value & self.mask
+
+word8  = Field(1)
+word16 = Field(2)
+word32 = Field(4)
+word64 = Field(8)
+# ARM B/BL, AArch64 B/BL: PC relative branches
+arm_branch = Field(4,
+    lambda old: sign_extend(old, 24) << 2,
+    lambda old, v: (old & 0xff000000) | ((v >> 2) & 0x00ffffff))
+a64_branch = Field(4,
+    lambda old: sign_extend(old, 26) << 2,
+    lambda old, v: (old & 0xfc000000) | ((v >> 2) & 0x03ffffff))
+# AArch64 ADRP: 21 bits, split in immlo and immhi
+a64_adrp = Field(4,
+    lambda old: 0,
+    lambda old, v: (old & 0x9f00001f) | (((v >> 12) & 0x3) << 29)
+                                      | (((v >> 14) & 0x7ffff) << 5))
+# AArch64 ADD/LDR/STR: low 12 bits of an address, scaled by the size
+# of the access
+def a64_lo12(shift):
+    return Field(4,
+        lambda old: 0,
+        lambda old, v: (old & 0xffc003ff) | (((v & 0xfff) >> shift) << 10))
+
+# Formulas of the ELF specifications, where S is the address of the
+# symbol, A the addend, P the address of the field and B the base
+def S_A(S, A, P, B):       return S + A
+def S_A_P(S, A, P, B):     return S + A - P
+def S_(S, A, P, B):        return S
+def B_A(S, A, P, B):       return B + A
+def page_S_A_P(S, A, P, B): return ((S + A) & ~0xfff) - (P & ~0xfff)
+
+# For each machine, (field, formula) for each relocation type; the
+# relocations to the GOT or PLT entries (created when linking) and to
+# TLS are not supported.
+elf_relocations = {
+    elf.EM_386: {
+        elf.R_386_NONE:       None,
+        elf.R_386_32:         (word32, S_A),
+        elf.R_386_PC32:       (word32, S_A_P),
+        elf.R_386_PLT32:      (word32, S_A_P),
+        elf.R_386_GLOB_DAT:   (word32, S_),
+        elf.R_386_JMP_SLOT:   (word32, S_),
+        elf.R_386_RELATIVE:   (word32, B_A),
+        },
+    elf.EM_X86_64: {
+        elf.R_X86_64_NONE:      None,
+        elf.R_X86_64_64:        (word64, S_A),
+        elf.R_X86_64_PC32:      (word32, S_A_P),
+        elf.R_X86_64_PLT32:     (word32, S_A_P),
+        elf.R_X86_64_GLOB_DAT:  (word64, S_),
+        elf.R_X86_64_JUMP_SLOT: (word64, S_),
+        elf.R_X86_64_RELATIVE:  (word64, B_A),
+        elf.R_X86_64_32:        (word32, S_A),
+        elf.R_X86_64_32S:       (word32, S_A),
+        elf.R_X86_64_PC64:      (word64, S_A_P),
+        },
+    elf.EM_ARM: {
+        elf.R_ARM_NONE:       None,
+        elf.R_ARM_PC24:       (arm_branch, S_A_P),
+        elf.R_ARM_ABS32:      (word32, S_A),
+        elf.R_ARM_REL32:      (word32, S_A_P),
+        elf.R_ARM_GLOB_DAT:   (word32, S_),
+        elf.R_ARM_JUMP_SLOT:  (word32, S_),
+        elf.R_ARM_RELATIVE:   (word32, B_A),
+        elf.R_ARM_CALL:       (arm_branch, S_A_P),
+        elf.R_ARM_JUMP24:     (arm_branch, S_A_P),
+        },
+    elf.EM_AARCH64: {
+        elf.R_AARCH64_NONE:                None,
+        elf.R_AARCH64_ABS64:               (word64, S_A),
+        elf.R_AARCH64_ABS32:               (word32, S_A),
+        elf.R_AARCH64_ABS16:               (word16, S_A),
+        elf.R_AARCH64_PREL64:              (word64, S_A_P),
+        elf.R_AARCH64_PREL32:              (word32, S_A_P),
+        elf.R_AARCH64_PREL16:              (word16, S_A_P),
+        elf.R_AARCH64_ADR_PREL_PG_HI21:    (a64_adrp, page_S_A_P),
+        elf.R_AARCH64_ADR_PREL_PG_HI21_NC: (a64_adrp, page_S_A_P),
+        elf.R_AARCH64_ADD_ABS_LO12_NC:     (a64_lo12(0), S_A),
+        elf.R_AARCH64_LDST8_ABS_LO12_NC:   (a64_lo12(0), S_A),
+        elf.R_AARCH64_LDST16_ABS_LO12_NC:  (a64_lo12(1), S_A),
+        elf.R_AARCH64_LDST32_ABS_LO12_NC:  (a64_lo12(2), S_A),
+        elf.R_AARCH64_LDST64_ABS_LO12_NC:  (a64_lo12(3), S_A),
+        elf.R_AARCH64_LDST128_ABS_LO12_NC: (a64_lo12(4), S_A),
+        elf.R_AARCH64_JUMP26:              (a64_branch, S_A_P),
+        elf.R_AARCH64_CALL26:              (a64_branch, S_A_P),
+        elf.R_AARCH64_GLOB_DAT:            (word64, S_A),
+        elf.R_AARCH64_JUMP_SLOT:           (word64, S_A),
+        elf.R_AARCH64_RELATIVE:            (word64, B_A),
+        },
+    }
+
+# PE base relocations add the difference between the actual and the
+# preferred image bases to the field: the addend is the old content,
+# and B is this difference.
+def arm_imm16(insn):
+    return ((insn >> 4) & 0xf000) | (insn & 0xfff)
+def arm_set_imm16(insn, v):
+    return (insn & 0xfff0f000) | ((v & 0xf000) << 4) | (v & 0xfff)
+def thumb_imm16(insn):
+    hw1, hw2 = insn & 0xffff, insn >> 16
+    return ((hw1 & 0xf) << 12) | (((hw1 >> 10) & 1) << 11) \
+         | (((hw2 >> 12) & 7) << 8) | (hw2 & 0xff)
+def thumb_set_imm16(insn, v):
+    hw1 = (insn & 0xfbf0) | ((v >> 12) & 0xf) | (((v >> 11) & 1) << 10)
+    hw2 = ((insn >> 16) & 0x8f00) | (((v >> 8) & 7) << 12) | (v & 0xff)
+    return hw1 | (hw2 << 16)
+# MOVW/MOVT pairs
+arm_mov32 = Field(8,
+    lambda old: arm_imm16(old & 0xffffffff) | (arm_imm16(old >> 32) << 16),
+    lambda old, v: arm_set_imm16(old & 0xffffffff, v & 0xffff)
+                 | (arm_set_imm16(old >> 32, (v >> 16) & 0xffff) << 32))
+thumb_mov32 = Field(8,
+    lambda old: thumb_imm16(old & 0xffffffff)
+             | (thumb_imm16(old >> 32) << 16),
+    lambda old, v: thumb_set_imm16(old & 0xffffffff, v & 0xffff)
+                 | (thumb_set_imm16(old >> 32, (v >> 16) & 0xffff) << 32))
+# High half of an address, in a 16-bit field
+word16_high = Field(2,
+    lambda old: old << 16,
+    lambda old, v: (v >> 16) & 0xffff)
+# MIPS J/JAL: 26 bits, the address divided by 4
+mips_jmpaddr = Field(4,
+    lambda old: (old & 0x03ffffff) << 2,
+    lambda old, v: (old & 0xfc000000) | ((v >> 2) & 0x03ffffff))
+def word16_highadj(low):
+    # The low half is in the next relocation entry; it is used to know
+    # whether the high half needs a carry
+    return Field(2,
+        lambda old: (old << 16) + sign_extend(low, 16),
+        lambda old, v: ((v + 0x8000) >> 16) & 0xffff)
+
+def pe_base_relocation(machine, rtype):
+    # The field of PE base relocation of type 'rtype', None for padding
+    # entries; raises KeyError for unsupported types
+    if rtype == pe.IMAGE_REL_BASED_ABSOLUTE:
+        return None
+    if rtype == pe.IMAGE_REL_BASED_MIPS_JMPADDR and machine in (
+            pe.IMAGE_FILE_MACHINE_ARM, pe.IMAGE_FILE_MACHINE_THUMB,
+            pe.IMAGE_FILE_MACHINE_ARMNT):
+        return arm_mov32
+    if rtype == pe.IMAGE_REL_BASED_MIPS_JMPADDR and machine in (
+            pe.IMAGE_FILE_MACHINE_R3000, pe.IMAGE_FILE_MACHINE_R4000,
+            pe.IMAGE_FILE_MACHINE_R10000, pe.IMAGE_FILE_MACHINE_WCEMIPSV2,
+            pe.IMAGE_FILE_MACHINE_MIPSFPU):
+        return mips_jmpaddr
+    if rtype == pe.IMAGE_REL_BASED_THUMB_MOV32 and machine in (
+            pe.IMAGE_FILE_MACHINE_ARM, pe.IMAGE_FILE_MACHINE_THUMB,
+            pe.IMAGE_FILE_MACHINE_ARMNT):
+        return thumb_mov32
+    return {
+        pe.IMAGE_REL_BASED_HIGH:    word16_high,
+        pe.IMAGE_REL_BASED_LOW:     word16,
+        pe.IMAGE_REL_BASED_HIGHLOW: word32,
+        pe.IMAGE_REL_BASED_DIR64:   word64,
+        }[rtype]
+
+class Relocator(object):
+    """
+    Patches to apply to images
+      sex: endianess of the fields
+
+    How to use a Relocator object:
+      add(image, offset, field, formula, S, A, P, B): 'image' is an
+        object with slice access, e.g. e.virt or the content of a section,
+        and the field is at 'offset' in 'image'. A is None when the
+        addend is stored in the field.
+      apply(): applies all patches, and returns the number of pages
+        that have been written
+    """
+    def __init__(self, sex='<'):
+        self.sex = sex
+        self.structs = {}
+        for size, t in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')):
+            self.structs[size] = Struct(sex + t)
+        self.images = {}
+        self.count = 0
+    def add(self, image, offset, field, formula, S=0, A=None, P=0, B=0):
+        key = id(image)
+        if not key in self.images:
+            self.images[key] = (image, [])
+        # 'count' keeps the order of patches of a given field
+        self.images[key][1].append(
+            (offset, self.count, field, formula, S, A, P, B))
+        self.count += 1
+    def apply(self):
+        pages = 0
+        for image, patches in self.images.values():
+            patches.sort()
+            i = 0
+            while i < len(patches):
+                page = patches[i][0] // page_size
+                j = i
+                stop = patches[i][0]
+                while j < len(patches) and patches[j][0] // page_size == page:
+                    stop = max(stop, patches[j][0] + patches[j][2].size)
+                    j += 1
+                start = patches[i][0]
+                data = StrPatchwork(image[start:stop])
+                for offset, _, field, formula, S, A, P, B in patches[i:j]:
+                    st = self.structs[field.size]
+                    old, = data.unpack_from(st, offset - start)
+                    if A is None:
+                        A = field.extract(old)
+                    value = formula(S, A, P, B)
+                    data[offset - start] = st.pack(field.insert(old, value))
+                image[start:stop] = data.pack()
+                pages += 1
+                i = j
+        self.images = {}
+        return pages
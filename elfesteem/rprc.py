@@ -21,7 +21,8 @@
 
 import struct
 from elfesteem.cstruct import CData, CStruct, data_null, data_empty
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.strpatchwork import StrPatchwork, pack_regions
+from elfesteem.patterns import search_regions
 
 # Section types
 FW_RESOURCE    = 0
@@ -213,6 +214,11 @@ class Virtual(object):
         for i, s in l:
             of = i.start-start
             s.data[i.start-s.da:i.stop-s.da] = data[i.start-s.da+of:i.stop-s.da+of]
+    def search(self, patterns, start=0, end=None):
+        # Yields (address, id) for all matches of 'patterns', in one pass
+        # over each section, see elfesteem.patterns
+        return search_regions([ (s.da, s.data.pack()) for s in self.parent.sections ],
+                              patterns, start, end)
     def max_addr(self):
         return self.layout.max_addr()
 
@@ -247,13 +253,28 @@ class RPRC(object):
             self.sections.append(s)
             of += s.bytelen
     def pack(self):
-        c = StrPatchwork()
-        c[0] = self.hdr.pack()
+        return self.build_patchwork().pack()
+    def regions(self):
+        # List of (offset, produce) for the parts of the file
+        r = [ (0, self.hdr.pack) ]
         of = self.hdr.bytelen
         for s in self.sections:
-            c[of] = s.pack()
+            r.append((of, s.pack))
             of += s.bytelen
-        return c.pack()
+        return r
+    def build_patchwork(self):
+        c = StrPatchwork()
+        for offset, produce in self.regions():
+            c[offset] = produce()
+        return c
+    def pack_to(self, fileobj):
+        pack_regions(fileobj, self.regions())
+    def write(self, filename):
+        fd = open(filename, 'wb')
+        try:
+            self.pack_to(fd)
+        finally:
+            fd.close()
     def display(self):
         # Same output as 'readrprc'
         rep = [self.hdr.display()] + [s.display() for s in self.sections]
@@ -1,84 +1,379 @@
 from array import array
+from bisect import bisect_left, bisect_right
 # To be compatible with python 2 and python 3
 import sys
 import struct
+import mmap
 data_null = struct.pack("B",0)
 data_empty = struct.pack("")
+bytes_type = type(data_empty) # 'bytes' is not defined in python2.3
+
+# Objects that are used as read-only backing store, without being copied
+mapped_types = (mmap.mmap,)
+try:
+    mapped_types += (memoryview,)
+except NameError:
+    # memoryview is not available before python2.7
+    pass
+
+# When the backing store cannot be searched directly (e.g. a memoryview),
+# it is searched by chunks of this size.
+chunk_size = 0x100000
+
+def to_bytes(a):
+    if sys.version_info[0] >= 3:
+        return a.tobytes()
+    else:
+        return a.tostring()
+
+def pack_regions(fileobj, regions, paddingbyte=data_null):
+    ''' Writes to 'fileobj' the regions of a file, without building the
+        file in memory. 'regions' is a list of (offset, produce) where
+        produce() returns the bytes at 'offset'; when regions overlap,
+        the last one in the list wins, as when they are written in this
+        order in a StrPatchwork, and gaps are filled with 'paddingbyte'.
+        Only the bytes of one region, or of a group of regions that
+        overlap, are in memory at a time. '''
+    order = [ (offset, i, produce)
+              for i, (offset, produce) in enumerate(regions) ]
+    order.sort()
+    state = {'pos': 0}
+    def pad(stop):
+        while state['pos'] < stop:
+            n = min(stop - state['pos'], chunk_size)
+            fileobj.write(paddingbyte*n)
+            state['pos'] += n
+    def flush(group):
+        if not group:
+            return
+        start = min([ _[1] for _ in group ])
+        pad(start)
+        if len(group) == 1:
+            fileobj.write(group[0][2])
+            state['pos'] += len(group[0][2])
+            return
+        group.sort()
+        c = StrPatchwork(paddingbyte=paddingbyte)
+        for _, offset, data in group:
+            c[offset-start] = data
+        c.pack_to(fileobj)
+        state['pos'] += len(c)
+    group, end, length = [], 0, 0
+    for offset, i, produce in order:
+        data = produce()
+        # An empty region after the end of the file extends it
+        length = max(length, offset + len(data))
+        if not len(data):
+            continue
+        if not group or offset >= end:
+            flush(group)
+            group, end = [], 0
+        group.append((i, offset, data))
+        end = max(end, offset + len(data))
+    flush(group)
+    pad(length)
 
 class StrPatchwork(object):
+    # The original data 'base' (bytes, mmap or memoryview) is never
+    # copied nor modified: written bytes are stored in an overlay of
+    # disjoint patches, sorted by offset. Adjacent or overlapping patches
+    # are merged. Everything after the end of 'base' is in some patch.
     def __init__(self, s=data_empty, paddingbyte=data_null):
         if s is None: s = data_empty
-        if isinstance(s, StrPatchwork): s = s.pack()
-        self.s = array("B",s)
-        # cache s to avoid rebuilding str after each find
-        self.s_cache = s
         self.paddingbyte=paddingbyte
+        self.patch_start = []
+        self.patch_data = []
+        if isinstance(s, StrPatchwork):
+            self.base = s.base
+            self.length = s.length
+            self.patch_start = s.patch_start[:]
+            self.patch_data = [ array("B", _) for _ in s.patch_data ]
+            return
+        if not isinstance(s, mapped_types) and not isinstance(s, bytes_type):
+            s = to_bytes(array("B", s))
+        self.base = s
+        self.length = len(s)
+    def from_file(cls, filename, paddingbyte=data_null):
+        ''' Maps the content of a file in memory, read-only; only the
+            pages that are accessed will be loaded. '''
+        fd = open(filename, 'rb')
+        try:
+            try:
+                s = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # e.g. empty file, or file that cannot be mapped
+                s = fd.read()
+        finally:
+            fd.close()
+        return cls(s, paddingbyte=paddingbyte)
+    from_file = classmethod(from_file)
     def __str__(self):
         raise AttributeError("Use pack() instead of str()")
     def pack(self):
-        if sys.version_info[0] >= 3:
-            return self.s.tobytes()
+        return self.read(0, self.length)
+    def chunks(self):
+        # Generates the content, in offset order, by pieces of at most
+        # chunk_size bytes.
+        pos = 0
+        for i in range(len(self.patch_start)+1):
+            if i < len(self.patch_start):
+                p_start = self.patch_start[i]
+            else:
+                p_start = self.length
+            while pos < p_start:
+                end = min(p_start, pos + chunk_size)
+                yield self.read_base(pos, end)
+                pos = end
+            if i < len(self.patch_start):
+                p_data = self.patch_data[i]
+                for j in range(0, len(p_data), chunk_size):
+                    yield to_bytes(p_data[j:j+chunk_size])
+                pos += len(p_data)
+    def pack_to(self, fileobj):
+        ''' Writes the content to 'fileobj', without building it in memory '''
+        for data in self.chunks():
+            fileobj.write(data)
+
+    def read_base(self, start, stop):
+        r = self.base[start:stop]
+        if not isinstance(r, bytes_type):
+            r = r.tobytes() # memoryview
+        return r
+    def view(self, start, stop):
+        ''' Same as self[start:stop], without copy when these bytes are
+            in the base and not patched: a memoryview of the base. '''
+        if 0 <= start < stop <= min(self.length, len(self.base)):
+            i = self.first_patch(start)
+            if i == len(self.patch_start) or self.patch_start[i] >= stop:
+                try:
+                    return memoryview(self.base)[start:stop]
+                except (NameError, TypeError):
+                    # e.g. python2 mmap, or no memoryview before python2.7
+                    pass
+        return self[start:stop]
+    def first_patch(self, start):
+        # Index of the first patch that ends after 'start'
+        i = bisect_right(self.patch_start, start) - 1
+        if i < 0:
+            return 0
+        if self.patch_start[i] + len(self.patch_data[i]) <= start:
+            return i + 1
+        return i
+    def read(self, start, stop):
+        # Bytes in [start:stop], which is a subset of [0:len(self)]
+        if start >= stop:
+            return data_empty
+        res = []
+        pos = start
+        i = self.first_patch(start)
+        while i < len(self.patch_start) and self.patch_start[i] < stop:
+            p_start = self.patch_start[i]
+            p_data = self.patch_data[i]
+            i += 1
+            if pos < p_start:
+                res.append(self.read_base(pos, p_start))
+                pos = p_start
+            end = min(stop, p_start + len(p_data))
+            res.append(to_bytes(p_data[pos-p_start:end-p_start]))
+            pos = end
+        if pos < stop:
+            res.append(self.read_base(pos, stop))
+        return data_empty.join(res)
+    def patch(self, start, val):
+        stop = start + len(val)
+        if start > self.length:
+            # The gap after the end of the data is filled with padding
+            val = array("B", self.paddingbyte*(start-self.length)) + val
+            start = self.length
+        # Patches overlapping or adjacent to [start:stop] are merged
+        i = bisect_left(self.patch_start, start)
+        if i > 0 and self.patch_start[i-1] + len(self.patch_data[i-1]) >= start:
+            i -= 1
+        j = bisect_right(self.patch_start, stop)
+        if j - i == 1 and self.patch_start[i] <= start:
+            # The write starts in the patch or at its end, e.g. sequential
+            # writes: the patch is modified in place, then extended.
+            p_data = self.patch_data[i]
+            off = start - self.patch_start[i]
+            n = len(p_data) - off
+            p_data[off:off+min(n, len(val))] = val[:n]
+            if n < len(val):
+                p_data.extend(val[n:])
+                if self.length < stop:
+                    self.length = stop
+            return
+        if j > i:
+            m_start = min(start, self.patch_start[i])
+            m_stop = max(stop, self.patch_start[j-1]+len(self.patch_data[j-1]))
         else:
-            return self.s.tostring()
+            m_start, m_stop = start, stop
+        data = array("B", self.read(m_start, min(m_stop, self.length)))
+        data.extend(array("B", self.paddingbyte*(m_stop-m_start-len(data))))
+        data[start-m_start:stop-m_start] = val
+        self.patch_start[i:j] = [m_start]
+        self.patch_data[i:j] = [data]
+        if self.length < m_stop:
+            self.length = m_stop
 
     def __getitem__(self, item):
-        s = self.s
+        l = self.length
         if type(item) is slice:
-            r = s[item]
+            start, stop, step = item.indices(l)
+            if step == 1:
+                r = self.read(start, stop)
+            else:
+                r = self.read(0, l)[item]
             end = item.stop
-            if end != None and len(s) < end:
+            if end != None and l < end:
                 if item.step is not None:
                     TODO
                 elif len(r) > 0:
                     # We go beyond the end of 's'
-                    r.extend(array("B",self.paddingbyte*(end-len(s))))
+                    r += self.paddingbyte*(end-l)
                 else:
                     # We are entirely after the end of 's'
                     start = item.start
                     if start is None: start = 0
-                    r = array("B",self.paddingbyte*(end-start))
-        else:
-            if item > len(s):
-                return self.paddingbyte
-            else:
-                r = array("B",[s[item]])
-        if sys.version_info[0] >= 3:
-            return r.tobytes()
-        else:
-            return r.tostring()
+                    r = self.paddingbyte*(end-start)
+            return r
+        if item > l:
+            return self.paddingbyte
+        if item < 0: item += l
+        if not 0 <= item < l:
+            raise IndexError("StrPatchwork index out of range")
+        return self.read(item, item+1)
+    # Incremented at each write, e.g. to know if a cache is stale
+    version = 0
     def __setitem__(self, item, val):
         if val is None:
             return
+        self.version += 1
         if sys.version_info[0] >= 3 and type(val) == str:
             val = val.encode(encoding="latin1")
         val = array("B",val)
         if type(item) is not slice:
             item = slice(item, item+len(val))
+        if item.step is None and item.start is not None \
+                and item.start >= 0 and item.stop == item.start+len(val):
+            self.patch(item.start, val)
+            return
+        # Unusual slice, e.g. with a step: apply it on a copy of the data
+        s = array("B", self.pack())
         end = item.stop
-        l = len(self.s)
+        l = len(s)
         if l < end:
-            self.s.extend(array("B", self.paddingbyte*(end-l)))
-        self.s[item] = val
-        self.s_cache = None
+            s.extend(array("B", self.paddingbyte*(end-l)))
+        s[item] = val
+        self.base = to_bytes(s)
+        self.length = len(s)
+        self.patch_start = []
+        self.patch_data = []
 
 
+    def unpack_from(self, st, offset):
+        # Same as st.unpack(self[offset:offset+st.size]), without copy
+        # when these bytes are not patched.
+        stop = offset + st.size
+        if 0 <= offset and stop <= len(self.base):
+            i = self.first_patch(offset)
+            if i == len(self.patch_start) or self.patch_start[i] >= stop:
+                return st.unpack_from(self.base, offset)
+        data = self[offset:stop]
+        return st.unpack(data + data_null*(st.size-len(data)))
+
     def __repr__(self):
         return "<Patchwork %r>" % self.pack()
     def __len__(self):
-        return len(self.s)
+        return self.length
     def __contains__(self, val):
-        return val in self.pack()
+        return self.find(val) != -1
     def __iadd__(self, other):
-        self.s.extend(array("B", other))
+        self[self.length] = other
         return self
 
+    # find() and rfind() search directly in 'base' between the patches;
+    # only the neighbourhood of each patch in [start:end] is rebuilt.
+    def search_args(self, pattern, args):
+        if not isinstance(pattern, bytes_type):
+            pattern = struct.pack("B", pattern)
+        if len(args) > 0 and args[0] is not None and args[0] > self.length:
+            return pattern, None, None
+        args = tuple(args) + (None, None)
+        start, end, _ = slice(args[0], args[1]).indices(self.length)
+        return pattern, start, end
+    def find_base(self, pattern, start, end):
+        if hasattr(self.base, 'find'):
+            return self.base.find(pattern, start, end)
+        while start + len(pattern) <= end:
+            stop = min(end, start + chunk_size + len(pattern) - 1)
+            r = self.read_base(start, stop).find(pattern)
+            if r != -1:
+                return start + r
+            start = stop - len(pattern) + 1
+        return -1
+    def rfind_base(self, pattern, start, end):
+        if hasattr(self.base, 'rfind'):
+            return self.base.rfind(pattern, start, end)
+        while start + len(pattern) <= end:
+            first = max(start, end - chunk_size - len(pattern) + 1)
+            r = self.read_base(first, end).rfind(pattern)
+            if r != -1:
+                return first + r
+            end = first + len(pattern) - 1
+        return -1
     def find(self, pattern, *args):
-        if not self.s_cache:
-            self.s_cache = self.pack()
-        return self.s_cache.find(pattern, *args)
-
+        pattern, start, end = self.search_args(pattern, args)
+        if start is None or start > end:
+            return -1
+        if len(pattern) == 0:
+            return start
+        pos = start
+        i = self.first_patch(start)
+        while pos < end:
+            if i < len(self.patch_start):
+                p_start = self.patch_start[i]
+                p_stop = p_start + len(self.patch_data[i])
+            else:
+                p_start = p_stop = end
+            gap_end = min(p_start, end)
+            if pos < gap_end:
+                r = self.find_base(pattern, pos, gap_end)
+                if r != -1:
+                    return r
+            if p_start >= end:
+                break
+            w_start = max(start, p_start - len(pattern) + 1)
+            r = self.read(w_start, min(end, p_stop + len(pattern) - 1)).find(pattern)
+            if r != -1:
+                return w_start + r
+            pos = p_stop
+            i += 1
+        return -1
     def rfind(self, pattern, *args):
-        if not self.s_cache:
-            self.s_cache = self.pack()
-        return self.s_cache.rfind(pattern, *args)
-
+        pattern, start, end = self.search_args(pattern, args)
+        if start is None or start > end:
+            return -1
+        if len(pattern) == 0:
+            return end
+        pos = end
+        i = bisect_left(self.patch_start, end) - 1
+        while pos > start:
+            if i >= 0:
+                p_start = self.patch_start[i]
+                p_stop = p_start + len(self.patch_data[i])
+            else:
+                p_start = p_stop = start
+            gap_start = max(p_stop, start)
+            if gap_start < pos:
+                r = self.rfind_base(pattern, gap_start, pos)
+                if r != -1:
+                    return r
+            if p_stop <= start:
+                break
+            w_start = max(start, p_start - len(pattern) + 1)
+            r = self.read(w_start, min(end, p_stop + len(pattern) - 1)).rfind(pattern)
+            if r != -1:
+                return w_start + r
+            pos = p_start
+            i -= 1
+        return -1
@@ -95,7 +95,9 @@ if __name__ == "__main__":
             'macho_manipulation',
             'rprc_manipulation',
             'minidump_manipulation',
+            'strpatchwork',
             'intervals',
+            'relocation',
             ):
         module = import_by_name('test_' + name)
         print_colored.bold(name)
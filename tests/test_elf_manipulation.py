@@ -7,6 +7,8 @@ from test_all import run_tests, assertion, hashlib, open_read
 from elfesteem.strpatchwork import StrPatchwork
 from elfesteem.elf_init import ELF, log
 from elfesteem import elf
+from elfesteem.columns import Columns
+from elfesteem.image import LoadedImage, PROT_READ, PROT_WRITE, PROT_EXEC
 
 import struct
 
@@ -71,7 +73,7 @@ def test_ELF_small32(assertion):
               hashlib.md5(d).hexdigest(),
               'Display Program Headers')
     d = repr(e.sh).encode('latin1')
-    assertion('ddf01165114eb70bd27910e4c5b03c09',
+    assertion('fd99caf2c2a7b579bb12986a91e87c99',
               hashlib.md5(d).hexdigest(),
               'Display Section Headers (repr)')
     d = e.sh.readelf_display().encode('latin1')
@@ -172,6 +174,355 @@ def test_ELF_small64(assertion):
     assertion('650cf3f99117d39d63fae73232e09acf',
               hashlib.md5(d).hexdigest(),
               'Display Reloc Table (elf64)')
+    # Relocation types that are not in the table of the machine
+    e = ELF(open_read(__dir__+'/binary_input/elf64_small.out'))
+    e.Ehdr.machine = elf.EM_AARCH64
+    rel = e.getsectionbyname('.rela.dyn').reltab[0]
+    rel.info = (rel.info & ~0xffffffff) | 311
+    assertion('311 aka. 0x137', rel.type17,
+              'Display unknown AArch64 relocation type')
+    rel.info = (rel.info & ~0xffffffff) | elf.R_AARCH64_RELATIVE
+    assertion('R_AARCH64_RELATIV', rel.type17,
+              'Display AArch64 relocation type')
+
+def test_ELF_columns(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf64_small.out'))
+    symtab = e.getsectionbyname('.symtab')
+    funcs = [ _ for _ in symtab.symtab
+              if _.info&0xf == elf.STT_FUNC and 0x400400 <= _.value < 0x400600 ]
+    rels = e.getsectionbyname('.rela.plt')
+    slots = [ _ for _ in rels.reltab if _.type == elf.R_X86_64_JUMP_SLOT ]
+    dynamic = e.getsectionbyname('.dynamic')
+    for use_numpy in (True, False):
+        c = symtab.columns(use_numpy=use_numpy)
+        assertion(len(symtab.symtab), len(c),
+                  'Number of symbols in columns (numpy=%s)' % use_numpy)
+        assertion([_.value for _ in symtab.symtab], list(c['value']),
+                  'Column of symbol values (numpy=%s)' % use_numpy)
+        assertion([symtab.symtab.index(_) for _ in funcs],
+                  c.select(type=elf.STT_FUNC, value=(0x400400, 0x400600)),
+                  'Select functions in address range (numpy=%s)' % use_numpy)
+        c = rels.columns(use_numpy=use_numpy)
+        assertion([rels.reltab.index(_) for _ in slots],
+                  c.select(type=elf.R_X86_64_JUMP_SLOT),
+                  'Select JUMP_SLOT relocations (numpy=%s)' % use_numpy)
+        c = dynamic.columns(use_numpy=use_numpy)
+        assertion([_.type for _ in dynamic.dyntab], list(c['type']),
+                  'Column of dynamic types (numpy=%s)' % use_numpy)
+    assertion(slots, rels.select(type=elf.R_X86_64_JUMP_SLOT),
+              'Select JUMP_SLOT relocations')
+    assertion(funcs, symtab.select(type=elf.STT_FUNC,
+                                   value=(0x400400, 0x400600)),
+              'Select functions in address range')
+    assertion(True, len(funcs) > 0 and len(slots) > 0,
+              'Non-empty selections')
+    needed = [ _ for _ in dynamic.dyntab if _.type == elf.DT_NEEDED ]
+    assertion((True, needed), (len(needed) > 0,
+              dynamic.select(type=elf.DT_NEEDED)),
+              'Select DT_NEEDED entries')
+    # The columns follow the modifications of the content
+    c = rels.columns()
+    rels.content[0] = struct.pack("<Q", 0x1234)
+    assertion((False, [0]), (c is rels.columns(),
+              rels.columns().select(offset=0x1234)),
+              'Columns after a direct write to the content')
+    assertion(True, rels.columns() is rels.columns(),
+              'Columns kept when the content is not modified')
+    # MIPS64 relocations have three types, 'type' is the first one
+    data = struct.pack("<QIBBBB", 0x10, 3, 0, 0, 0, 18)
+    c = Columns(elf.Rel64MIPS, rels, data)
+    assertion(([18], [3]), (list(c['type']), list(c['sym_idx'])),
+              'Columns of MIPS64 relocations')
+
+def test_ELF_compact_records(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf64_small.out'))
+    sym = e.getsectionbyname('.symtab').symtab[-1]
+    rel = e.getsectionbyname('.rela.dyn').reltab[0]
+    dyn = e.getsectionbyname('.dynamic').dyntab[0]
+    assertion([False, False, False],
+              [hasattr(_, '__dict__') for _ in (sym, rel, dyn)],
+              'Symbols, relocations and dynamic entries have no __dict__')
+    data = sym.pack()
+    values = [ sym.getf(_) for _ in sym._names ]
+    for f, v in zip(sym._names, values):
+        sym.setf(f, v)
+    assertion((data, values),
+              (sym.pack(), [ getattr(sym, _) for _ in sym._names ]),
+              'getf/setf/pack of a symbol unchanged')
+    sym.setf('value', sym.value + 1)
+    assertion(True, data != sym.pack(),
+              'setf of a symbol changes its packed value')
+
+def test_ELF_set_relocs(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf64_small.out'))
+    rels = e.getsectionbyname('.rela.plt')
+    data = rels.content.pack()
+    relocs = [ (_.offset, _.type, _.sym_idx, _.addend) for _ in rels.reltab ]
+    for use_numpy in (True, False):
+        rels.set_relocs(relocs, use_numpy=use_numpy)
+        assertion((data, True), (rels.content.pack(), '_lazy' in rels.__dict__),
+                  'Relocations encoded at once (numpy=%s)' % use_numpy)
+    c = rels.columns()
+    rels.set_relocs({'offset': c['offset'], 'info': c['info']})
+    assertion([_[:3]+(0,) for _ in relocs],
+              [ (_.offset, _.type, _.sym_idx, _.addend) for _ in rels.reltab ],
+              'Relocations encoded from columns')
+    relocs = [ (0x601000+8*i, elf.R_X86_64_RELATIVE, 0, i) for i in range(5) ]
+    rels.set_relocs(relocs)
+    assertion((120, 5), (rels.sh.size, len(rels.reltab)),
+              'Relocations replaced')
+    assertion([3, 4], [_.addend for _ in rels.relocs_at(0x60101c, 8)],
+              'Relocations patching an address range')
+    assertion([], rels.relocs_at(0x601028),
+              'No relocation patching an address')
+
+def test_ELF_lazy(assertion):
+    raw = open_read(__dir__+'/binary_input/elf64_small.out')
+    e = ELF(raw)
+    parsed = lambda: [ _.sh.name for _ in e.sh if not '_lazy' in _.__dict__ ]
+    assertion([], parsed(),
+              'No section is parsed when opening an ELF')
+    dynsym = e.getsectionbyname('.dynsym')
+    assertion('__stack_chk_fail', dynsym[2].name,
+              'Lazy parsing of a symbol table')
+    assertion(['', '.dynsym', '.dynstr'], parsed(),
+              'Lazy parsing of a symbol table and its string table')
+    e.sh.load()
+    assertion([ _.sh.name for _ in e.sh ], parsed(),
+              'Parsing of all sections')
+    assertion(hashlib.md5(raw).hexdigest(), hashlib.md5(e.pack()).hexdigest(),
+              'Packing after lazy parsing')
+    e = ELF(raw)
+    dynsym = e.getsectionbyname('.dynsym')
+    dynsym.content = StrPatchwork(raw[dynsym.sh.offset:dynsym.sh.offset+48])
+    assertion((2, 48), (len(dynsym.symtab), len(dynsym.content)),
+              'Content written before lazy parsing')
+
+def test_ELF_vad_index(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    def brute_force(ad):
+        return ([ _ for _ in e.sh if _.addr <= ad < _.addr+_.size ],
+                [ _ for _ in e.ph if _.addr <= ad < _.addr+_.size ])
+    addresses = [ b+d for _ in list(e.sh)+list(e.ph)
+                      for b in (_.addr, _.addr+_.size) for d in (-1, 0, 1) ]
+    assertion([ brute_force(_) for _ in addresses ],
+              [ e.vad_index().find(_) for _ in addresses ],
+              'Index of virtual addresses')
+    text = e.getsectionbyname('.text')
+    addr = text.sh.addr
+    text.sh.addr = 0x10
+    assertion(text, e.getsectionbyvad(0x12),
+              'Index of virtual addresses after moving a section')
+    text.sh.addr = addr
+    assertion(text, e.getsectionbyvad(addr),
+              'Index of virtual addresses after moving back a section')
+    i = e.sh.shlist.index(text)
+    new = text.__class__(e.sh, addr=0x10, size=8)
+    e.sh[i] = new
+    assertion((new, []), (e.getsectionbyvad(0x12), e.vad_index().find(addr)[0]),
+              'Index of virtual addresses after replacing a section')
+    e.sh[i] = text
+    assertion(max([ _.addr+_.size for _ in list(e.sh)+list(e.ph) ]),
+              e.virt.max_addr(),
+              'Maximal virtual address')
+
+def test_ELF_section_names(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    text = e.getsectionbyname('.text')
+    init = e.getsectionbyname('.init')
+    assertion([text], e.getsectionsbyname('.text'),
+              'Get sections by name')
+    text.sh.name_idx = init.sh.name_idx
+    assertion(([], [init, text]),
+              (e.getsectionsbyname('.text'), e.getsectionsbyname('.init')),
+              'Get sections by name after renaming')
+
+def test_ELF_section_overlaps(assertion):
+    global log_history
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    assertion([], e.section_overlaps(),
+              'No overlapping sections')
+    text = e.getsectionbyname('.text')
+    init = e.getsectionbyname('.init')
+    plt  = e.getsectionbyname('.plt')
+    text.sh.offset = init.sh.offset + 4
+    assertion([('offset', init, text), ('offset', plt, text)],
+              e.section_overlaps(),
+              'Overlapping sections')
+    d = e.pack()
+    ELF(d, check_coherency=False)
+    assertion([], log_history,
+              'Coherency of sections not checked')
+    ELF(d)
+    assertion([('error', ('Section offset overlap for [%r] [%r]' % (init, text),), {})],
+              log_history,
+              'Coherency of sections checked')
+    log_history = []
+
+def test_ELF_hash(assertion):
+    from elfesteem.elf_init import elf_hash, gnu_hash, HashSection
+    assertion((0x077905a6, 0x156b2bb8),
+              (elf_hash('printf'.encode('latin1')),
+               gnu_hash('printf'.encode('latin1'))),
+              'Hash functions')
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    dynsym = e.getsectionbyname('.dynsym')
+    assertion(e.getsectionbyname('.gnu.hash'), dynsym.hash_section(),
+              'GNU hash section of .dynsym')
+    assertion(True, e.link_index() is e.link_index(),
+              'Links of sections are indexed once')
+    stdin = dynsym.lookup('stdin')
+    assertion((0x0804a01c, True), (stdin.value, '_lazy' in dynsym.__dict__),
+              'Lookup with GNU hash, without parsing .dynsym')
+    assertion((None, None), (dynsym.lookup('puts'), dynsym.lookup('nothere')),
+              'Lookup of undefined symbols with GNU hash')
+    # SysV hash table with 3 buckets, replacing the GNU hash table
+    nchain = len(dynsym)
+    buckets, chains = [0, 0, 0], [0] * nchain
+    for i in range(1, nchain):
+        h = elf_hash(dynsym[i].name.encode('latin1')) % 3
+        buckets[h], chains[i] = i, buckets[h]
+    h = HashSection(e.sh, link=e.sh.shlist.index(dynsym))
+    h.content = StrPatchwork(struct.pack("<%dI" % (2+3+nchain),
+                                         3, nchain, *(buckets+chains)))
+    h.parse_content()
+    e.sh.append(h)
+    e.getsectionbyname('.gnu.hash').sh.link = 0
+    assertion(h, dynsym.hash_section(),
+              'SysV hash section of .dynsym')
+    assertion(dynsym['stdin'], dynsym.lookup('stdin'),
+              'Lookup with SysV hash')
+    assertion(None, dynsym.lookup('puts'),
+              'Lookup of undefined symbols with SysV hash')
+
+def test_ELF_strtab(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    st = e.getsectionbyname('.strtab')
+    assertion((536, 537, None),
+              (st.find_name('main'), st.find_name('ain'), st.find_name('nothere')),
+              'Find names and suffixes in string table')
+    assertion([567, 568, 536, 575],
+              st.add_names(['_start_new', 'start_new', 'main', 'ew']),
+              'Add names to string table, with tail merging')
+    assertion((578, 578), (len(st.content), st.sh.size),
+              'String table grown once')
+    assertion(578, st.add_name('_start_new2'),
+              'Add one name to string table')
+    assertion(([537, 568], 590), (st.add_names(['ain', 'start_new']),
+                                  len(st.content)),
+              'Add suffixes of names already in string table')
+    e = ELF(e.pack())
+    st = e.getsectionbyname('.strtab')
+    assertion(('start_new', 568),
+              (st.get_name(568), st.find_name('start_new')),
+              'String table after packing')
+
+def test_ELF_relocate(assertion):
+    global log_history
+    e = ELF(open_read(__dir__+'/binary_input/elf_cpp.o'))
+    for i, s in enumerate(e.sh):
+        if s.sh.flags & elf.SHF_ALLOC:
+            s.sh.addr = 0x10000 * i
+    assertion(10, e.relocate(),
+              'Relocation of an object file')
+    text = e.getsectionbyname('.text')
+    assertion((0x60000, 0x4ffe8, 0x3ffdb),
+              struct.unpack('<3I', text.content[4:8] + text.content[0x14:0x18]
+                                   + text.content[0x21:0x25]),
+              'Relocated .text of an object file')
+    e = ELF(open_read(__dir__+'/binary_input/elf64_small.out'))
+    slot = e.getsectionbyname('.rela.plt').reltab[0]
+    class Image(object):
+        # Memory, by pages
+        def __init__(self):
+            self.pages = {}
+        def __getitem__(self, item):
+            page = self.pages.get(item.start & ~0xfff, StrPatchwork())
+            return page[item.start & 0xfff:item.stop - (item.start & ~0xfff)]
+        def __setitem__(self, item, data):
+            page = self.pages.setdefault(item.start & ~0xfff, StrPatchwork())
+            page[item.start & 0xfff] = data
+    image = Image()
+    assertion(4, e.relocate(base=0x10000000, image=image,
+                  symbols={'puts': 0x4242, '__libc_start_main': 0x4343}),
+              'Relocation of an executable in an image')
+    assertion([('warn', ('%d relocations of type %d not applied',
+                         1, elf.R_X86_64_COPY), {}),
+               ('warn', ('%d relocations to undefined symbols not applied',
+                         2), {})],
+              sorted(log_history),
+              'Relocations not applied (logs)')
+    log_history = []
+    assertion(0x4242, struct.unpack('<Q', image[0x10000000+slot.offset:
+                                                0x10000000+slot.offset+8])[0],
+              'Relocated JUMP_SLOT in an image')
+    # One summary per unsupported type, whatever the symbols
+    rels = e.getsectionbyname('.rela.plt')
+    rels.set_relocs([ (_.offset, elf.R_X86_64_COPY, _.sym_idx, 0)
+                      for _ in rels.reltab[:3] ])
+    e.relocate(base=0x10000000, image=image)
+    assertion([('warn', ('%d relocations of type %d not applied',
+                         4, elf.R_X86_64_COPY), {})],
+              log_history,
+              'Relocations not applied, by type (logs)')
+    log_history = []
+
+def test_ELF_loaded_image(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    image = LoadedImage(e)
+    assertion([(0x8048000, 0x804b000)], image.regions(),
+              'Loaded image of an executable')
+    assertion((PROT_READ|PROT_EXEC, PROT_READ|PROT_WRITE),
+              (image.prot(0x8048000), image.prot(0x804a000)),
+              'Protections of the pages of the image')
+    assertion(True, '_lazy' in e.getsectionbyname('.text').__dict__,
+              'Sections are not loaded to map the image')
+    text = e.getsectionbyname('.text')
+    assertion(text.content[0:16], image[text.sh.addr:text.sh.addr+16],
+              'Read .text in the image')
+    bss = e.getsectionbyname('.bss')
+    assertion(struct.pack('4B', 0, 0, 0, 0), image[bss.sh.addr:bss.sh.addr+4],
+              'Read .bss in the image')
+    e = ELF(open_read(__dir__+'/binary_input/elf_cpp.o'))
+    for i, s in enumerate(e.sh):
+        if s.sh.flags & elf.SHF_ALLOC:
+            s.sh.addr = 0x10000 * i
+    image = LoadedImage(e)
+    assertion(10, e.relocate(image=image),
+              'Relocation of an object file in a loaded image')
+    text = e.getsectionbyname('.text')
+    assertion(0x60000, struct.unpack('<I', image[text.sh.addr+4:
+                                                 text.sh.addr+8])[0],
+              'Relocated .text in a loaded image')
+    image = LoadedImage(page_size=0x10)
+    image.map(0x100, 0x10, struct.pack('B', 1))
+    buf = image._data[0]
+    image.map(0x110, 0x10, struct.pack('B', 2), PROT_WRITE)
+    image.map(0x120, 0x10, struct.pack('B', 3))
+    assertion((True, [(0x100, 0x130)], PROT_WRITE),
+              (buf is image._data[0], image.regions(), image.prot(0x110)),
+              'Adjacent mappings extend the region in place')
+    image.map(0xf0, 0x10, struct.pack('B', 4))
+    assertion(struct.pack('5B', 4, 0, 1, 2, 3),
+              image[0xf0:0xf1] + image[0xff:0x101] + image[0x110:0x111]
+              + image[0x120:0x121],
+              'Mapping before a region')
+
+def test_ELF_search(assertion):
+    e = ELF(open_read(__dir__+'/binary_input/elf_small.out'))
+    res = list(e.virt.search(['main'.encode('latin1'),
+                              (0x55, 0x89, 0xe5),
+                              'ain'.encode('latin1')]))
+    assertion([(0x80482a8, 0), (0x80482a9, 2), (0x8048400, 1),
+               (0x8048460, 1), (0x8048484, 1), (0x8048560, 1)], res,
+              'Search many patterns')
+    # The segments are searched in the file, and in the modified sections
+    e = ELF(StrPatchwork.from_file(__dir__+'/binary_input/elf_small.out'))
+    text = e.getsectionbyname('.text')
+    text.content[0x8048400-text.sh.addr] = struct.pack("3B", 0, 0, 0)
+    assertion([(0x8048460, 0), (0x8048484, 0), (0x8048560, 0)],
+              list(e.virt.search([(0x55, 0x89, 0xe5)])),
+              'Search in a modified section')
 
 def test_ELF_group(assertion):
     elf_group = open_read(__dir__+'/binary_input/elf_cpp.o')
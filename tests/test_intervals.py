@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 
 from test_all import run_tests, assertion
-from elfesteem.intervals import Intervals
+from elfesteem.intervals import Intervals, overlaps, first_overlaps
 
 def test_intervals(assertion):
     i = Intervals()
@@ -60,6 +60,16 @@ def test_intervals(assertion):
     assertion([_ for _ in i], [10, 11, 12, 13, 27, 28, 29],
               'Enumerate [10:14] [27:30]')
 
+def test_overlaps(assertion):
+    ranges = [ (0, 10), (5, 8), None, (5, 6), (10, 20), (12, 12), (15, 30) ]
+    assertion([(0, 1), (0, 3), (4, 5), (4, 6)], overlaps(ranges),
+              'Overlapping ranges')
+    assertion([1, 0, None, 0, 5, 4, 4], first_overlaps(ranges),
+              'First overlapping range')
+    ranges = [ (0, 100) ] * 100 + [ (i, i+1) for i in range(1, 100) ]
+    assertion([ 100 ] * 100 + [ 0 ] * 99, first_overlaps(ranges),
+              'First overlapping range, many overlaps')
+
 def run_test(assertion):
     for name, value in dict(globals()).items():
         if name.startswith('test_'):
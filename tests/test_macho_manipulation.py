@@ -8,6 +8,7 @@ from test_all import run_tests, assertion, hashlib, open_read
 import struct
 from elfesteem.macho import MACHO, log
 from elfesteem import macho
+from elfesteem.image import LoadedImage
 
 # We want to be able to verify warnings in non-regression test
 log_history = []
@@ -255,6 +256,51 @@ def test_MACHO_macho64_exe(assertion):
               hashlib.md5(d).hexdigest(),
               'Packing after reading 64-bit Mach-O executable')
 
+def test_MACHO_section_names(assertion):
+    e = MACHO(open_read(__dir__+'macho_64.out'))
+    s = e.getsectionbyname('__TEXT,__text')
+    assertion('__TEXT,__text', s.sh.name,
+              'Get section by name')
+    s.sh.sectname = '__code'
+    assertion((None, s),
+              (e.getsectionbyname('__TEXT,__text'),
+               e.getsectionbyname('__TEXT,__code')),
+              'Get section by name after renaming')
+
+def test_MACHO_strtab(assertion):
+    e = MACHO(open_read(__dir__+'macho_64.out'))
+    st = e.sect[[_.__class__.__name__ for _ in e.sect].index('StringTable')]
+    assertion((66, 68), (st.find_name('_main'), st.find_name('ain')),
+              'Find names and suffixes in string table')
+    assertion([66, 112, 113], st.add_names(['_main', '_foo', 'foo']),
+              'Add names to string table, with tail merging')
+    assertion((117, 573), (st.size, e.load[3].filesize),
+              'String table and __LINKEDIT grown')
+    assertion(([68, 114], 117), (st.add_names(['ain', 'oo']), st.size),
+              'Add suffixes of names already in string table')
+    e = MACHO(e.pack())
+    st = e.sect[[_.__class__.__name__ for _ in e.sect].index('StringTable')]
+    assertion('foo', st.get_name(113),
+              'String table after packing')
+
+def test_MACHO_loaded_image(assertion):
+    e = MACHO(open_read(__dir__+'macho_64.out'))
+    image = LoadedImage(e)
+    assertion([(0x100000000, 0x100003000)], image.regions(),
+              'Loaded image of a Mach-O, without __PAGEZERO')
+    s = e.getsectionbyname('__TEXT,__stubs')
+    assertion(e.content[s.sh.offset:s.sh.offset+s.sh.size],
+              image[s.sh.addr:s.sh.addr+s.sh.size],
+              'Read stubs in the image')
+    image[0x100000f00] = struct.pack('4s', 'toto'.encode('latin1'))
+    assertion('toto', image[0x100000f00:0x100000f04].decode('latin1'),
+              'Write in the image')
+    try:
+        image[0:4]
+        assertion(0, 1, 'IndexError expected for non-mapped addresses')
+    except IndexError:
+        pass
+
 def test_MACHO_fat(assertion):
     global log_history
     macho_fat = open_read(__dir__+'macho_fat.out')
@@ -4,9 +4,14 @@ import os
 __dir__ = os.path.dirname(__file__)
 
 from test_all import run_tests, assertion, hashlib, open_read
-from elfesteem.pe_init import log, PE, COFF, Coff
-from elfesteem.strpatchwork import StrPatchwork
+from elfesteem.pe_init import log, PE, COFF, Coff, Checksum
+from elfesteem.strpatchwork import StrPatchwork, data_null
 from elfesteem import pe
+from elfesteem.image import LoadedImage, PROT_READ, PROT_EXEC
+from elfesteem.patterns import Patterns, signature
+import binascii
+from io import BytesIO
+import re
 import struct
 
 # We want to be able to verify warnings in non-regression test
@@ -266,6 +271,325 @@ def test_PE_manipulate(assertion):
               hashlib.md5(d).hexdigest(),
               'Adding imports, no specified section')
 
+def test_PE_section_index(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    def brute_force(rva, off):
+        sh = [ _ for _ in e.SHList if _.vaddr <= rva < _.vaddr+_.size ]
+        sh.append(None)
+        so = [ _ for _ in e.SHList if _.scnptr <= off < _.scnptr+_.rsize ]
+        so.append(None)
+        return sh[0], so[0]
+    positions = [ b+d for _ in e.SHList
+                      for b in (_.vaddr, _.vaddr+_.size,
+                                _.scnptr, _.scnptr+_.rsize)
+                      for d in (-1, 0, 1) ]
+    assertion([ brute_force(_, _) for _ in positions ],
+              [ (e.getsectionbyrva(_), e.getsectionbyoff(_))
+                for _ in positions ],
+              'Indexes of sections by RVA and by offset')
+    s = e.SHList[1]
+    vaddr = s.vaddr
+    s.vaddr = 0x80000
+    assertion(s, e.getsectionbyrva(0x80010),
+              'Index of sections by RVA after moving a section')
+    s.vaddr = vaddr
+    s = e.SHList.add_section(name = 'new', rawsize = 0x1000)
+    assertion(s.scnptr+0x10, e.rva2off(s.vaddr+0x10),
+              'Index of sections by RVA after adding a section')
+    assertion(s.vaddr+0x10, e.off2rva(s.scnptr+0x10),
+              'Index of sections by offset after adding a section')
+
+def test_PE_section_names(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    s = e.getsectionbyname('.rdata')
+    assertion(e.SHList[2], s,
+              'Get section by name')
+    s.name_data = struct.pack("8s", '.rodata'.encode('latin1'))
+    assertion((None, s),
+              (e.getsectionbyname('.rdata'), e.getsectionbyname('.rodata')),
+              'Get section by name after renaming')
+    s = e.SHList.add_section(name = 'new', rawsize = 0x1000)
+    assertion(s, e.getsectionbyname('new'),
+              'Get section by name after adding a section')
+
+def test_PE_strtab(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_mingw.exe'))
+    st = e.SymbolStrings
+    name = '___mingw_CRTStartup'.encode('latin1')
+    assertion(30, st.getby_name(name),
+              'Find names in COFF string table')
+    assertion([1951, 1952, 30],
+              st.add_names([n.encode('latin1') for n in ('_new', 'new',
+                                                         '___mingw_CRTStartup')]),
+              'Add names to COFF string table, with tail merging')
+    assertion('new'.encode('latin1'), st.getby_offset(1952),
+              'Name at the offset of a suffix')
+    e = PE(e.pack())
+    assertion(1951, e.SymbolStrings.getby_name('_new'.encode('latin1')),
+              'COFF string table after packing')
+
+def test_PE_relocate(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    assertion(385, e.relocate(e.NThdr.ImageBase + 0x100000),
+              'Base relocations applied')
+    assertion((0x10100000, 0x1011a004),
+              (e.NThdr.ImageBase, struct.unpack('<I', e.drva[0x11ae1:0x11ae5])[0]),
+              'Relocated PE')
+    assertion('2083dd82643bbee9dd889cfb4d1e970b',
+              hashlib.md5(e.pack()).hexdigest(),
+              'Packing relocated PE')
+
+def test_PE_loaded_image(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    base = e.NThdr.ImageBase + 0x100000
+    image = LoadedImage(e, base=base)
+    assertion([(0x10100000, 0x1011f000)], image.regions(),
+              'Loaded image of a DLL')
+    assertion((PROT_READ, PROT_READ|PROT_EXEC),
+              (image.prot(base), image.prot(base+e.SHList[1].vaddr)),
+              'Protections of the pages of the image')
+    assertion(385, e.relocate(base, image=image),
+              'Base relocations applied to a loaded image')
+    assertion(0x1011a004, struct.unpack('<I', image[base+0x11ae1:
+                                                    base+0x11ae5])[0],
+              'Relocated loaded image')
+    assertion('19028e1a1bde785fb4a58aeacf56007b',
+              hashlib.md5(e.pack()).hexdigest(),
+              'File not modified by the relocation of the image')
+
+def test_PE_search(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_mingw.exe'))
+    patterns = Patterns({
+        'prologue': signature('55 89 e5 ?? ec'),
+        'msvcrt':   'msvcrt.dll'.encode('latin1'),
+        'call':     re.compile('\\xe8...\\x00'.encode('latin1'), re.DOTALL),
+        })
+    res = list(e.virt.search(patterns))
+    assertion((59, 0x405270),
+              (len(res), [a for a, p in res if p == 'msvcrt'][0]),
+              'Search many patterns')
+    assertion([(0x40121c, 'prologue'), (0x401230, 'prologue')],
+              [m for m in res if m[1] == 'prologue'][:2],
+              'Search signature with wildcard')
+    assertion([0x40102a, 0x401089, 0x4010b2, 0x4010c5, 0x4010db, 0x401101,
+               0x401112],
+              [a for a, p in e.virt.search(patterns, 0x401000, 0x401120)],
+              'Search in an address range')
+    patterns = Patterns([
+        signature('61 ?? 63'),
+        re.compile('b.'.encode('latin1'), re.DOTALL),
+        re.compile('c.'.encode('latin1')),
+        re.compile('(c)\\1'.encode('latin1')),
+        ])
+    res = patterns.search('abc\nabcc'.encode('latin1'), 0x100)
+    for first in res:
+        break
+    assertion(((0x100, 0), 2),
+              (first, len(patterns.prefilters)),
+              'Matches yielded before the end of the search')
+    assertion([(0x101, 1), (0x104, 0), (0x105, 1), (0x106, 2), (0x106, 3)],
+              list(res),
+              'Search regular expressions with different flags and groups')
+
+def test_PE_drva_write(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    idata = e.content[0x7a00:0x7a08]
+    # .data has 0x200 bytes in the file, and 0x590 in memory
+    e.drva[0x1a1fe:0x1a206] = struct.pack('<Q', 0x0807060504030201)
+    assertion((True, struct.pack('BB', 1, 2), idata),
+              (isinstance(e.content, StrPatchwork),
+               e.content[0x79fe:0x7a00], e.content[0x7a00:0x7a08]),
+              'Write at RVA patches the file content in place')
+    assertion(struct.pack('<Q', 0x0807060504030201), e.drva[0x1a1fe:0x1a206],
+              'Write at RVA in the virtual padding of a section')
+
+def test_PE_checksum(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_mingw.exe'))
+    assertion((0x690c0, True),
+              (e.compute_checksum(), e.verify_checksum()),
+              'Checksum of a PE file')
+    assertion(0x690c0, e.compute_checksum(use_numpy=False),
+              'Checksum of a PE file, without NumPy')
+    crc = Checksum(e.content, e.checksum_offset())
+    data = 'abc'.encode('latin1')
+    crc.update(0x401, e.content[0x401:0x404], data)
+    e.content[0x401] = data
+    assertion((0x6753d, 0x6753d, False),
+              (crc.value(), e.compute_checksum(), e.verify_checksum()),
+              'Incremental checksum')
+    data = e.content.pack()
+    crc = Checksum(data[:0], None)
+    for i in range(0, len(data), 0x3001):
+        crc.write(data[i:i+0x3001])
+    of = e.checksum_offset()
+    crc.sum -= struct.unpack('<I', data[of:of+4])[0]
+    assertion(0x6753d, crc.value(),
+              'Checksum of data written in pieces')
+    fd = BytesIO()
+    e.pack_to(fd)
+    assertion((e.pack(), True),
+              (fd.getvalue(), e.verify_checksum(fd.getvalue())),
+              'Streaming with checksum')
+
+def test_PE_authenticode(assertion):
+    dll_vstudio = open_read(__dir__+'/binary_input/pe_vstudio.dll')
+    e = PE(dll_vstudio)
+    digests = e.authenticode_digest(['md5', 'sha256'])
+    assertion(['ff2d90791ec8daaa9a905e48da29379c',
+               '2be972b8aa4a05cde2908fcfd5b4fd06'
+               'f8acfb6d8b55686097be6be276b298e6'],
+              [binascii.hexlify(d).decode('latin1') for d in digests],
+              'Authenticode digests')
+    # Same file, with a certificate table and another checksum
+    c = StrPatchwork(dll_vstudio)
+    c[len(dll_vstudio)] = struct.pack('<IHH8s', 16, 0x200, 2,
+                                      'certdata'.encode('latin1'))
+    c[e.checksum_offset()] = struct.pack('<I', 0x12345678)
+    c[e.checksum_offset()+64] = struct.pack('<II', len(dll_vstudio), 16)
+    e = PE(c.pack())
+    assertion(((35840, 37376), digests[1]),
+              (e.authenticode_ranges()[-1], e.authenticode_digest('sha256')),
+              'Authenticode digest of a signed file')
+
+def test_PE_shared_thunks(assertion):
+    dll_vstudio = open_read(__dir__+'/binary_input/pe_vstudio.dll')
+    e = PE(dll_vstudio)
+    # The second import descriptor points to the thunks of the first
+    of = e.rva2off(e.NThdr.optentries[pe.DIRECTORY_ENTRY_IMPORT].rva)
+    c = StrPatchwork(dll_vstudio)
+    c[of+20] = c[of:of+4]
+    c[of+36] = c[of+16:of+20]
+    e = PE(c.pack())
+    d = e.DirImport
+    assertion((True, True, 8),
+              (d[0].IAT is d[1].IAT, d[0].ILT is d[1].ILT, len(d[1].IAT)),
+              'Thunks shared by import descriptors')
+    assertion([str(t.name) for t in d[0].IAT], [str(t.name) for t in d[1].IAT],
+              'Names of shared thunks')
+
+def test_PE_import_export_index(assertion):
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    index = e.DirImport.func_index()
+    assertion((98, 0x1b014, 0x1b014, True),
+              (len(index), index[('KERNEL32.dll', 'GetCurrentProcess')],
+               index[(None, 'GetCurrentProcess')],
+               index is e.DirImport.func_index()),
+              'Index of imports')
+    assertion((12, 0x110aa, 0x1a138),
+              (len(e.DirExport.name_index()),
+               e.DirExport.name_index()['?fnMyLib@@YAHXZ'],
+               e.DirExport.ordinal_index()[11]),
+              'Index of exports')
+    d = [ _ for _ in e.DirImport if str(_.name) == 'KERNEL32.dll' ][0]
+    d.name.update(s='KERNEL64.dll'.encode('latin1'))
+    d.IAT[0].name = 'NewFunction'
+    index = e.DirImport.func_index()
+    assertion((0x1b014, None, d.firstthunk),
+              (index.get(('KERNEL64.dll', 'GetCurrentProcess')),
+               index.get(('KERNEL32.dll', 'GetCurrentProcess')),
+               index.get(('KERNEL64.dll', 'NewFunction'))),
+              'Index of imports after modification of names')
+    t = e.DirExport[0].ENPT[0]
+    old = str(t.name)
+    t.name.update(s='renamed'.encode('latin1'))
+    assertion((None, True),
+              (e.DirExport.name_index().get(old),
+               'renamed' in e.DirExport.name_index()),
+              'Index of exports after modification of a name')
+    e = PE(open_read(__dir__+'/binary_input/Ange/dllfw.dll'))
+    assertion({0: 'msvcrt.printf', 'ExitProcess': 'msvcrt.printf'},
+              e.DirExport.forwarder_index(),
+              'Index of forwarded exports')
+    try:
+        e.DirExport.forwarder_index()[0] = 'msvcrt.puts'
+        assertion(0, 1, 'Indexes are read-only')
+    except TypeError:
+        pass
+
+def test_PE_import_planner(assertion):
+    global log_history
+    e = PE(open_read(__dir__+'/binary_input/pe_mingw.exe'))
+    e.DirImport.add_dlldesc([({"name":"kernel32.dll"},
+                                ["CreateFileA", "WriteFile"]),
+                             ({"name":"USER32.dll"},
+                                ["GetMenu"])])
+    size, iat_size = e.DirImport.plan(ilt=False, separate_iat=True)
+    assertion((162, 20), (size, iat_size),
+              'Import planner: sizes')
+    s_iat = e.SHList.add_section(name='iat', rawsize=iat_size)
+    s_dir = e.SHList.add_section(name='imp', rawsize=size)
+    e.DirImport.write_directory(s_dir.addr, iat_rva=s_iat.addr, ilt=False)
+    assertion((s_iat.addr+12, size),
+              (e.DirImport.get_funcrva('USER32.dll', 'GetMenu'), s_dir.paddr),
+              'Import planner: separate IAT')
+    e = PE(e.pack())
+    log_history = []
+    assertion((s_iat.addr+4, [True, True, False, False]),
+              (e.DirImport.get_funcrva('kernel32.dll', 'WriteFile'),
+               [hasattr(d, 'ILT') for d in e.DirImport]),
+              'Import planner: no ILT')
+
+def test_PE_export_builder(assertion):
+    global log_history
+    e = PE(open_read(__dir__+'/binary_input/pe_mingw.exe'))
+    try:
+        e.DirExport.build(['no_such_symbol'])
+        assertion(0, 1, 'Export builder: unknown symbol')
+    except ValueError:
+        pass
+    e.DirExport.build(['main', ('foo', 0x1234),
+                       ('bar', 'KERNEL32.ExitProcess')], 'mingw.exe')
+    e = PE(e.pack())
+    assertion((['bar', 'foo', 'main'], 0x1270, 'KERNEL32.ExitProcess'),
+              ([str(t.name) for t in e.DirExport[0].ENPT],
+               e.DirExport.name_index()['main'],
+               e.DirExport.forwarder_index()['bar']),
+              'Export builder: symbols, sorted names and forwarders')
+    e.DirExport.build([('zed', 0x2000), ('foo', 0x1300)])
+    e = PE(e.pack())
+    log_history = []
+    assertion({1: 0x1270, 2: 0x1300, 4: 0x2000},
+              dict([ (k, v) for k, v in e.DirExport.ordinal_index().items()
+                     if k != 3 ]),
+              'Export builder: extension of an existing table')
+    assertion('KERNEL32.ExitProcess',
+              e.DirExport.forwarder_index()[3],
+              'Export builder: forwarders are kept')
+
+def test_PE_resource_lookup(assertion):
+    global log_history
+    e = PE(open_read(__dir__+'/binary_input/pe_vstudio.dll'))
+    r = e.DirRes.lookup(pe.RT_MANIFEST, 2, 1033)
+    assertion((0x1d170, 381, True, None),
+              (r.rva, r.size, r is e.DirRes.lookup(pe.RT_MANIFEST),
+               e.DirRes.lookup(pe.RT_ICON)),
+              'Lookup of a resource')
+    assertion('1e4a89b11eae0fcf8bb5fdd5ec3b6f61',
+              hashlib.md5(r.data).hexdigest(),
+              'Content of a resource')
+    r.data = data_null*1100
+    assertion((1100, 1100), (len(r.data), r.size),
+              'Content of a resource replaced')
+    entries = r.parent.parent
+    new = pe.ResourceDataDescription(parent=r.parent, rva=0x1234, size=4)
+    entries[0].data = new
+    assertion(new, e.DirRes.lookup(pe.RT_MANIFEST, 2, 1033),
+              'Lookup of a resource after replacing it')
+    entry = pe.ResourceDirectoryEntry(parent=entries, id=entries[0].id)
+    entry.data = r
+    entries[0] = entry
+    assertion(r, e.DirRes.lookup(pe.RT_MANIFEST),
+              'Lookup of a resource after replacing its entry')
+    e = PE(open_read(__dir__+'/binary_input/Ange/namedresource.exe'))
+    assertion(" * resource loaded by 'named' name and type\n\x00".encode('latin1'),
+              e.DirRes.lookup('TYPE', 'RES', 0).data,
+              'Lookup of a named resource')
+    e = PE(open_read(__dir__+'/binary_input/Ange/resourceloop.exe'))
+    assertion(0x11a0,
+              e.DirRes.lookup(789, 29524, 0).rva,
+              'Lookup in a resource loop')
+    log_history = []
+
 def test_PE_dll(assertion):
     global log_history
     # Small DLL created with Visual Studio
@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+
+from test_all import run_tests, assertion
+from elfesteem.strpatchwork import StrPatchwork
+from elfesteem import relocation
+import struct
+
+def test_relocation_fields(assertion):
+    image = StrPatchwork(struct.pack("<5I", 0xebfffffe, 0x94000000,
+                                     0x90000000, 0xf9400020, 0))
+    r = relocation.Relocator('<')
+    r.add(image, 0, relocation.arm_branch, relocation.S_A_P,
+          S=0x9000, P=0x8000)
+    r.add(image, 4, relocation.a64_branch, relocation.S_A_P,
+          S=0x2000, A=0, P=0x1000)
+    r.add(image, 8, relocation.a64_adrp, relocation.page_S_A_P,
+          S=0x12345678, A=0, P=0x1000)
+    r.add(image, 12, relocation.a64_lo12(3), relocation.S_A,
+          S=0x12345678, A=0)
+    r.add(image, 16, relocation.word32, relocation.S_A_P,
+          S=0x1000, A=-4, P=0x2000)
+    assertion(1, r.apply(),
+              'Relocations applied to one page')
+    assertion((0xeb0003fe, 0x94000400, 0x90091a20, 0xf9433c20, 0xffffeffc),
+              struct.unpack("<5I", image.pack()),
+              'Relocation of branches, ADRP, LDR and words')
+
+def test_relocation_pe_fields(assertion):
+    image = StrPatchwork(struct.pack("<4H", 0xf240, 0, 0xf2c0, 0)
+                       + struct.pack("<H", 0x1234))
+    r = relocation.Relocator('<')
+    r.add(image, 0, relocation.thumb_mov32, relocation.B_A, B=0x12345678)
+    r.add(image, 8, relocation.word16_highadj(0x8000), relocation.B_A,
+          B=0x10000)
+    r.apply()
+    assertion((0xf245, 0x6078, 0xf2c1, 0x2034, 0x1235),
+              struct.unpack("<5H", image.pack()),
+              'Relocation of MOVW/MOVT and HIGHADJ')
+    assertion(0x12345678,
+              relocation.thumb_mov32.extract(struct.unpack("<Q", image[0:8])[0]),
+              'Value of MOVW/MOVT')
+
+def run_test(assertion):
+    for name, value in dict(globals()).items():
+        if name.startswith('test_'):
+            value(assertion)
+
+if __name__ == "__main__":
+    run_tests(run_test)
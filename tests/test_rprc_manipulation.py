@@ -5,6 +5,7 @@ __dir__ = os.path.dirname(__file__)
 
 from test_all import run_tests, assertion, hashlib, open_read
 from elfesteem.rprc import RPRC
+from io import BytesIO
 
 def test_RPRC_empty(assertion):
     e = RPRC()
@@ -16,6 +17,10 @@ def test_RPRC_empty(assertion):
     assertion('865001a37fa24754bd17012e85d2bfff',
               hashlib.md5(d).hexdigest(),
               'Creation of a standard empty RPRC; fix point')
+    fd = BytesIO()
+    RPRC(d).pack_to(fd)
+    assertion(d, fd.getvalue(),
+              'Streaming an empty RPRC to a file')
 
 def test_RPRC_ducati(assertion):
     rprc_m3 = open_read(__dir__+'/binary_input/ducati-m3_p768.bin')
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+import os
+__dir__ = os.path.dirname(__file__)
+
+from test_all import run_tests, assertion, hashlib, open_read
+from elfesteem.strpatchwork import StrPatchwork, pack_regions
+import struct
+from io import BytesIO
+
+def test_StrPatchwork_basic(assertion):
+    s = StrPatchwork(struct.pack("4B",1,2,3,4))
+    s[6] = struct.pack("B",7)
+    assertion(struct.pack("7B",1,2,3,4,0,0,7), s.pack(),
+              'Write after the end of StrPatchwork')
+    assertion(struct.pack("3B",7,0,0), s[6:9],
+              'Read after the end of StrPatchwork')
+    assertion(3, s.find(struct.pack("B",4)),
+              'Find in StrPatchwork')
+
+def test_StrPatchwork_overlay(assertion):
+    raw = struct.pack("16B",*range(16))
+    s = StrPatchwork(raw)
+    s[4] = struct.pack("2B",0xaa,0xbb)
+    s[9] = struct.pack("B",0xcc)
+    s[6] = struct.pack("B",0xdd)
+    assertion(True, s.base is raw,
+              'Original data of StrPatchwork is not copied')
+    assertion([4, 9], s.patch_start,
+              'Adjacent patches are merged')
+    assertion(struct.pack("5B",3,0xaa,0xbb,0xdd,7), s[3:8],
+              'Read across patches')
+    assertion(3, s.find(struct.pack("2B",3,0xaa)),
+              'Find pattern starting before a patch')
+    assertion(6, s.find(struct.pack("2B",0xdd,7)),
+              'Find pattern ending after a patch')
+    assertion(-1, s.find(struct.pack("2B",4,5)),
+              'Find pattern hidden by a patch')
+    assertion(12, s.find(struct.pack("B",12), 5),
+              'Find pattern after patches')
+    assertion(9, s.rfind(struct.pack("B",0xcc)),
+              'Rfind pattern in a patch')
+    assertion(-1, s.rfind(struct.pack("B",0xcc), 0, 9),
+              'Rfind pattern in a patch outside of the range')
+    assertion(True, struct.pack("2B",8,0xcc) in s,
+              'Pattern in StrPatchwork')
+
+def test_StrPatchwork_unpack_from(assertion):
+    st = struct.Struct("<HH")
+    s = StrPatchwork(struct.pack("<HHH",1,2,3))
+    s[4] = struct.pack("<H",4)
+    assertion((1, 2), s.unpack_from(st, 0),
+              'Unpack from base of StrPatchwork')
+    assertion((2, 4), s.unpack_from(st, 2),
+              'Unpack from patched StrPatchwork')
+    assertion((4, 0), s.unpack_from(st, 4),
+              'Unpack after the end of StrPatchwork')
+
+def test_StrPatchwork_sequential(assertion):
+    s = StrPatchwork()
+    s[0] = struct.pack("B",1)
+    patch = s.patch_data[0]
+    for i in range(1, 20000):
+        s[i*100-99] = struct.pack("B",1)*100
+    assertion((True, 1999901),
+              (s.patch_data[0] is patch, len(s)),
+              'Sequential writes extend the patch in place')
+    s = StrPatchwork(struct.pack("8B",*range(8)))
+    s[1] = struct.pack("2B",0xaa,0xaa)
+    s[2] = struct.pack("3B",0xbb,0xbb,0xbb)
+    assertion(struct.pack("8B",0,0xaa,0xbb,0xbb,0xbb,5,6,7), s.pack(),
+              'Write that extends a patch over the original data')
+
+def test_StrPatchwork_pack_to(assertion):
+    import elfesteem.strpatchwork
+    chunk_size = elfesteem.strpatchwork.chunk_size
+    elfesteem.strpatchwork.chunk_size = 3
+    s = StrPatchwork(struct.pack("8B",*range(8)))
+    s[2] = struct.pack("B",0xaa)
+    s[10] = struct.pack("4B",0xbb,0xbb,0xbb,0xbb)
+    assertion([2, 1, 3, 2, 3, 3], [len(_) for _ in s.chunks()],
+              'StrPatchwork in chunks')
+    fd = BytesIO()
+    s.pack_to(fd)
+    assertion(s.pack(), fd.getvalue(),
+              'StrPatchwork written to a file')
+    elfesteem.strpatchwork.chunk_size = chunk_size
+
+def test_StrPatchwork_pack_regions(assertion):
+    fd = BytesIO()
+    pack_regions(fd, [
+        (2, lambda: struct.pack("3B",1,1,1)),
+        (10, lambda: struct.pack("2B",2,2)),
+        (3, lambda: struct.pack("B",3)),
+        (0, lambda: struct.pack("B",4)),
+        (16, lambda: struct.pack("")),
+        ])
+    c = StrPatchwork()
+    c[2] = struct.pack("3B",1,1,1)
+    c[10] = struct.pack("2B",2,2)
+    c[3] = struct.pack("B",3)
+    c[0] = struct.pack("B",4)
+    c[16] = struct.pack("")
+    assertion(c.pack(), fd.getvalue(),
+              'Regions written in offset order to a file')
+    assertion(struct.pack("16B",4,0,1,3,1,0,0,0,0,0,2,2,0,0,0,0),
+              fd.getvalue(),
+              'Overlapping regions, gaps and empty region at the end')
+
+def test_StrPatchwork_mapped(assertion):
+    filename = __dir__+'/binary_input/elf_small.out'
+    raw = open_read(filename)
+    s = StrPatchwork.from_file(filename)
+    assertion(True, s.base is not None,
+              'StrPatchwork mapped from a file')
+    assertion(len(raw), len(s),
+              'Length of mapped StrPatchwork')
+    assertion(raw[0x100:0x120], s[0x100:0x120],
+              'Read from mapped StrPatchwork')
+    s[0x110] = struct.pack("4B",1,2,3,4)
+    s[0x112] = struct.pack("4B",5,6,7,8)
+    s[len(raw)+4] = struct.pack("B",9)
+    assertion([0x110, len(raw)], s.patch_start,
+              'Overlay of patches in mapped StrPatchwork')
+    expected = raw[:0x110] + struct.pack("6B",1,2,5,6,7,8) + raw[0x116:] \
+               + struct.pack("5B",0,0,0,0,9)
+    assertion(expected, s.pack(),
+              'Pack of patched mapped StrPatchwork')
+    assertion(expected[0x10c:0x11c], s[0x10c:0x11c],
+              'Read across a patch of mapped StrPatchwork')
+    assertion(raw, open_read(filename),
+              'Mapped file is not modified')
+    assertion(expected.find(struct.pack("3B",6,7,8)),
+              s.find(struct.pack("3B",6,7,8)),
+              'Find in patched mapped StrPatchwork')
+    v = s.view(0x100, 0x110)
+    if not isinstance(v, type(raw)):
+        v = v.tobytes() # memoryview of the mapped file
+    assertion(raw[0x100:0x110], v,
+              'View of mapped StrPatchwork')
+    assertion(expected[0x10c:0x11c], s.view(0x10c, 0x11c),
+              'View across a patch of mapped StrPatchwork')
+    m = StrPatchwork(memoryview(raw))
+    m[0x110] = struct.pack("4B",1,2,3,4)
+    assertion(raw[:0x110] + struct.pack("4B",1,2,3,4) + raw[0x114:], m.pack(),
+              'Patch of StrPatchwork backed by a memoryview')
+
+def test_StrPatchwork_containers(assertion):
+    from elfesteem.elf_init import ELF
+    from elfesteem.pe_init import PE
+    from elfesteem.macho_init import MACHO
+    from elfesteem.minidump_init import Minidump
+    for container, filename in (
+            (ELF,      'elf_small.out'),
+            (PE,       'pe_mingw.exe'),
+            (MACHO,    'macho/macho_fat.out'),
+            (Minidump, 'minidump-i386.dmp'),
+            ):
+        filename = __dir__+'/binary_input/'+filename
+        raw = open_read(filename)
+        e = container(StrPatchwork.from_file(filename))
+        if hasattr(e, 'content'):
+            d = e.content.pack()
+        else:
+            d = e._content.pack()
+        assertion(hashlib.md5(raw).hexdigest(), hashlib.md5(d).hexdigest(),
+                  'Parsing mapped file with %s' % container.__name__)
+        if container is not Minidump:
+            d = container(raw).pack()
+            assertion(hashlib.md5(d).hexdigest(),
+                      hashlib.md5(e.pack()).hexdigest(),
+                      'Packing mapped file with %s' % container.__name__)
+            fd = BytesIO()
+            e.pack_to(fd)
+            assertion(hashlib.md5(d).hexdigest(),
+                      hashlib.md5(fd.getvalue()).hexdigest(),
+                      'Streaming mapped file with %s' % container.__name__)
+
+def run_test(assertion):
+    for name, value in dict(globals()).items():
+        if name.startswith('test_'):
+            value(assertion)
+
+if __name__ == "__main__":
+    run_tests(run_test)